@@ -28,6 +28,18 @@ release_notes.add_argument(
     required=True,
 )
 
+# benchmark-substitution
+benchmark_substitution = command.add_parser(
+    "benchmark-substitution",
+    help="Compare the throughput of compiled and uncompiled parameter substitution.",
+)
+benchmark_substitution.add_argument(
+    "--number",
+    type=int,
+    default=20000,
+    help="The number of times to substitute the parameters.",
+)
+
 
 args = parser.parse_args()
 if args.command == "bump-version":
@@ -146,3 +158,79 @@ elif args.command == "release-notes":
     else:
         print(f"No release notes found for version {args.version}.")
         exit(1)
+
+elif args.command == "benchmark-substitution":
+    import functools
+    import sys
+    import timeit
+
+    sys.path.insert(0, "src")
+    from tarmac.templates import FULL_SUBSTITUTION_REGEX, SUBSTITUTION_REGEX, Template
+
+    # Typical step parameters: a few expressions among mostly literal values.
+    params = {
+        "host": "${target}",
+        "url": "https://${target}:${port}/api/${version}",
+        "env": {"REGION": "${matrix['region']}", "MODE": "production", "DEBUG": "0"},
+        "args": ["--retries", "3", "--timeout=${port // 100}"],
+        "message": "Deploying $${literal} to ${target}",
+    }
+    namespace = {
+        "target": "web1.example.com",
+        "port": 8443,
+        "version": "v2",
+        "matrix": {"region": "eu"},
+    }
+
+    # The substitution as it was done before templates:
+    # regexes and `eval` on the source of every expression, every time.
+    def substitute_uncompiled(v, evaluate=lambda s: eval(s, {}, namespace)):
+        if isinstance(v, str):
+            if m := FULL_SUBSTITUTION_REGEX.match(v):
+                return evaluate(m.group(1))
+
+            def subst(match):
+                escape_len = len(match.group(1))
+                prefix = "$" * (escape_len // 2)
+                if escape_len % 2 == 0:
+                    return prefix + "{" + match.group(2) + "}"
+                return prefix + str(evaluate(match.group(2)))
+
+            return SUBSTITUTION_REGEX.sub(subst, v)
+        elif isinstance(v, list):
+            return [substitute_uncompiled(i, evaluate) for i in v]
+        elif isinstance(v, dict):
+            return {k: substitute_uncompiled(i, evaluate) for k, i in v.items()}
+        return v
+
+    # The same, with `eval` of cached code objects instead of the safe
+    # expression engine, to compare the cost of evaluating the expressions.
+    compile_cached = functools.lru_cache(lambda s: compile(s, "<expr>", "eval"))
+
+    def eval_cached(s):
+        return eval(compile_cached(s), {}, namespace)
+
+    template = Template(params)
+    constant = Template({key: "literal" for key in params})
+    assert substitute_uncompiled(params) == template.render(namespace)
+
+    results = {
+        "uncompiled": timeit.timeit(
+            lambda: substitute_uncompiled(params), number=args.number
+        ),
+        "uncompiled, cached eval": timeit.timeit(
+            lambda: substitute_uncompiled(params, eval_cached), number=args.number
+        ),
+        "compiled": timeit.timeit(
+            lambda: template.render(namespace), number=args.number
+        ),
+        "compiled, no placeholders": timeit.timeit(
+            lambda: constant.render({}), number=args.number
+        ),
+    }
+    baseline = results["uncompiled"]
+    for name, seconds in results.items():
+        print(
+            f"{name:>26}: {args.number / seconds:>10.0f} params/s"
+            f" ({baseline / seconds:.1f}x)"
+        )
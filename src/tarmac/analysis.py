@@ -0,0 +1,105 @@
+import ast
+
+from .expressions import STEP_HELPERS, compile_expression
+from .metadata import WorkflowStep
+from .templates import template_expressions
+
+
+def infer_references(steps: list[WorkflowStep]) -> list[set[str] | None]:
+    """
+    Find the IDs of the steps whose outputs each workflow step reads.
+
+    The substitutions, the condition and the Python body
+    of each step are inspected. Expressions record the steps they read
+    when they are compiled, so only Python bodies are walked here.
+    The result is None for steps that access the step outputs in a way
+    that cannot be determined statically.
+    """
+    return [step_references(step) for step in steps]
+
+
+def step_references(step: WorkflowStep) -> set[str] | None:
+    """
+    Find the IDs of the steps whose outputs a workflow step reads.
+
+    Returns None if they cannot be determined statically.
+    """
+    refs: set[str] = set()
+    for expression in template_expressions(step.substituted_values):
+        found = expression_references(expression)
+        if found is None:
+            return None
+        refs |= found
+    if isinstance(step.condition, str):
+        found = expression_references(step.condition)
+        if found is None:
+            return None
+        refs |= found
+    if step.py is not None:
+        try:
+            tree = ast.parse(step.py, mode="exec")
+        except SyntaxError:
+            return None
+        found = _tree_references(tree)
+        if found is None:
+            return None
+        refs |= found
+    return refs
+
+
+def expression_references(expression: str) -> set[str] | None:
+    """
+    Find the IDs of the steps whose outputs an expression reads.
+
+    Returns None if they cannot be determined statically.
+    """
+    try:
+        return compile_expression(expression).references
+    except (SyntaxError, ValueError):
+        return None
+
+
+def _tree_references(tree: ast.AST) -> set[str] | None:
+    parents: dict[ast.AST, ast.AST] = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+    refs = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "steps":
+            ref = _steps_access(node, parents)
+            if ref is None:
+                return None
+            refs.add(ref)
+        elif (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in STEP_HELPERS
+        ):
+            ref = _constant_string(node.args[0]) if node.args else None
+            if ref is None:
+                return None
+            refs.add(ref)
+    return refs
+
+
+def _steps_access(node: ast.Name, parents: dict[ast.AST, ast.AST]) -> str | None:
+    parent = parents.get(node)
+    if isinstance(parent, ast.Attribute):
+        if parent.attr != "get":
+            # steps.foo
+            return parent.attr
+        # steps.get("foo")
+        call = parents.get(parent)
+        if isinstance(call, ast.Call) and call.func is parent and call.args:
+            return _constant_string(call.args[0])
+    # steps["foo"]
+    if isinstance(parent, ast.Subscript) and parent.value is node:
+        return _constant_string(parent.slice)
+    return None
+
+
+def _constant_string(node: ast.AST) -> str | None:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
@@ -0,0 +1,657 @@
+import asyncio
+import contextlib
+import itertools
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Iterable, TypeVar
+
+from .concurrency import AdaptiveLimiter
+from .journal import child_run_id
+from .metadata import ConcurrencyGroup, ValueMapping, WorkflowStep
+from .resources import Capacity
+from .runner import (
+    Runner,
+    WorkflowCallback,
+    WorkflowRun,
+    _held_groups,
+    _step_timeout,
+)
+from .scheduler import StepSelection
+from .transport import (
+    CommandResult,
+    LocalTransport,
+    cancel_on,
+    cancelled,
+    kill_process_group,
+    script_files,
+    wait_interval,
+)
+
+T = TypeVar("T")
+
+
+async def _blocking(
+    func: Callable[..., T], *args: Any, undo: Callable[[T], Any] | None = None
+) -> T:
+    """
+    Run a blocking call, such as file I/O, a lock or starting a process,
+    in a thread so that the other runs on the event loop keep going.
+
+    When the caller is cancelled, the call still finishes in its thread,
+    so its result is passed to `undo` before the cancellation propagates.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        try:
+            result = await future
+        except Exception:
+            raise asyncio.CancelledError from None
+        if undo is not None:
+            undo(result)
+        raise
+
+
+class AsyncRunner:
+    """
+    This class is responsible for executing scripts and workflows
+    on an asyncio event loop.
+
+    It produces the same outputs as `Runner`,
+    but waits for subprocesses without blocking a thread,
+    so that many workflows can run concurrently on one event loop.
+    Cancelling a call kills the subprocesses it started.
+    """
+
+    def __init__(
+        self,
+        base_path: str | Path,
+        jobs: int = 1,
+        cwd: str | Path | None = None,
+        capacity: Capacity | None = None,
+        warm_workers: bool = False,
+        cached_envs: bool = False,
+        offline: bool = False,
+        prefetch: int = 0,
+    ):
+        # Subprocesses are started on the event loop, so only local ones.
+        self.transport = LocalTransport(cwd)
+        self.runner = Runner(
+            base_path,
+            jobs=jobs,
+            transport=self.transport,
+            capacity=capacity,
+            warm_workers=warm_workers,
+            cached_envs=cached_envs,
+            offline=offline,
+            prefetch=prefetch,
+        )
+
+    @property
+    def base_path(self) -> Path:
+        return self.runner.base_path
+
+    @property
+    def jobs(self) -> int:
+        return self.runner.jobs
+
+    async def _communicate(
+        self,
+        p: asyncio.subprocess.Process,
+        stdin: bytes | None = None,
+        timeout: float | None = None,
+    ) -> tuple[str, str, bool]:
+        """
+        Like `transport.communicate`, for a process started on the event loop.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        communicate = asyncio.ensure_future(p.communicate(stdin))
+        try:
+            while True:
+                done, _ = await asyncio.wait(
+                    [communicate], timeout=wait_interval(deadline)
+                )
+                if done or cancelled():
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+        except asyncio.CancelledError:
+            if p.returncode is None:
+                # Kill the whole session so that children of the process
+                # do not keep its output pipes open.
+                kill_process_group(p)
+            await p.wait()
+            communicate.cancel()
+            raise
+        timed_out = not done
+        if timed_out:
+            kill_process_group(p)
+        # The output read before a timeout is kept.
+        stdout, stderr = await communicate
+        return (
+            stdout.decode("utf-8", errors="replace"),
+            stderr.decode("utf-8", errors="replace"),
+            timed_out,
+        )
+
+    def close(self) -> None:
+        """
+        Stop the environment prefetching and the warm workers of the runner.
+        """
+        self.runner.close()
+
+    async def execute_script(
+        self,
+        name: str,
+        inputs: ValueMapping,
+        timeout: float | None = None,
+        warm: bool = True,
+    ) -> ValueMapping:
+        prefetcher = self.runner.prefetcher
+        if prefetcher is not None:
+            await asyncio.to_thread(prefetcher.wait, name, warm)
+        filename, metadata = await asyncio.to_thread(self.runner._load_script, name)
+        inputs = metadata.validate_inputs(inputs)
+        python = await asyncio.to_thread(self.runner._script_python, filename, metadata)
+        workers = self.runner.workers
+        if warm and workers is not None:
+            # The worker is waited for in a thread, and killed on cancellation.
+            worker, digest = await _blocking(
+                workers.acquire,
+                filename,
+                metadata,
+                self.runner._uv_args(metadata),
+                python,
+                undo=lambda acquired: workers.release(acquired[0]),
+            )
+            try:
+                result, outputs = await asyncio.to_thread(
+                    worker.run_script, filename, digest, inputs, timeout
+                )
+            except asyncio.CancelledError:
+                worker.kill()
+                raise
+            finally:
+                await _blocking(workers.release, worker)
+            return self.runner._script_outputs(outputs, result)
+        with script_files(inputs) as (env, outputs_file):
+            p = await asyncio.create_subprocess_exec(
+                *self.transport.script_command(
+                    filename, self.runner._uv_args(metadata), python
+                ),
+                env=env,
+                cwd=self.transport.cwd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+            )
+            stdout, stderr, timed_out = await self._communicate(p, None, timeout)
+            assert p.returncode is not None
+            outputs_file.seek(0)
+            outputs = outputs_file.read().decode("utf-8", errors="replace")
+        return self.runner._script_outputs(
+            outputs, CommandResult(p.returncode, stdout, stderr, timed_out)
+        )
+
+    async def execute_shell(
+        self,
+        script: str | list[str],
+        inputs: ValueMapping,
+        timeout: float | None = None,
+    ) -> ValueMapping:
+        extra_env, cwd, stdin = self.runner._shell_options(inputs)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        env = os.environ.copy()
+        env.update(extra_env)
+        cwd = self.transport.resolve_cwd(cwd)
+        if isinstance(script, str):
+            script = [script]
+        out: ValueMapping = {
+            "succeeded": True,
+            "output": "",
+            "error": "",
+            "returncode": 0,
+        }
+        for s in script:
+            p = await asyncio.create_subprocess_shell(
+                s,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                stdin=asyncio.subprocess.PIPE if stdin else None,
+                env=env,
+                cwd=cwd,
+                start_new_session=True,
+            )
+            left = None if deadline is None else max(deadline - time.monotonic(), 0)
+            stdout, stderr, timed_out = await self._communicate(
+                p, stdin.encode("utf-8") if stdin else None, left
+            )
+            stdin = None  # only pass stdin to the first command
+            out["returncode"] = p.returncode
+            out["output"] += stdout
+            out["error"] += stderr
+            if timed_out:
+                out["succeeded"] = False
+                out["timed_out"] = True
+                break
+            if p.returncode != 0:
+                out["succeeded"] = False
+                break
+            else:
+                out["succeeded"] = True
+        return out
+
+    async def execute_python(
+        self, script: str, inputs: ValueMapping, steps: ValueMapping
+    ) -> ValueMapping:
+        # Python steps run in-process, so keep them off the event loop.
+        return await asyncio.to_thread(
+            self.runner.execute_python, script, inputs, steps
+        )
+
+    async def execute_workflow(
+        self,
+        name: str,
+        inputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        timeout: float | None = None,
+        run_id: str | None = None,
+        selection: StepSelection | None = None,
+    ) -> ValueMapping:
+        runner = self.runner
+        # Starting a run reads the workflow and history and creates the journal.
+        run = await _blocking(
+            runner._start_workflow,
+            name,
+            inputs,
+            before_each,
+            after_each,
+            timeout,
+            run_id,
+            selection,
+            undo=lambda run: run.close(),
+        )
+        try:
+            async with self._concurrency_slot(
+                run.metadata.concurrency, run.inputs, run.remaining()
+            ) as slot:
+                if slot is not None and slot.get("timed_out"):
+                    run.outputs["succeeded"] = False
+                else:
+                    await self._execute_steps(run)
+            if slot is not None:
+                run.outputs["concurrency"] = slot
+            await _blocking(runner._finish_workflow, run)
+        finally:
+            await _blocking(run.close)
+        return run.outputs
+
+    async def resume_workflow(
+        self,
+        name: str,
+        run_id: str,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+    ) -> ValueMapping:
+        """
+        Like `Runner.resume_workflow`, on the event loop.
+        """
+        inputs, selection = await asyncio.to_thread(
+            self.runner._resume_arguments, name, run_id
+        )
+        return await self.execute_workflow(
+            name, inputs, before_each, after_each, run_id=run_id, selection=selection
+        )
+
+    async def _execute_steps(self, run: WorkflowRun) -> None:
+        runner = self.runner
+        before_each, after_each = run.before_each, run.after_each
+        scheduler, outputs = run.scheduler, run.outputs
+        # Each step gets a snapshot of the outputs of the steps
+        # that finished before it started.
+        running: dict[asyncio.Task, int] = {}
+        # The steps that are running when a step times out are killed too.
+        timed_out = threading.Event()
+        try:
+            with cancel_on(timed_out):
+                while True:
+                    if outputs["succeeded"] and run.expired():
+                        outputs["succeeded"] = False
+                    if outputs["succeeded"]:
+                        for index in scheduler.ready():
+                            if len(running) >= self.jobs:
+                                break
+                            if not scheduler.reserve(index):
+                                continue
+                            # Starting and finishing a step are written to the journal.
+                            step = await _blocking(run.start_step, index)
+                            task = asyncio.create_task(
+                                self.execute_workflow_step(
+                                    step,
+                                    run.inputs,
+                                    run.snapshot(),
+                                    before_each,
+                                    after_each,
+                                    run.deadline,
+                                    run.run_id,
+                                )
+                            )
+                            running[task] = index
+                    if not running:
+                        if not outputs["succeeded"] or not scheduler.ready():
+                            break
+                        # Other runs hold the resources the ready steps need.
+                        # The wait is bounded, since a thread cannot be cancelled.
+                        remaining = run.remaining()
+                        await asyncio.to_thread(
+                            scheduler.wait_for_resources,
+                            1.0 if remaining is None else min(remaining, 1.0),
+                        )
+                        continue
+                    done, _ = await asyncio.wait(
+                        running, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        index = running.pop(task)
+                        out = task.result()
+                        await _blocking(run.finish_step, index, out)
+                        if not runner._step_succeeded(out):
+                            outputs["succeeded"] = False
+                        if out.get("timed_out"):
+                            timed_out.set()
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    @contextlib.asynccontextmanager
+    async def _concurrency_slot(
+        self,
+        concurrency: ConcurrencyGroup | None,
+        namespace: ValueMapping,
+        timeout: float | None = None,
+    ) -> AsyncIterator[ValueMapping | None]:
+        """
+        Like `Runner._concurrency_slot`, but waits without blocking the event loop.
+        """
+        if concurrency is None:
+            yield None
+            return
+        semaphore = self.runner._concurrency_semaphore(concurrency, namespace)
+        held = _held_groups.get()
+        key = (str(semaphore.directory), semaphore.group)
+        if key in held:
+            yield {"group": semaphore.group, "waited": 0.0}
+            return
+        start = time.monotonic()
+        acquired = False
+        # The queue and slot files are locked in a thread.
+        try:
+            await _blocking(semaphore.join)
+            while not (
+                acquired := await _blocking(
+                    semaphore.try_acquire, undo=lambda _: semaphore.release()
+                )
+            ):
+                waited = time.monotonic() - start
+                if timeout is not None and waited >= timeout:
+                    break
+                delay = semaphore.poll_interval
+                if timeout is not None:
+                    delay = min(delay, timeout - waited)
+                await asyncio.sleep(delay)
+        except BaseException:
+            await _blocking(semaphore.leave)
+            raise
+        waited = time.monotonic() - start
+        if not acquired:
+            await _blocking(semaphore.leave)
+            yield {
+                "group": semaphore.group,
+                "waited": round(waited, 3),
+                "timed_out": True,
+            }
+            return
+        # Tasks copy the context, so the steps of the run see the group.
+        token = _held_groups.set(held | {key})
+        try:
+            yield {"group": semaphore.group, "waited": round(waited, 3)}
+        finally:
+            _held_groups.reset(token)
+            await _blocking(semaphore.release)
+
+    async def execute_workflow_step(
+        self,
+        step: WorkflowStep,
+        inputs: ValueMapping,
+        outputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        deadline: float | None = None,
+        run_id: str | None = None,
+    ) -> ValueMapping:
+        runner = self.runner
+        if step.matrix is not None:
+            instances = runner._matrix_instances(step, inputs, outputs)
+            max_parallel = step.max_parallel or self.jobs
+            limiter = runner._create_limiter(step.adaptive, max_parallel)
+            results = await self._execute_instances(
+                instances,
+                len(instances),
+                max_parallel,
+                step.fail_fast,
+                inputs,
+                outputs,
+                before_each,
+                after_each,
+                limiter,
+                deadline,
+                run_id,
+            )
+            out = runner._matrix_outputs(instances, results)
+            if limiter is not None:
+                out["adaptive"] = limiter.report()
+        elif step.for_each is not None:
+            batches = runner._for_each_batches(step, inputs, outputs)
+            max_parallel = step.parallel or self.jobs
+            limiter = runner._create_limiter(step.adaptive, max_parallel)
+            results = await self._execute_instances(
+                runner._for_each_instances(step, batches),
+                len(batches),
+                max_parallel,
+                step.fail_fast,
+                inputs,
+                outputs,
+                before_each,
+                after_each,
+                limiter,
+                deadline,
+                run_id,
+            )
+            out = runner._for_each_outputs(step, batches, results)
+            if limiter is not None:
+                out["adaptive"] = limiter.report()
+        else:
+            out = await self._execute_step(
+                step,
+                inputs,
+                outputs,
+                before_each,
+                after_each,
+                None,
+                deadline,
+                run_id,
+            )
+        assert isinstance(outputs["steps"], dict)
+        assert step.id is not None
+        outputs["steps"][step.id] = out
+        return out
+
+    async def _execute_step(
+        self,
+        step: WorkflowStep,
+        inputs: ValueMapping,
+        outputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        variables: ValueMapping | None = None,
+        deadline: float | None = None,
+        run_id: str | None = None,
+    ) -> ValueMapping:
+        runner = self.runner
+        timeout = _step_timeout(step.timeout, deadline)
+        # Conditions may run shell commands, so keep them off the event loop.
+        if step.condition is not None and not await asyncio.to_thread(
+            runner.evaluate_condition,
+            step.condition,
+            inputs,
+            outputs,
+            variables,
+            deadline,
+        ):
+            if before_each:
+                before_each(step, {})
+            out = {"succeeded": None}
+        else:
+            params = runner._substitute_params(step, inputs, outputs, variables)
+            if before_each:
+                before_each(step, params)
+            namespace = (
+                runner._step_namespace(inputs, outputs, variables)
+                if step.cache or step.concurrency
+                else {}
+            )
+            # Cache keys hash the script files, and entries are files.
+            key = (
+                await asyncio.to_thread(runner._cache_key, step, params, namespace)
+                if step.cache
+                else None
+            )
+            cached = (
+                await asyncio.to_thread(runner.cache.get, key)
+                if key is not None
+                else None
+            )
+            if cached is not None:
+                out = {**cached, "cached": True}
+            elif timeout is not None and timeout <= 0:
+                out = {"succeeded": False, "timed_out": True}
+            else:
+                # Waiting for a turn in the group counts against the timeout.
+                expires = None if timeout is None else time.monotonic() + timeout
+                async with self._concurrency_slot(
+                    step.concurrency, namespace, timeout
+                ) as slot:
+                    if slot is not None and slot.get("timed_out"):
+                        out = {"succeeded": False, "timed_out": True}
+                    else:
+                        out = await self._run_step(
+                            step,
+                            params,
+                            outputs,
+                            before_each,
+                            after_each,
+                            _step_timeout(None, expires),
+                            run_id,
+                        )
+                if key is not None:
+                    await _blocking(runner._store_cached, step, key, out)
+                if slot is not None:
+                    out["concurrency"] = slot
+
+        if after_each:
+            after_each(step, out)
+        return out
+
+    async def _run_step(
+        self,
+        step: WorkflowStep,
+        params: ValueMapping,
+        outputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        timeout: float | None = None,
+        run_id: str | None = None,
+    ) -> ValueMapping:
+        if step.type == "script":
+            assert step.do is not None
+            return await self.execute_script(step.do, params, timeout, step.warm)
+        elif step.type == "shell":
+            assert step.run is not None
+            return await self.execute_shell(step.run, params, timeout)
+        elif step.type == "python":
+            assert step.py is not None
+            return await self.execute_python(step.py, params, outputs["steps"])
+        elif step.type == "workflow":
+            assert step.workflow is not None
+            if run_id is not None:
+                run_id = child_run_id(run_id, str(step.id))
+            return await self.execute_workflow(
+                step.workflow, params, before_each, after_each, timeout, run_id
+            )
+        else:
+            raise ValueError("unknown step type")  # pragma: no cover
+
+    async def _execute_instances(
+        self,
+        instances: Iterable[tuple[WorkflowStep, ValueMapping]],
+        count: int,
+        max_parallel: int,
+        fail_fast: bool,
+        inputs: ValueMapping,
+        outputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        limiter: AdaptiveLimiter | None = None,
+        deadline: float | None = None,
+        run_id: str | None = None,
+    ) -> list[ValueMapping | None]:
+        results: list[ValueMapping | None] = [None] * count
+        pending = enumerate(instances)
+        running: dict[asyncio.Task, tuple[int, float]] = {}
+        stopped = False
+        try:
+            while True:
+                if not stopped:
+                    limit = max_parallel if limiter is None else limiter.limit
+                    free = max(limit - len(running), 0)
+                    for index, (instance, variables) in itertools.islice(pending, free):
+                        task = asyncio.create_task(
+                            self._execute_step(
+                                instance,
+                                inputs,
+                                outputs,
+                                before_each,
+                                after_each,
+                                variables,
+                                deadline,
+                                run_id,
+                            )
+                        )
+                        running[task] = (index, time.monotonic())
+                if not running:
+                    break
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    index, started = running.pop(task)
+                    out = results[index] = task.result()
+                    succeeded = self.runner._step_succeeded(out)
+                    if limiter is not None:
+                        limiter.record(time.monotonic() - started, succeeded)
+                        if limiter.tripped:
+                            stopped = True
+                    if fail_fast and not succeeded:
+                        stopped = True
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+        return results
@@ -0,0 +1,119 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from .metadata import ValueMapping
+from .state import write_json
+
+
+class ResultCache:
+    """
+    Stores the outputs of workflow steps on disk, by cache key.
+
+    Each entry is a JSON file whose modification time is its last use.
+    Entries expire after their TTL, and the least recently used ones are
+    evicted once the entries take more than `max_size` bytes in total.
+    The total is counted from one scan of the directory and the entries
+    stored since, so that storing an entry does not scan the directory;
+    entries stored by other processes are counted when it is scanned again.
+    """
+
+    # The default limit on the total size of the entries, in bytes.
+    max_size = 256 * 1024**2
+
+    def __init__(self, directory: Path, max_size: int | None = None):
+        self.directory = directory
+        if max_size is not None:
+            self.max_size = max_size
+        # The total size of the entries, or None until the directory is scanned.
+        self._size: int | None = None
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> ValueMapping | None:
+        """
+        Return the outputs stored under a key, or None if there are none.
+        """
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires") is not None and entry["expires"] <= time.time():
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except OSError:  # pragma: no cover
+            pass
+        return entry["outputs"]
+
+    def put(self, key: str, outputs: ValueMapping, ttl: float | None = None) -> None:
+        """
+        Store outputs under a key, for `ttl` seconds if given.
+        """
+        now = time.time()
+        path = self._path(key)
+        try:
+            replaced = path.stat().st_size
+        except OSError:
+            replaced = 0
+        write_json(
+            path,
+            {
+                "created": now,
+                "expires": None if ttl is None else now + ttl,
+                "outputs": outputs,
+            },
+        )
+        # Only sizes are checked here; expired entries are removed
+        # when they are looked up or pruned.
+        if self._size is not None:
+            self._size += path.stat().st_size - replaced
+            if self._size <= self.max_size:
+                return
+        self.prune(expired=False)
+
+    def prune(
+        self, max_size: int | None = None, expired: bool = True
+    ) -> tuple[int, int]:
+        """
+        Remove the expired entries (if `expired` is true),
+        then the least recently used ones until the rest take
+        at most `max_size` bytes.
+
+        Returns the number of entries removed and the bytes freed.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        now = time.time()
+        entries = []
+        removed = freed = 0
+        for path in self.directory.glob("*/*.json"):
+            try:
+                stat = path.stat()
+                expires = None
+                if expired:
+                    with open(path) as f:
+                        expires = json.load(f).get("expires")
+            except (OSError, ValueError):
+                continue
+            if expires is not None and expires <= now:
+                path.unlink(missing_ok=True)
+                removed += 1
+                freed += stat.st_size
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= max_size:
+                break
+            path.unlink(missing_ok=True)
+            removed += 1
+            freed += size
+            total -= size
+        self._size = total
+        return removed, freed
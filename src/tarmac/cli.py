@@ -3,19 +3,39 @@ import json
 import logging
 import os
 import sys
+import time
+from pathlib import Path
 from typing import Any, TextIO
 
 import yaml
 
 from . import __version__
+from .cache import ResultCache
+from .envs import ScriptEnvironments
+from .inventory import Inventory
+from .journal import new_run_id
+from .metadata import parse_size
+from .resources import Capacity
 from .runner import Runner
+from .scheduler import StepSelection
 
 
 def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    # The commands are reserved as the first argument. A workflow with
+    # the name of a command runs with an option before it, like `tarmac -b . env`.
+    if args and args[0] in COMMANDS:
+        return COMMANDS[args[0]](args[1:])
+
     parser = argparse.ArgumentParser(
         prog="tarmac",
         description="Execute a tarmac workflow",
-        epilog="See https://github.com/merlinz01/tarmac for more information.",
+        epilog="Run `tarmac cache prune` to prune the cached step outputs,"
+        " `tarmac env list` or `tarmac env prune` to manage the cached script environments,"
+        " and `tarmac bundle WORKFLOW` to download the packages of a workflow for --offline."
+        " To run a workflow named `cache`, `env` or `bundle`, pass an option before it."
+        " See https://github.com/merlinz01/tarmac for more information.",
     )
     parser.add_argument(
         "--version",
@@ -68,8 +88,123 @@ def main(args=None):
         metavar="FILE",
         help="File to write the output to. If not specified or '-', output will be printed to stdout.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Run up to N independent workflow steps at the same time",
+    )
+    parser.add_argument(
+        "--capacity",
+        metavar="key=value",
+        type=str,
+        nargs="+",
+        help="The cpu, memory and io capacity to run parallel steps in. Defaults to the CPU count and available memory.",
+    )
+    parser.add_argument(
+        "--warm-workers",
+        action="store_true",
+        help="Run scripts in interpreters that are kept running between scripts with the same dependencies",
+    )
+    parser.add_argument(
+        "--cached-envs",
+        action="store_true",
+        help="Run scripts with the interpreter of an environment built once for their locked dependencies, instead of `uv run`",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Install the packages of scripts only from the wheelhouse created by `tarmac bundle`",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Set up the environments of the upcoming script steps of the workflow in the background, N at a time",
+    )
+    parser.add_argument(
+        "--only",
+        type=str,
+        metavar="STEPS",
+        help="Run only the steps with these comma-separated IDs or tags",
+    )
+    parser.add_argument(
+        "--from",
+        dest="start",
+        type=str,
+        metavar="STEPS",
+        help="Run only the steps with these comma-separated IDs or tags and the steps that depend on them",
+    )
+    parser.add_argument(
+        "--until",
+        type=str,
+        metavar="STEPS",
+        help="Run only the steps with these comma-separated IDs or tags and the steps they depend on",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        metavar="RUN_ID",
+        help="Continue a failed or interrupted run of the workflow from the steps that did not finish",
+    )
+    parser.add_argument(
+        "--graph",
+        action="store_true",
+        help="Print the dependencies between the workflow steps instead of running them",
+    )
+    parser.add_argument(
+        "-t",
+        "--targets",
+        type=str,
+        metavar="PATTERN",
+        help="Run the workflow against the inventory targets and groups in this comma-separated list",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        metavar="FILE",
+        help="The inventory file to read the targets from. Defaults to inventory.yml in the base path.",
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        metavar="N",
+        help="Run the workflow against N targets (or N%% of the targets) at a time",
+    )
+    parser.add_argument(
+        "--max-fail-percentage",
+        type=float,
+        metavar="P",
+        help="Stop starting batches once more than P%% of the targets failed",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        default=None,
+        help="Adapt the number of targets run at the same time to how long they take and how often they fail",
+    )
 
     args = parser.parse_args(args)
+    if args.graph and args.script:
+        parser.error("--graph cannot be used with --script")
+    if args.targets and (args.script or args.graph):
+        parser.error("--targets cannot be used with --script or --graph")
+    if args.resume and (args.script or args.graph or args.targets or args.inputs):
+        parser.error(
+            "--resume cannot be used with --script, --graph, --targets or --inputs"
+        )
+    selects = args.only or args.start or args.until
+    if selects and (args.script or args.graph or args.targets or args.resume):
+        parser.error(
+            "--only, --from and --until cannot be used with --script, --graph, --targets or --resume"
+        )
+    if not args.targets:
+        for option in ("inventory", "batch", "max_fail_percentage", "adaptive"):
+            if getattr(args, option) is not None:
+                parser.error(f"--{option.replace('_', '-')} requires --targets")
 
     logging.basicConfig(level=args.log_level)
 
@@ -79,15 +214,78 @@ def main(args=None):
             key, value = input_.split("=")
             inputs[key] = value
 
-    runner = Runner(
-        base_path=args.base_path
-        or os.environ.get("TARMAC_BASE_PATH", "")
-        or os.getcwd()
-    )
+    capacity = {}
+    if args.capacity:
+        for item in args.capacity:
+            key, _, value = item.partition("=")
+            if key not in ("cpu", "memory", "io") or not value:
+                parser.error(f"Invalid capacity: {item}")
+            capacity[key] = value
+
+    if args.prefetch < 0:
+        parser.error("The number of environments to prefetch cannot be negative")
+    try:
+        runner = Runner(
+            base_path=args.base_path
+            or os.environ.get("TARMAC_BASE_PATH", "")
+            or os.getcwd(),
+            jobs=args.jobs,
+            capacity=Capacity.detect(**capacity),
+            warm_workers=args.warm_workers,
+            cached_envs=args.cached_envs,
+            offline=args.offline,
+            prefetch=args.prefetch,
+        )
+    except ValueError as e:
+        if not args.offline:
+            raise
+        parser.error(str(e))
     if args.script:
         result = runner.execute_script(args.workflow, inputs)
+    elif args.graph:
+        result = runner.workflow_graph(args.workflow)
+    elif args.targets:
+        inventory_file = args.inventory or runner.base_path / "inventory.yml"
+        try:
+            with open(inventory_file) as f:
+                inventory = Inventory.load(f.read())
+        except FileNotFoundError:
+            parser.error(f"Inventory file {inventory_file} not found")
+        result = runner.execute_workflow_on_targets(
+            args.workflow,
+            inputs,
+            inventory.select(args.targets),
+            batch=args.batch,
+            max_fail_percentage=args.max_fail_percentage,
+            adaptive=bool(args.adaptive),
+        )
     else:
-        result = runner.execute_workflow(args.workflow, inputs)
+        run_id = args.resume or new_run_id()
+        selection = None
+        if selects:
+            selection = StepSelection(
+                only=args.only.split(",") if args.only else None,
+                start=args.start.split(",") if args.start else None,
+                until=args.until.split(",") if args.until else None,
+            )
+        try:
+            if args.resume:
+                result = runner.resume_workflow(args.workflow, run_id)
+            else:
+                result = runner.execute_workflow(
+                    args.workflow, inputs, run_id=run_id, selection=selection
+                )
+        except ValueError as e:
+            if not (args.resume or selects):
+                raise
+            parser.error(str(e))
+        if not result["succeeded"]:
+            print(
+                f"Resume this run with: tarmac {args.workflow} --resume {run_id}",
+                file=sys.stderr,
+            )
+    # The workers also exit when this process does, on any error.
+    runner.close()
 
     def print_result(file: TextIO):
         if args.output_format == "json":
@@ -207,3 +405,141 @@ def main(args=None):
         else:
             with open(args.output_file, "w") as file:
                 print_result(file)
+
+
+def cache_main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="tarmac cache",
+        description="Manage the cached outputs of workflow steps",
+    )
+    _add_base_path(parser, "The path to the workspace containing the cache")
+    commands = parser.add_subparsers(dest="command", required=True)
+    prune = commands.add_parser(
+        "prune",
+        help="Remove the expired and least recently used cached outputs",
+    )
+    _add_base_path(prune, "The path to the workspace containing the cache", True)
+    prune.add_argument(
+        "--max-size",
+        type=str,
+        metavar="SIZE",
+        help="Remove the least recently used outputs until the rest take at most SIZE, such as 100M. Defaults to 256M.",
+    )
+    args = parser.parse_args(args)
+
+    base_path = Path(
+        args.base_path or os.environ.get("TARMAC_BASE_PATH", "") or os.getcwd()
+    )
+    max_size = None
+    if args.max_size is not None:
+        try:
+            max_size = parse_size(args.max_size)
+        except ValueError as e:
+            parser.error(str(e))
+    cache = ResultCache(base_path / ".tarmac" / "cache")
+    removed, freed = cache.prune(max_size)
+    print(f"Removed {removed} cached outputs ({freed} bytes)")
+
+
+def env_main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="tarmac env",
+        description="Manage the cached environments of scripts",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_ = commands.add_parser(
+        "list",
+        help="List the cached environments, the most recently used first",
+    )
+    prune = commands.add_parser(
+        "prune",
+        help="Remove the cached environments that were not used recently",
+    )
+    prune.add_argument(
+        "--max-age",
+        type=float,
+        default=30,
+        metavar="DAYS",
+        help="Remove the environments that were not used for DAYS days. Defaults to 30.",
+    )
+    for command in (parser, list_, prune):
+        _add_base_path(
+            command,
+            "The path to the workspace containing the environments",
+            command is not parser,
+        )
+    args = parser.parse_args(args)
+
+    base_path = Path(
+        args.base_path or os.environ.get("TARMAC_BASE_PATH", "") or os.getcwd()
+    )
+    environments = ScriptEnvironments(base_path / ".tarmac" / "envs")
+    if args.command == "list":
+        for env in environments.list():
+            last_used = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(env["last_used"])
+            )
+            line = f"{env['hash'][:16]}  last used {last_used}  {env['size']} bytes"
+            print("  ".join([line, *env["packages"]]))
+    else:
+        removed, freed = environments.prune(args.max_age * 86400)
+        print(f"Removed {removed} environments ({freed} bytes)")
+
+
+def bundle_main(args: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="tarmac bundle",
+        description="Download the packages that the scripts of a workflow use"
+        " into the wheelhouse in the base path, for running it with --offline",
+    )
+    parser.add_argument(
+        "workflow",
+        type=str,
+        help="The workflow whose scripts, and the scripts of the workflows it runs, to bundle",
+    )
+    parser.add_argument(
+        "-b",
+        "--base-path",
+        type=str,
+        help="The path to the workspace containing the workflows and scripts",
+    )
+    args = parser.parse_args(args)
+
+    runner = Runner(
+        base_path=args.base_path
+        or os.environ.get("TARMAC_BASE_PATH", "")
+        or os.getcwd()
+    )
+    try:
+        result = runner.bundle_workflow(args.workflow)
+    except ValueError as e:
+        parser.error(str(e))
+    print(
+        f"Bundled {len(result['scripts'])} scripts"
+        f" ({len(result['wheels'])} new wheels) into {runner.wheelhouse.directory}"
+    )
+
+
+def _add_base_path(
+    parser: argparse.ArgumentParser, help: str, subcommand: bool = False
+) -> None:
+    """
+    Add the base path option to a command, or to one of its subcommands,
+    so that it can come before or after the subcommand.
+    """
+    parser.add_argument(
+        "-b",
+        "--base-path",
+        type=str,
+        # A subcommand must not reset the value given before it.
+        default=argparse.SUPPRESS if subcommand else None,
+        help=help,
+    )
+
+
+# The commands that are not workflow runs, by their first argument.
+COMMANDS = {
+    "cache": cache_main,
+    "env": env_main,
+    "bundle": bundle_main,
+}
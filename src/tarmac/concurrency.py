@@ -0,0 +1,106 @@
+import collections
+import time
+from typing import Callable
+
+
+class AdaptiveLimiter:
+    """
+    Chooses how many tasks to run at the same time from how the finished
+    tasks went, in the style of TCP congestion control (AIMD).
+
+    The limit grows by one for every `limit` tasks that succeed in time,
+    and is halved when a task fails or takes more than `latency_tolerance`
+    times the fastest successful task, at most once per `limit` tasks.
+    Once at least `error_threshold` of the last `window` tasks failed,
+    the circuit breaker trips and the limit drops to zero,
+    so that no new tasks are started.
+    """
+
+    # The number of finished tasks needed before the circuit breaker can trip.
+    min_samples = 5
+    # How many seconds a task must take beyond the fastest one to count as slow,
+    # so that the jitter of very short tasks does not lower the limit.
+    min_slowdown = 0.05
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial: int | None = None,
+        latency_tolerance: float = 2.0,
+        error_threshold: float = 0.5,
+        window: int = 20,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_limit < 1:
+            raise ValueError("The maximum concurrency must be at least 1")
+        self.max_limit = max_limit
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.error_threshold = error_threshold
+        self.tripped = False
+        self.timeline: list[tuple[float, int]] = []
+        self._clock = clock
+        self._started = clock()
+        self._limit = max(self.min_limit, min(initial or self.min_limit, max_limit))
+        self._baseline: float | None = None
+        self._since_decrease = 0
+        self._since_increase = 0
+        self._outcomes: collections.deque[bool] = collections.deque(maxlen=window)
+        self._note()
+
+    @property
+    def limit(self) -> int:
+        """
+        The number of tasks that may run at the same time.
+        """
+        if self.tripped:
+            return 0
+        return self._limit
+
+    def record(self, latency: float, succeeded: bool) -> None:
+        """
+        Update the limit with a task that finished.
+        """
+        self._outcomes.append(succeeded)
+        self._since_decrease += 1
+        slow = False
+        if succeeded:
+            if self._baseline is None or latency < self._baseline:
+                self._baseline = latency
+            slow = (
+                latency > self._baseline * self.latency_tolerance
+                and latency - self._baseline > self.min_slowdown
+            )
+        if not succeeded or slow:
+            self._since_increase = 0
+            if self._since_decrease >= self._limit:
+                self._limit = max(self.min_limit, self._limit // 2)
+                self._since_decrease = 0
+        else:
+            self._since_increase += 1
+            if self._since_increase >= self._limit:
+                self._limit = min(self.max_limit, self._limit + 1)
+                self._since_increase = 0
+        failures = self._outcomes.count(False)
+        samples = len(self._outcomes)
+        if (
+            samples >= min(self.min_samples, self._outcomes.maxlen or samples)
+            and failures >= self.error_threshold * samples
+        ):
+            self.tripped = True
+        self._note()
+
+    def _note(self) -> None:
+        limit = self.limit
+        if not self.timeline or self.timeline[-1][1] != limit:
+            self.timeline.append((round(self._clock() - self._started, 3), limit))
+
+    def report(self) -> dict:
+        """
+        Describe the chosen limits over time, for the outputs of a run.
+        """
+        return {
+            "timeline": [list(entry) for entry in self.timeline],
+            "tripped": self.tripped,
+        }
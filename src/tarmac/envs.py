@@ -0,0 +1,414 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import IO, Iterator
+
+from uv import find_uv_bin
+
+from .metadata import ScriptMetadata, ValueMapping, metadata_block
+from .state import write_json
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+# The file that marks a complete environment, whose modification time
+# is the last time a script ran with the environment.
+MARKER = "environment.json"
+
+# The metadata to lock for scripts without `# /// script` metadata.
+_EMPTY_SCRIPT_METADATA = "# /// script\n# dependencies = []\n# ///\n"
+
+
+class ScriptEnvironments:
+    """
+    Builds the virtual environment of each script's dependencies once,
+    so that scripts run with its interpreter instead of `uv run`.
+
+    The `# /// script` metadata of a script is locked with `uv lock`
+    once for each version of its `# /// script` and `# /// tarmac` metadata,
+    under `locks`. The environment is built from the locked requirements,
+    in a directory named by their hash, so that scripts whose dependencies
+    lock to the same packages share an environment.
+    Scripts with `additional_uv_args` still run with `uv run`,
+    since the arguments cannot be applied to a prebuilt environment.
+    """
+
+    # The uv options shared by all commands.
+    uv_options = ["--color", "never", "--no-progress", "--no-config", "--native-tls"]
+
+    def __init__(
+        self,
+        directory: Path,
+        uv_bin: str | None = None,
+        requirements: list[str] | None = None,
+        index_args: list[str] | None = None,
+    ):
+        self.directory = directory
+        self.uv_bin = uv_bin
+        # The requirements installed next to the locked ones.
+        self.requirements = list(requirements or [])
+        # The options that choose where packages come from, such as a wheelhouse.
+        self.index_args = list(index_args or [])
+        # The interpreter of each locked version of the metadata.
+        self._pythons: dict[str, Path] = {}
+        # A lock for each version of the metadata, so that different scripts
+        # are prepared at the same time while the same one is prepared once.
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _uv(self, *args: str, cwd: Path | None = None) -> None:
+        subprocess.run(
+            [self.uv_bin or find_uv_bin(), *args],
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _metadata_key(self, source: str) -> str:
+        material = {
+            "script": metadata_block(source, "script"),
+            "tarmac": metadata_block(source, "tarmac"),
+            "requirements": self.requirements,
+            "index": self.index_args,
+        }
+        data = json.dumps(material, sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def requirements_file(self, script: Path) -> Path:
+        """
+        Lock the dependencies of a script if needed,
+        and return the file of the locked requirements.
+        """
+        with open(script) as f:
+            source = f.read()
+        key = self._metadata_key(source)
+        with self._key_lock(key):
+            try:
+                self._locked_environment(key, source)
+            except subprocess.CalledProcessError as e:
+                raise ValueError(
+                    f"Failed to lock the dependencies of {script.name}: {e.stderr}"
+                ) from e
+        return self.directory / "locks" / key / "requirements.txt"
+
+    def python(self, script: Path, metadata: ScriptMetadata) -> Path | None:
+        """
+        Return the interpreter to run a script with, building its environment
+        if needed, or None if the script should run with `uv run`.
+        """
+        if metadata.additional_uv_args:
+            return None
+        with open(script) as f:
+            source = f.read()
+        key = self._metadata_key(source)
+        python = self._pythons.get(key)
+        if python is not None and _touch(python.parent.parent / MARKER):
+            return python
+        with self._key_lock(key):
+            try:
+                python = self._prepare(key, source)
+            except (OSError, subprocess.CalledProcessError) as e:
+                # `uv run` reports the error in the outputs of the step.
+                stderr = getattr(e, "stderr", None) or e
+                logger.warning("Failed to build the script environment: %s", stderr)
+                return None
+            self._pythons[key] = python
+        return python
+
+    def _locked_environment(self, key: str, source: str) -> str:
+        # Returns the hash of the environment of the locked requirements.
+        locked = self.directory / "locks" / key
+        with _file_lock(self.directory / "locks" / f"{key}.lock"):
+            try:
+                return (locked / "environment").read_text()
+            except FileNotFoundError:
+                return self._lock_requirements(locked, source)
+
+    def _prepare(self, key: str, source: str) -> Path:
+        locked = self.directory / "locks" / key
+        env_hash = self._locked_environment(key, source)
+        env = self.directory / env_hash
+        with _file_lock(self.directory / f"{env_hash}.lock"):
+            if not _touch(env / MARKER):
+                self._build(env, locked)
+        return _interpreter(env)
+
+    def _lock_requirements(self, locked: Path, source: str) -> str:
+        """
+        Lock the dependencies of a script and return the hash
+        of the environment they are installed in.
+        """
+        locked.mkdir(parents=True, exist_ok=True)
+        block = metadata_block(source, "script") or _EMPTY_SCRIPT_METADATA
+        (locked / "script.py").write_text(block)
+        self._uv(
+            "lock",
+            *self.uv_options,
+            *self.index_args,
+            "--script",
+            "script.py",
+            cwd=locked,
+        )
+        self._uv(
+            "export",
+            *self.uv_options,
+            *self.index_args,
+            "--quiet",
+            "--no-header",
+            "--script",
+            "script.py",
+            "--output-file",
+            "requirements.txt",
+            cwd=locked,
+        )
+        material = {
+            "requirements": (locked / "requirements.txt").read_text(),
+            "extra": self.requirements,
+            "python": _python_request(),
+        }
+        data = json.dumps(material, sort_keys=True)
+        env_hash = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        (locked / "environment").write_text(env_hash)
+        return env_hash
+
+    def _build(self, env: Path, locked: Path) -> None:
+        if env.exists():
+            # A build that did not finish.
+            shutil.rmtree(env)
+        logger.info("Building the script environment %s", env.name)
+        self._uv(
+            "venv", *self.uv_options, "--quiet", "--python", _python_request(), str(env)
+        )
+        self._uv(
+            "pip",
+            "install",
+            *self.uv_options,
+            *self.index_args,
+            "--quiet",
+            "--python",
+            str(_interpreter(env)),
+            "--requirement",
+            str(locked / "requirements.txt"),
+            *self.requirements,
+        )
+        requirements = (locked / "requirements.txt").read_text()
+        write_json(
+            env / MARKER,
+            {
+                "created": time.time(),
+                "python": _python_request(),
+                "requirements": requirements,
+                "extra": self.requirements,
+            },
+        )
+
+    def list(self) -> list[ValueMapping]:
+        """
+        Describe the complete environments, the most recently used first.
+        """
+        environments = []
+        for marker in self.directory.glob(f"*/{MARKER}"):
+            try:
+                stat = marker.stat()
+                with open(marker) as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            packages = [
+                line.split(" ")[0]
+                for line in info.get("requirements", "").splitlines()
+                if line and not line.startswith((" ", "#"))
+            ]
+            environments.append(
+                {
+                    "hash": marker.parent.name,
+                    "created": info.get("created"),
+                    "last_used": stat.st_mtime,
+                    "size": _size(marker.parent),
+                    "packages": packages + info.get("extra", []),
+                }
+            )
+        environments.sort(key=lambda env: env["last_used"], reverse=True)
+        return environments
+
+    def prune(self, max_age: float) -> tuple[int, int]:
+        """
+        Remove the environments that were not used for `max_age` seconds,
+        the environments that were never completed, and the locks
+        of the removed environments.
+
+        Returns the number of environments removed and the bytes freed.
+        """
+        now = time.time()
+        removed = freed = 0
+        if not self.directory.is_dir():
+            return removed, freed
+        for env in self.directory.iterdir():
+            if not env.is_dir() or env.name == "locks":
+                continue
+            with _file_lock(
+                self.directory / f"{env.name}.lock", blocking=False
+            ) as held:
+                if not held:
+                    # A build of the environment is in progress.
+                    continue
+                try:
+                    last_used = (env / MARKER).stat().st_mtime
+                except FileNotFoundError:
+                    last_used = None
+                if last_used is not None and now - last_used <= max_age:
+                    continue
+                size = _size(env)
+                shutil.rmtree(env, ignore_errors=True)
+            (self.directory / f"{env.name}.lock").unlink(missing_ok=True)
+            removed += 1
+            freed += size
+        for locked in (self.directory / "locks").glob("*/environment"):
+            env_hash = locked.read_text()
+            if not (self.directory / env_hash).exists():
+                shutil.rmtree(locked.parent, ignore_errors=True)
+                (locked.parent.parent / f"{locked.parent.name}.lock").unlink(
+                    missing_ok=True
+                )
+        return removed, freed
+
+
+class Wheelhouse:
+    """
+    A directory of wheels that scripts install their packages from
+    when they run offline, for air-gapped hosts.
+
+    The wheels are for the platform and interpreter tarmac runs with.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def index_args(self) -> list[str]:
+        """
+        Return the uv options that install packages from the wheelhouse only.
+        """
+        return [
+            "--offline",
+            "--no-index",
+            "--find-links",
+            str(self.directory.absolute()),
+        ]
+
+    def wheels(self) -> list[str]:
+        return sorted(path.name for path in self.directory.glob("*.whl"))
+
+    def download(
+        self,
+        requirements: list[Path],
+        packages: list[str] | None = None,
+        uv_bin: str | None = None,
+    ) -> list[str]:
+        """
+        Download the wheels of the packages in requirements files,
+        and of other packages with their dependencies.
+
+        Returns the names of the wheels that were not in the wheelhouse yet.
+        """
+        before = set(self.wheels())
+        self.directory.mkdir(parents=True, exist_ok=True)
+        pip = [
+            uv_bin or find_uv_bin(),
+            "tool",
+            "run",
+            "--no-config",
+            "--python",
+            _python_request(),
+            "pip",
+            "download",
+            "--quiet",
+            "--disable-pip-version-check",
+            "--only-binary",
+            ":all:",
+            "--dest",
+            str(self.directory),
+        ]
+        commands = [[*pip, "--requirement", str(path)] for path in requirements]
+        if packages:
+            commands.append([*pip, *packages])
+        for command in commands:
+            try:
+                subprocess.run(
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+            except subprocess.CalledProcessError as e:
+                raise ValueError(f"Failed to download the wheels: {e.stderr}") from e
+        return sorted(set(self.wheels()) - before)
+
+
+def _python_request() -> str:
+    # Environments use the interpreter tarmac runs with,
+    # which is a version that tarmac supports.
+    return sys.executable
+
+
+def _interpreter(env: Path) -> Path:
+    if os.name == "nt":  # pragma: no cover
+        return env / "Scripts" / "python.exe"
+    return env / "bin" / "python"
+
+
+def _touch(path: Path) -> bool:
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _size(directory: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            with contextlib.suppress(OSError):
+                total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path, blocking: bool = True) -> Iterator[bool]:
+    """
+    Hold an exclusive lock on a file, across processes where `flock` exists.
+
+    Yields whether the lock is held, which is only false when not blocking.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    f: IO
+    with open(path, "a") as f:
+        if fcntl is None:  # pragma: no cover
+            yield True
+            return
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
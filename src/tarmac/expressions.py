@@ -0,0 +1,359 @@
+import ast
+import builtins
+import functools
+import operator
+from typing import Any, Callable, Mapping
+
+Evaluator = Callable[[Mapping[str, Any]], Any]
+
+# The built-in functions that expressions can call.
+SAFE_BUILTINS: dict[str, Any] = {
+    name: getattr(builtins, name)
+    for name in (
+        "abs",
+        "all",
+        "any",
+        "bool",
+        "dict",
+        "enumerate",
+        "float",
+        "int",
+        "len",
+        "list",
+        "max",
+        "min",
+        "range",
+        "reversed",
+        "round",
+        "set",
+        "sorted",
+        "str",
+        "sum",
+        "tuple",
+        "zip",
+    )
+}
+
+# The condition helpers, which are only in the namespace of conditions.
+HELPERS = frozenset(
+    ("changed", "exists", "isdir", "isfile", "run", "skipped", "time_left")
+)
+
+# The methods that expressions can call, on strings and mappings.
+SAFE_METHODS = frozenset(
+    (
+        "count",
+        "endswith",
+        "get",
+        "items",
+        "join",
+        "keys",
+        "lower",
+        "lstrip",
+        "replace",
+        "rsplit",
+        "rstrip",
+        "split",
+        "startswith",
+        "strip",
+        "upper",
+        "values",
+    )
+)
+
+# The condition helpers that take the ID of a step as their first argument.
+STEP_HELPERS = ("changed", "skipped")
+
+_BINARY_OPERATORS: dict[type[ast.operator], Callable[[Any, Any], Any]] = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+
+_UNARY_OPERATORS: dict[type[ast.unaryop], Callable[[Any], Any]] = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+_COMPARISONS: dict[type[ast.cmpop], Callable[[Any, Any], Any]] = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+
+class Expression:
+    """
+    An expression of a substitution or condition, compiled to Python closures.
+
+    Only a subset of Python is supported: literals, names, attribute and
+    item access, arithmetic, comparisons, boolean operators, and calls
+    to the condition helpers, safe built-in functions and string and
+    mapping methods. Anything else is rejected when the expression
+    is compiled, so that it cannot reach the rest of the interpreter.
+
+    `references` holds the IDs of the steps whose outputs the expression
+    reads, or None if it reads the step outputs in an undetermined way.
+    """
+
+    __slots__ = ("source", "references", "_evaluate")
+
+    def __init__(self, source: str):
+        self.source = source
+        tree = ast.parse(f"({source})", mode="eval")
+        compiler = _Compiler(source)
+        self._evaluate = compiler.compile(tree.body)
+        self.references = compiler.references
+
+    def evaluate(self, namespace: Mapping[str, Any]) -> Any:
+        """
+        Evaluate the expression with the names in a namespace.
+        """
+        return self._evaluate(namespace)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_expression(source: str) -> Expression:
+    """
+    Compile an expression, reusing the result for the same source.
+    """
+    return Expression(source)
+
+
+class _Compiler:
+    def __init__(self, source: str):
+        self.source = source
+        self.references: set[str] | None = set()
+
+    def _reject(self, what: str) -> ValueError:
+        return ValueError(f"{what} is not allowed in expressions: {self.source}")
+
+    def _refer(self, step: str | None) -> None:
+        if step is None:
+            self.references = None
+        elif self.references is not None:
+            self.references.add(step)
+
+    def compile(self, node: ast.AST) -> Evaluator:
+        method = getattr(self, "_compile_" + type(node).__name__, None)
+        if method is None:
+            raise self._reject(type(node).__name__)
+        return method(node)
+
+    def _compile_Constant(self, node: ast.Constant) -> Evaluator:
+        value = node.value
+        return lambda namespace: value
+
+    def _compile_Name(self, node: ast.Name, steps_access: bool = False) -> Evaluator:
+        name = node.id
+        if name.startswith("_"):
+            raise self._reject(f"Name {name}")
+        if name == "steps" and not steps_access:
+            # The outputs are read in a way that cannot be followed.
+            self._refer(None)
+
+        def evaluate(namespace: Mapping[str, Any]) -> Any:
+            try:
+                return namespace[name]
+            except KeyError:
+                pass
+            try:
+                return SAFE_BUILTINS[name]
+            except KeyError:
+                raise NameError(f"name {name!r} is not defined") from None
+
+        return evaluate
+
+    def _compile_steps_base(self, node: ast.AST) -> Evaluator | None:
+        # The `steps` name, when its access to a single step is followed.
+        if isinstance(node, ast.Name) and node.id == "steps":
+            return self._compile_Name(node, steps_access=True)
+        return None
+
+    def _compile_Attribute(self, node: ast.Attribute) -> Evaluator:
+        attr = node.attr
+        if attr.startswith("_"):
+            raise self._reject(f"Attribute {attr}")
+        value = self._compile_steps_base(node.value)
+        if value is not None:
+            self._refer(attr)
+        else:
+            value = self.compile(node.value)
+        return lambda namespace: getattr(value(namespace), attr)
+
+    def _compile_Subscript(self, node: ast.Subscript) -> Evaluator:
+        value = self._compile_steps_base(node.value)
+        if value is not None:
+            self._refer(_constant_string(node.slice))
+        else:
+            value = self.compile(node.value)
+        index = self.compile(node.slice)
+        return lambda namespace: value(namespace)[index(namespace)]
+
+    def _compile_Slice(self, node: ast.Slice) -> Evaluator:
+        parts = [
+            None if part is None else self.compile(part)
+            for part in (node.lower, node.upper, node.step)
+        ]
+        return lambda namespace: slice(
+            *(None if part is None else part(namespace) for part in parts)
+        )
+
+    def _compile_Call(self, node: ast.Call) -> Evaluator:
+        func = node.func
+        if isinstance(func, ast.Name):
+            if func.id not in HELPERS and func.id not in SAFE_BUILTINS:
+                raise self._reject(f"Calling {func.id}")
+            if func.id in STEP_HELPERS:
+                self._refer(_constant_string(node.args[0]) if node.args else None)
+            function = self._compile_Name(func)
+        elif isinstance(func, ast.Attribute):
+            if func.attr not in SAFE_METHODS:
+                raise self._reject(f"Calling {func.attr}")
+            steps = self._compile_steps_base(func.value)
+            if steps is not None and func.attr == "get":
+                # steps.get("foo")
+                self._refer(_constant_string(node.args[0]) if node.args else None)
+
+                def function(namespace: Mapping[str, Any]) -> Any:
+                    return steps(namespace).get
+
+            else:
+                if steps is not None:
+                    self._refer(None)
+                function = self.compile(func)
+        else:
+            raise self._reject("Calling an expression")
+        args = []
+        for arg in node.args:
+            if isinstance(arg, ast.Starred):
+                raise self._reject("Unpacking")
+            args.append(self.compile(arg))
+        kwargs = []
+        for keyword in node.keywords:
+            if keyword.arg is None:
+                raise self._reject("Unpacking")
+            kwargs.append((keyword.arg, self.compile(keyword.value)))
+        if not kwargs:
+            return lambda namespace: function(namespace)(
+                *[arg(namespace) for arg in args]
+            )
+        return lambda namespace: function(namespace)(
+            *[arg(namespace) for arg in args],
+            **{name: value(namespace) for name, value in kwargs},
+        )
+
+    def _compile_BoolOp(self, node: ast.BoolOp) -> Evaluator:
+        values = [self.compile(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+
+            def evaluate_and(namespace: Mapping[str, Any]) -> Any:
+                result = None
+                for value in values:
+                    result = value(namespace)
+                    if not result:
+                        return result
+                return result
+
+            return evaluate_and
+
+        def evaluate_or(namespace: Mapping[str, Any]) -> Any:
+            result = None
+            for value in values:
+                result = value(namespace)
+                if result:
+                    return result
+            return result
+
+        return evaluate_or
+
+    def _compile_UnaryOp(self, node: ast.UnaryOp) -> Evaluator:
+        op = _UNARY_OPERATORS.get(type(node.op))
+        if op is None:
+            raise self._reject(type(node.op).__name__)
+        operand = self.compile(node.operand)
+        return lambda namespace: op(operand(namespace))
+
+    def _compile_BinOp(self, node: ast.BinOp) -> Evaluator:
+        op = _BINARY_OPERATORS.get(type(node.op))
+        if op is None:
+            raise self._reject(type(node.op).__name__)
+        left, right = self.compile(node.left), self.compile(node.right)
+        return lambda namespace: op(left(namespace), right(namespace))
+
+    def _compile_Compare(self, node: ast.Compare) -> Evaluator:
+        left = self.compile(node.left)
+        comparisons = []
+        for op, comparator in zip(node.ops, node.comparators):
+            comparisons.append((_COMPARISONS[type(op)], self.compile(comparator)))
+        if len(comparisons) == 1:
+            compare, right = comparisons[0]
+            return lambda namespace: compare(left(namespace), right(namespace))
+
+        def evaluate(namespace: Mapping[str, Any]) -> Any:
+            # Chained comparisons evaluate each operand at most once.
+            a = left(namespace)
+            for compare, right in comparisons:
+                b = right(namespace)
+                if not compare(a, b):
+                    return False
+                a = b
+            return True
+
+        return evaluate
+
+    def _compile_IfExp(self, node: ast.IfExp) -> Evaluator:
+        test, body, orelse = (
+            self.compile(node.test),
+            self.compile(node.body),
+            self.compile(node.orelse),
+        )
+        return lambda namespace: (
+            body(namespace) if test(namespace) else orelse(namespace)
+        )
+
+    def _compile_elements(self, elements: list[ast.expr]) -> list[Evaluator]:
+        if any(isinstance(element, ast.Starred) for element in elements):
+            raise self._reject("Unpacking")
+        return [self.compile(element) for element in elements]
+
+    def _compile_List(self, node: ast.List) -> Evaluator:
+        elements = self._compile_elements(node.elts)
+        return lambda namespace: [element(namespace) for element in elements]
+
+    def _compile_Tuple(self, node: ast.Tuple) -> Evaluator:
+        elements = self._compile_elements(node.elts)
+        return lambda namespace: tuple(element(namespace) for element in elements)
+
+    def _compile_Set(self, node: ast.Set) -> Evaluator:
+        elements = self._compile_elements(node.elts)
+        return lambda namespace: {element(namespace) for element in elements}
+
+    def _compile_Dict(self, node: ast.Dict) -> Evaluator:
+        if any(key is None for key in node.keys):
+            raise self._reject("Unpacking")
+        items = [
+            (self.compile(key), self.compile(value))
+            for key, value in zip(node.keys, node.values)
+            if key is not None
+        ]
+        return lambda namespace: {
+            key(namespace): value(namespace) for key, value in items
+        }
+
+
+def _constant_string(node: ast.AST) -> str | None:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
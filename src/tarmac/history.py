@@ -0,0 +1,47 @@
+import json
+import logging
+from pathlib import Path
+
+from .state import write_json
+
+logger = logging.getLogger(__name__)
+
+
+class StepHistory:
+    """
+    The durations of the steps of a workflow, recorded across runs.
+
+    Each duration is a moving average,
+    so that a single unusually slow or fast run does not throw off the estimate.
+    """
+
+    # The weight of the latest run in the moving average.
+    smoothing = 0.5
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.durations: dict[str, float] = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self.durations = {
+                str(k): float(v) for k, v in data.get("durations", {}).items()
+            }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError):
+            logger.warning("Ignoring corrupted step history %s", path)
+
+    def record(self, durations: dict[str, float]) -> None:
+        """
+        Add the step durations of a run to the history and save it.
+        """
+        for step_id, duration in durations.items():
+            previous = self.durations.get(step_id)
+            if previous is not None:
+                duration = previous + self.smoothing * (duration - previous)
+            self.durations[step_id] = duration
+        try:
+            write_json(self.path, {"durations": self.durations})
+        except OSError as e:
+            logger.warning("Failed to save step history %s: %s", self.path, e)
@@ -0,0 +1,144 @@
+from typing import Self
+
+import yaml
+from pydantic import BaseModel, Field
+
+from .metadata import ValueMapping
+
+
+class Target(BaseModel):
+    """
+    Describes a target to execute workflows against.
+    """
+
+    name: str = ""
+    """
+    The name of the target.
+    """
+
+    host: str | None = None
+    """
+    The host to run the workflow steps on over SSH.
+    If not provided, the workflow steps run on this machine.
+    """
+
+    user: str | None = None
+    """
+    The user to log in to the host as.
+    """
+
+    port: int | None = None
+    """
+    The SSH port of the host.
+    """
+
+    ssh_options: list[str] = Field(default_factory=list)
+    """
+    Additional arguments to pass to the ssh command.
+    """
+
+    path: str | None = None
+    """
+    The directory to run the workflow steps in.
+    If not provided, a new temporary directory is used for each run on this
+    machine, and the home directory of the user on a host.
+    """
+
+    inputs: ValueMapping = Field(default_factory=dict)
+    """
+    The workflow inputs to use for the target.
+    They override the inputs of the groups of the target.
+    """
+
+    model_config = {
+        "extra": "forbid",
+    }
+
+
+class Group(BaseModel):
+    """
+    Describes a group of targets.
+    """
+
+    targets: list[str] = Field(default_factory=list)
+    """
+    The names of the targets in the group.
+    """
+
+    inputs: ValueMapping = Field(default_factory=dict)
+    """
+    The workflow inputs to use for all targets in the group.
+    """
+
+    model_config = {
+        "extra": "forbid",
+    }
+
+
+class Inventory(BaseModel):
+    """
+    The targets that workflows can be executed against.
+    """
+
+    targets: dict[str, Target] = Field(default_factory=dict)
+    """
+    A dictionary of targets.
+    The keys are the names of the targets.
+    """
+
+    groups: dict[str, Group] = Field(default_factory=dict)
+    """
+    A dictionary of groups of targets.
+    The keys are the names of the groups.
+    The group `all` contains every target unless it is defined explicitly.
+    """
+
+    model_config = {
+        "extra": "forbid",
+    }
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        for name, target in self.targets.items():
+            target.name = name
+        for name, group in self.groups.items():
+            for target in group.targets:
+                if target not in self.targets:
+                    raise ValueError(f"Group {name} contains unknown target {target}")
+
+    @classmethod
+    def load(cls, file: str) -> Self:
+        inventory = yaml.safe_load(file)
+        if inventory is None:
+            inventory = {}
+        return cls(**inventory)
+
+    def select(self, selector: str) -> list[Target]:
+        """
+        Return the targets matching a comma-separated list
+        of group and target names, in inventory order.
+
+        The inputs of each returned target include the inputs of its groups.
+        """
+        names: set[str] = set()
+        for pattern in selector.split(","):
+            pattern = pattern.strip()
+            if pattern in self.groups:
+                names.update(self.groups[pattern].targets)
+            elif pattern == "all":
+                names.update(self.targets)
+            elif pattern in self.targets:
+                names.add(pattern)
+            else:
+                raise ValueError(f"Unknown target or group: {pattern}")
+        selected = []
+        for name, target in self.targets.items():
+            if name not in names:
+                continue
+            inputs: ValueMapping = {}
+            for group in self.groups.values():
+                if name in group.targets:
+                    inputs.update(group.inputs)
+            inputs.update(target.inputs)
+            selected.append(target.model_copy(update={"inputs": inputs}))
+        return selected
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import IO, Any
+
+from .metadata import ValueMapping
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore[assignment]
+
+RUN_ID_REGEX = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def new_run_id() -> str:
+    """
+    Return a new, unique and sortable run ID.
+    """
+    return time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+
+
+def child_run_id(run_id: str, step_id: str) -> str:
+    """
+    Return the run ID of a workflow run by a step of another run.
+
+    It is the same every time the step runs in the same run,
+    so that resuming the run also resumes the nested run.
+    """
+    return run_id + "." + re.sub(r"[^A-Za-z0-9_-]", "_", step_id)
+
+
+def _read(path: Path) -> tuple[list[dict], int]:
+    """
+    Read the records of a journal file.
+
+    Returns the records and the length of the file up to the last
+    complete record; anything after it was cut off by a crash.
+    """
+    records = []
+    length = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            length += len(line)
+    return records, length
+
+
+def read_journal(path: Path) -> list[dict]:
+    """
+    Return the complete records of a journal file.
+    """
+    return _read(path)[0]
+
+
+def read_journal_header(path: Path) -> dict:
+    """
+    Return the record describing the run of a journal file.
+    """
+    with open(path, "rb") as f:
+        line = f.readline()
+    try:
+        header = json.loads(line)
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("event") != "run":
+        raise ValueError(f"Invalid run journal: {path}")
+    return header
+
+
+class RunJournal:
+    """
+    An append-only record of a workflow run, for resuming it after a failure.
+
+    The first record describes the run, and the next ones the steps
+    that started and finished, by their index in the workflow,
+    since step IDs may be empty or repeated. Every record is flushed to disk
+    before the journal returns, so that it survives a crash.
+    """
+
+    def __init__(self, path: Path, file: IO[bytes], records: list[dict]):
+        self.path = path
+        self._file = file
+        self.records = records
+
+    @classmethod
+    def create(cls, path: Path, header: ValueMapping) -> "RunJournal":
+        """
+        Start a new journal, replacing any existing one.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        journal = cls(path, open(path, "wb"), [])
+        _sync_directory(path.parent)
+        journal.record("run", **header)
+        return journal
+
+    @classmethod
+    def resume(cls, path: Path) -> "RunJournal":
+        """
+        Open an existing journal to append to it.
+        """
+        records, length = _read(path)
+        if not records or records[0].get("event") != "run":
+            raise ValueError(f"Invalid run journal: {path}")
+        file = open(path, "r+b")
+        file.truncate(length)
+        file.seek(length)
+        return cls(path, file, records)
+
+    @property
+    def header(self) -> dict:
+        return self.records[0]
+
+    def finished_steps(self) -> dict[int, ValueMapping]:
+        """
+        Return the outputs of the steps that finished, by step index.
+        """
+        return {
+            record["index"]: record["outputs"]
+            for record in self.records
+            if record.get("event") == "finish"
+        }
+
+    def record(self, event: str, **fields: Any) -> None:
+        entry = {"event": event, "time": time.time(), **fields}
+        line = json.dumps(entry, default=repr) + "\n"
+        self._file.write(line.encode("utf-8"))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records.append(json.loads(line))
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class RunIndex:
+    """
+    The IDs of the latest runs of each workflow, oldest first,
+    so that earlier runs are found without reading every journal.
+
+    Only the journals of the last `keep` runs of each workflow are kept;
+    the journals of older runs are removed when a run is added.
+    """
+
+    # The default number of runs of each workflow whose journals are kept.
+    keep = 50
+
+    def __init__(self, directory: Path, keep: int | None = None):
+        self.directory = directory
+        if keep is not None:
+            self.keep = keep
+
+    def _path(self, workflow: str) -> Path:
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", workflow)
+        if name != workflow:
+            name += "-" + hashlib.sha1(workflow.encode()).hexdigest()[:8]
+        return self.directory / "index" / f"{name}.json"
+
+    def runs(self, workflow: str) -> list[str]:
+        """
+        Return the IDs of the kept runs of a workflow, oldest first.
+        """
+        try:
+            with open(self._path(workflow)) as f:
+                runs = json.load(f)
+        except (OSError, ValueError):
+            return []
+        return runs if isinstance(runs, list) else []
+
+    def add(self, workflow: str, run_id: str) -> None:
+        """
+        Make a run the latest run of a workflow, and remove the journals
+        of the runs that are no longer kept.
+        """
+        path = self._path(workflow)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                runs = json.loads(f.read() or "[]")
+            except ValueError:
+                runs = []
+            runs = [run for run in runs if run != run_id] + [run_id]
+            dropped, runs = runs[: -self.keep], runs[-self.keep :]
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(runs))
+        for run in dropped:
+            (self.directory / f"{run}.jsonl").unlink(missing_ok=True)
+
+
+def _sync_directory(path: Path) -> None:
+    # Make sure the new journal file itself survives a crash.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # pragma: no cover
+        return
+    try:
+        os.fsync(fd)
+    except OSError:  # pragma: no cover
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,151 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import IO, Iterator
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore[assignment]
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # pragma: no cover
+        pass
+    return True
+
+
+class GroupSemaphore:
+    """
+    A semaphore shared by every thread and process that uses the same
+    directory and group, built on `flock` so that it is released
+    when its holder exits, however it exits.
+
+    The group has `limit` slot files; holding the lock on one of them
+    is holding the semaphore.
+    Waiters queue up in arrival order in a queue file,
+    and only the first one in the queue may take a free slot,
+    so that a waiter cannot be overtaken by ones that came later.
+    Waiters of processes that no longer exist are dropped from the queue.
+    """
+
+    # How often a waiter checks for a free slot, in seconds.
+    poll_interval = 0.05
+
+    def __init__(self, directory: Path, group: str, limit: int = 1):
+        if fcntl is None:  # pragma: no cover
+            raise ValueError("Concurrency groups are not supported on this platform")
+        if limit < 1:
+            raise ValueError("The concurrency limit must be at least 1")
+        self.directory = directory
+        self.group = group
+        self.limit = limit
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", group)
+        if name != group:
+            name += "-" + hashlib.sha1(group.encode()).hexdigest()[:8]
+        self._name = name
+        self._ticket: str | None = None
+        self._slot: IO | None = None
+
+    @contextlib.contextmanager
+    def _queue(self) -> Iterator[list[list]]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / f"{self._name}.queue", "a+") as f:
+            assert fcntl is not None
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                entries = json.loads(f.read() or "[]")
+            except ValueError:
+                entries = []
+            entries = [entry for entry in entries if _alive(entry[1])]
+            yield entries
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(entries))
+
+    def join(self) -> None:
+        """
+        Join the end of the queue of waiters.
+        """
+        self._ticket = uuid.uuid4().hex
+        with self._queue() as queue:
+            queue.append([self._ticket, os.getpid()])
+
+    def leave(self) -> None:
+        """
+        Leave the queue of waiters without taking a slot.
+        """
+        if self._ticket is None:
+            return
+        with self._queue() as queue:
+            queue[:] = [entry for entry in queue if entry[0] != self._ticket]
+        self._ticket = None
+
+    def try_acquire(self) -> bool:
+        """
+        Take a free slot if this waiter is first in the queue.
+        """
+        assert fcntl is not None
+        if self._ticket is None:
+            self.join()
+        with self._queue() as queue:
+            if not any(entry[0] == self._ticket for entry in queue):
+                queue.append([self._ticket, os.getpid()])
+            if queue[0][0] != self._ticket:
+                return False
+            for index in range(self.limit):
+                f = open(self.directory / f"{self._name}.{index}.lock", "a")
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    f.close()
+                    continue
+                self._slot = f
+                queue.pop(0)
+                self._ticket = None
+                return True
+        return False
+
+    def acquire(self, timeout: float | None = None) -> float | None:
+        """
+        Wait for a slot and take it.
+
+        Returns how many seconds were spent waiting, or None if no slot
+        was free within `timeout` seconds.
+        """
+        start = time.monotonic()
+        self.join()
+        try:
+            while not self.try_acquire():
+                waited = time.monotonic() - start
+                if timeout is not None and waited >= timeout:
+                    self.leave()
+                    return None
+                delay = self.poll_interval
+                if timeout is not None:
+                    delay = min(delay, timeout - waited)
+                time.sleep(delay)
+        except BaseException:
+            self.leave()
+            raise
+        return time.monotonic() - start
+
+    def release(self) -> None:
+        """
+        Give back the slot.
+        """
+        if self._slot is not None:
+            assert fcntl is not None
+            fcntl.flock(self._slot, fcntl.LOCK_UN)
+            self._slot.close()
+            self._slot = None
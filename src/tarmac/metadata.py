@@ -1,11 +1,31 @@
+import functools
 import re
 from typing import Any, Iterator, Literal, Self, TypeAlias
 
 import yaml
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
+
+from .expressions import compile_expression
+from .templates import Template, template_expressions
 
 REGEX = r"(?m)^# /// (?P<type>[a-zA-Z0-9-]+)$\s(?P<content>(^#(| .*)$\s)+)^# ///$"
 
+_SIZE_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*$", re.IGNORECASE)
+_SIZE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def parse_size(value: int | float | str) -> int:
+    """
+    Parse a number of bytes such as 512M or 1.5G (powers of 1024).
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = _SIZE_REGEX.match(value)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit.lower()])
+
 
 def _metadata_stream(script: str) -> Iterator[tuple[str, str]]:
     for match in re.finditer(REGEX, script):
@@ -18,6 +38,17 @@ def _metadata_stream(script: str) -> Iterator[tuple[str, str]]:
         )
 
 
+def metadata_block(script: str, type_: str) -> str:
+    """
+    Return the first `# /// <type>` metadata block of a script as written,
+    or an empty string if it has none.
+    """
+    for match in re.finditer(REGEX, script):
+        if match.group("type") == type_:
+            return match.group(0)
+    return ""
+
+
 IOTypeString: TypeAlias = Literal["str", "int", "float", "bool", "list", "dict"]
 IOType: TypeAlias = Any
 ValueMapping: TypeAlias = dict[str, IOType]
@@ -211,6 +242,163 @@ class ScriptMetadata(Metadata):
 WorkflowType: TypeAlias = Literal["script", "shell", "python", "workflow"]
 
 
+class AdaptiveConcurrency(BaseModel):
+    """
+    Settings for adapting the number of runs of a step
+    that execute at the same time.
+    """
+
+    min_parallel: int = Field(alias="min", default=1)
+    """
+    The lowest number of runs to execute at the same time.
+    """
+
+    initial: int | None = None
+    """
+    The number of runs to execute at the same time at first.
+    If not provided, the minimum is used.
+    """
+
+    latency_tolerance: float = Field(alias="latency-tolerance", default=2.0)
+    """
+    How many times longer than the fastest successful run
+    a run may take before the number of runs is lowered.
+    """
+
+    error_threshold: float = Field(alias="error-threshold", default=0.5)
+    """
+    The fraction of failed runs at which no new runs are started.
+    """
+
+    window: int = 20
+    """
+    The number of most recent runs the error rate is computed over.
+    """
+
+    model_config = {
+        "extra": "forbid",
+        "frozen": True,
+        "populate_by_name": True,
+    }
+
+    @model_validator(mode="after")
+    def _check_values(self) -> Self:
+        if self.min_parallel < 1:
+            raise ValueError("`min` must be at least 1")
+        if self.latency_tolerance < 1:
+            raise ValueError("`latency-tolerance` must be at least 1")
+        if not 0 < self.error_threshold <= 1:
+            raise ValueError("`error-threshold` must be between 0 and 1")
+        if self.window < 1:
+            raise ValueError("`window` must be at least 1")
+        return self
+
+
+class StepResources(BaseModel):
+    """
+    Describes the resources a workflow step uses while it runs.
+    """
+
+    cpu: float = 0
+    """
+    The number of CPUs the workflow step keeps busy.
+    """
+
+    memory: int = 0
+    """
+    The amount of memory the workflow step uses, in bytes.
+    Can be given with a unit, such as 512M or 2G.
+    """
+
+    io: Literal["none", "light", "heavy"] = "none"
+    """
+    How much disk or network I/O the workflow step does.
+    """
+
+    model_config = {
+        "extra": "forbid",
+        "frozen": True,
+    }
+
+    @model_validator(mode="before")
+    @classmethod
+    def _parse_memory(cls, data: Any) -> Any:
+        if isinstance(data, dict) and "memory" in data:
+            data = dict(data)
+            data["memory"] = parse_size(data["memory"])
+        return data
+
+    @model_validator(mode="after")
+    def _check_values(self) -> Self:
+        if self.cpu < 0:
+            raise ValueError("`cpu` must not be negative")
+        if self.memory < 0:
+            raise ValueError("`memory` must not be negative")
+        return self
+
+
+class ConcurrencyGroup(BaseModel):
+    """
+    Limits how many workflow steps or workflow runs of a named group
+    execute at the same time, in this and other processes
+    using the same base path.
+    """
+
+    group: str
+    """
+    The name of the group.
+    Can contain substitutions.
+    """
+
+    limit: int = 1
+    """
+    The number of members of the group that may execute at the same time.
+    """
+
+    model_config = {
+        "extra": "forbid",
+        "frozen": True,
+    }
+
+    @model_validator(mode="after")
+    def _check_values(self) -> Self:
+        if not self.group:
+            raise ValueError("`group` must not be empty")
+        if self.limit < 1:
+            raise ValueError("`limit` must be at least 1")
+        return self
+
+
+class StepCache(BaseModel):
+    """
+    Settings for caching the outputs of a workflow step.
+    """
+
+    files: list[str] = Field(default_factory=list)
+    """
+    The files the workflow step reads, relative to the base path.
+    Can be glob patterns and contain substitutions.
+    The cached outputs are only used while the files are unchanged.
+    """
+
+    ttl: float | None = None
+    """
+    The number of seconds the cached outputs can be used for.
+    If not provided, they can be used until they are evicted.
+    """
+
+    model_config = {
+        "extra": "forbid",
+        "frozen": True,
+    }
+
+    @model_validator(mode="after")
+    def _check_values(self) -> Self:
+        if self.ttl is not None and self.ttl <= 0:
+            raise ValueError("`ttl` must be positive")
+        return self
+
+
 class WorkflowStep(BaseModel):
     """
     Describes a workflow step.
@@ -220,13 +408,15 @@ class WorkflowStep(BaseModel):
     """
     The ID of the workflow step.
     If not provided, the ID will be set to the name of the workflow step.
+    Steps must have different IDs when any step has `needs`
+    or the workflow has `infer_needs`.
     """
 
     type: WorkflowType | None = None
     """
     The type of the workflow step.
-    Can be one of: script, workflow, shell.
-    The type will be set based on the presence of the `do`, `run`, or `workflow` fields.
+    Can be one of: script, workflow, shell, python.
+    The type is set based on the presence of the `do`, `run`, `py`, or `workflow` fields.
     """
 
     name: str = ""
@@ -270,42 +460,225 @@ class WorkflowStep(BaseModel):
     If provided, the workflow step will only run if the condition is true.
     """
 
+    needs: str | list[str] | None = None
+    """
+    The IDs of the workflow steps that must finish before this step starts.
+    If not provided, the workflow step runs after the previous step.
+    An empty list means the workflow step does not depend on any other step.
+    """
+
+    tags: list[str] = Field(default_factory=list)
+    """
+    Tags for selecting the workflow step, like its ID,
+    when running only part of a workflow.
+    """
+
+    resources: StepResources | None = None
+    """
+    The resources the workflow step uses while it runs.
+    Steps that run in parallel only start when their resources
+    fit in the capacity of the runner, which the steps of all its runs share,
+    including those of nested workflows.
+    For matrix and `for_each` steps, these are the resources of all runs together.
+    Steps that run a workflow take no resources, since its steps take their own.
+    """
+
+    timeout: float | None = None
+    """
+    The number of seconds the workflow step may run for.
+    A script or shell step that runs longer is killed with all its subprocesses,
+    and fails with `timed_out` set in its outputs, next to its partial output.
+    For matrix and `for_each` steps, this applies to each run separately.
+    Waiting for a turn in the concurrency group counts against the timeout.
+    When steps run in parallel, the steps running next to one that times out
+    are killed too, as if they timed out.
+    Python steps cannot be interrupted, so they cannot have a timeout.
+    """
+
+    cache: bool | StepCache = False
+    """
+    Whether to reuse the outputs of an earlier successful run of the workflow step.
+    The outputs are stored under a key computed from the step type,
+    the substituted parameters, the script file, including its metadata,
+    and the files listed under `files`, and reused with `cached` set
+    instead of running the workflow step again.
+    Only script and shell steps can be cached.
+    """
+
+    warm: bool = True
+    """
+    Whether the script of the workflow step may run in a warm worker,
+    when the runner keeps them.
+    Set to false for scripts that must run in a new interpreter,
+    such as scripts that change the state of the interpreter.
+    """
+
+    concurrency: ConcurrencyGroup | None = None
+    """
+    The concurrency group of the workflow step.
+    The workflow step waits for its turn in the group before it runs,
+    and the time it waited is available as `concurrency.waited` in its outputs.
+    For matrix and `for_each` steps, each run waits for its turn separately.
+    """
+
+    matrix: dict[str, list[Any] | str] | None = None
+    """
+    The values to run the workflow step with.
+    The workflow step runs once for each combination of the values,
+    with the combination available as `matrix` in substitutions and the condition.
+    A value can also be a substitution that evaluates to a list.
+    """
+
+    max_parallel: int | None = Field(alias="max-parallel", default=None)
+    """
+    The maximum number of matrix combinations to run at the same time.
+    If not provided, the number of jobs of the runner is used.
+    """
+
+    for_each: list[Any] | str | None = None
+    """
+    The items to run the workflow step for.
+    Usually a substitution that evaluates to a list.
+    The workflow step runs once for each item,
+    with the item available as `item` in substitutions and the condition.
+    """
+
+    batch_size: int | None = Field(alias="batch-size", default=None)
+    """
+    The number of items to pass to each run of a `for_each` workflow step.
+    If provided, the list of items is available as `batch` instead of `item`,
+    and the workflow step may output a `results` list with one entry per item.
+    """
+
+    parallel: int | None = None
+    """
+    The maximum number of `for_each` runs to execute at the same time.
+    If not provided, the number of jobs of the runner is used.
+    """
+
+    adaptive: bool | AdaptiveConcurrency = False
+    """
+    Whether to adapt the number of matrix combinations or `for_each` runs
+    that execute at the same time to how long they take and how often they fail.
+    The number of jobs, `max-parallel` or `parallel` is the upper limit.
+    """
+
+    fail_fast: bool = Field(alias="fail-fast", default=True)
+    """
+    Whether to stop starting matrix combinations or `for_each` runs
+    once one of them fails.
+    """
+
     model_config = {
         "extra": "forbid",
+        "frozen": True,
     }
 
-    def __init__(self, *args, **kw):
-        super().__init__(*args, **kw)
-        if not self.id:
-            self.id = self.name
-
-    def validate_workflow_type(self):
-        if self.type is not None:
+    @model_validator(mode="before")
+    @classmethod
+    def _set_id_and_type(cls, data: Any) -> Any:
+        # The model is frozen, so derived fields are set before validation.
+        if not isinstance(data, dict):
+            return data
+        if data.get("type") is not None:
             raise ValueError(
                 "Do not set `type` manually, use the relevant parameter instead"
             )
-        if self.do is not None:
-            if self.run is not None:
-                raise ValueError("Cannot use `run` with `do`")
-            if self.workflow is not None:
-                raise ValueError("Cannot use `workflow` with `do`")
-            if self.py is not None:
-                raise ValueError("Cannot use `py` with `do`")
-            self.type = "script"
-        elif self.run is not None:
-            if self.workflow is not None:
-                raise ValueError("Cannot use `workflow` with `run`")
+        data = dict(data)
+        data["type"] = _workflow_type(
+            data.get("do"), data.get("run"), data.get("py"), data.get("workflow")
+        )
+        if not data.get("id"):
+            data["id"] = data.get("name", "")
+        return data
+
+    @model_validator(mode="after")
+    def _check_repetition(self) -> Self:
+        if self.matrix is not None and self.for_each is not None:
+            raise ValueError("Cannot use `for_each` with `matrix`")
+        if self.adaptive and self.matrix is None and self.for_each is None:
+            raise ValueError("Cannot use `adaptive` without `matrix` or `for_each`")
+        if self.matrix is None and self.max_parallel is not None:
+            raise ValueError("Cannot use `max-parallel` without `matrix`")
+        if self.for_each is None:
+            if self.batch_size is not None:
+                raise ValueError("Cannot use `batch-size` without `for_each`")
+            if self.parallel is not None:
+                raise ValueError("Cannot use `parallel` without `for_each`")
+        for name, value in (
+            ("max-parallel", self.max_parallel),
+            ("batch-size", self.batch_size),
+            ("parallel", self.parallel),
+        ):
+            if value is not None and value < 1:
+                raise ValueError(f"`{name}` must be at least 1")
+        if self.cache and self.type not in ("script", "shell"):
+            raise ValueError("Only script and shell steps can use `cache`")
+        if self.timeout is not None:
             if self.py is not None:
-                raise ValueError("Cannot use `py` with `run`")
-            self.type = "shell"
-        elif self.py is not None:
-            if self.workflow is not None:
-                raise ValueError("Cannot use `workflow` with `py`")
-            self.type = "python"
-        elif self.workflow is not None:
-            self.type = "workflow"
-        else:
-            raise ValueError("Must have either `do`, `run`, `py`, or `workflow`")
+                raise ValueError("Cannot use `timeout` with `py`")
+            if self.timeout <= 0:
+                raise ValueError("`timeout` must be positive")
+        return self
+
+    @model_validator(mode="after")
+    def _check_expressions(self) -> Self:
+        # Invalid expressions are reported when the workflow is loaded,
+        # rather than when the step runs.
+        sources = list(template_expressions(self.substituted_values))
+        if isinstance(self.condition, str):
+            sources.append(self.condition)
+        for source in sources:
+            compile_expression(source)
+        return self
+
+    @property
+    def substituted_values(self) -> list[Any]:
+        """
+        The values of the workflow step that can contain substitutions.
+        """
+        return [
+            self.params,
+            self.matrix,
+            self.for_each,
+            self.concurrency.group if self.concurrency else None,
+            self.cache.files if isinstance(self.cache, StepCache) else None,
+        ]
+
+    @functools.cached_property
+    def params_template(self) -> Template:
+        """
+        The parameters of the workflow step, compiled for substitution.
+        """
+        return Template(self.params)
+
+    def validate_workflow_type(self):
+        _workflow_type(self.do, self.run, self.py, self.workflow)
+
+
+def _workflow_type(do: Any, run: Any, py: Any, workflow: Any) -> WorkflowType:
+    if do is not None:
+        if run is not None:
+            raise ValueError("Cannot use `run` with `do`")
+        if workflow is not None:
+            raise ValueError("Cannot use `workflow` with `do`")
+        if py is not None:
+            raise ValueError("Cannot use `py` with `do`")
+        return "script"
+    elif run is not None:
+        if workflow is not None:
+            raise ValueError("Cannot use `workflow` with `run`")
+        if py is not None:
+            raise ValueError("Cannot use `py` with `run`")
+        return "shell"
+    elif py is not None:
+        if workflow is not None:
+            raise ValueError("Cannot use `workflow` with `py`")
+        return "python"
+    elif workflow is not None:
+        return "workflow"
+    else:
+        raise ValueError("Must have either `do`, `run`, `py`, or `workflow`")
 
 
 class WorkflowMetadata(Metadata):
@@ -321,9 +694,38 @@ class WorkflowMetadata(Metadata):
     steps: list[WorkflowStep] = Field(default_factory=list)
     """
     A list of workflow steps.
-    The steps are executed in order.
+    The steps are executed in order, unless they declare `needs`.
+    """
+
+    infer_needs: bool = False
+    """
+    Whether to derive the dependencies between the steps from the outputs
+    they read, instead of running each step after the previous one.
+    Steps whose dependencies cannot be determined run as barriers.
+    """
+
+    concurrency: ConcurrencyGroup | None = None
+    """
+    The concurrency group of the workflow.
+    A run of the workflow waits for its turn in the group before its steps run,
+    and the time it waited is available as `concurrency.waited` in its outputs.
     """
 
+    deadline: float | None = None
+    """
+    The number of seconds a run of the workflow may take.
+    Once they are up, running steps are killed as if they timed out,
+    no more steps are started, and the run fails with `timed_out` set
+    in its outputs. Conditions can check the time left with `time_left()`.
+    Waiting for a turn in the concurrency group counts against the deadline.
+    """
+
+    @model_validator(mode="after")
+    def _check_deadline(self) -> Self:
+        if self.deadline is not None and self.deadline <= 0:
+            raise ValueError("`deadline` must be positive")
+        return self
+
     @classmethod
     def load(cls, file: str) -> Self:
         metadata = yaml.safe_load(file)
@@ -0,0 +1,72 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+# A script to prepare, and whether it may run in a warm worker.
+ScriptKey = tuple[str, bool]
+
+
+class EnvironmentPrefetcher:
+    """
+    Prepares the environments of the scripts that workflows are about to run
+    in background threads, so that the steps do not wait for them.
+
+    At most `max_workers` environments are prepared at the same time.
+    A script that is about to run waits for its preparation if it started,
+    and otherwise prepares its environment itself.
+    Failures are only logged, since the step reports them when it runs.
+    """
+
+    def __init__(self, prepare: Callable[[str, bool], None], max_workers: int):
+        if max_workers < 1:
+            raise ValueError(
+                "The number of environments to prefetch must be at least 1"
+            )
+        self.prepare = prepare
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tarmac-prefetch"
+        )
+        self._pending: dict[ScriptKey, Future] = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, scripts: Iterable[ScriptKey]) -> None:
+        """
+        Schedule the preparation of the environments of scripts, in order.
+        """
+        with self._lock:
+            for key in scripts:
+                future = self._pending.get(key)
+                if future is not None and not future.done():
+                    continue
+                self._pending[key] = self._pool.submit(self._prepare, key)
+
+    def _prepare(self, key: ScriptKey) -> None:
+        name, warm = key
+        try:
+            self.prepare(name, warm)
+        except Exception as e:
+            logger.warning("Failed to prefetch the environment of %s: %s", name, e)
+        else:
+            logger.debug("Prefetched the environment of %s", name)
+
+    def wait(self, name: str, warm: bool = True) -> None:
+        """
+        Wait for the preparation of a script that is about to run,
+        or cancel it if it did not start yet.
+        """
+        with self._lock:
+            future = self._pending.pop((name, warm), None)
+        if future is not None and not future.cancel():
+            future.result()
+
+    def close(self) -> None:
+        """
+        Cancel the preparations that did not start, and wait for the others.
+        """
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            self._pending.clear()
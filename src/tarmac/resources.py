@@ -0,0 +1,145 @@
+import os
+import threading
+from typing import Any, Self
+
+from pydantic import BaseModel, model_validator
+
+from .metadata import StepResources, parse_size
+
+# How much of the I/O capacity a step uses for each level of I/O.
+IO_WEIGHTS = {"none": 0, "light": 1, "heavy": 4}
+
+
+def _available_memory() -> int | None:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):  # pragma: no cover
+        return None
+
+
+class Capacity(BaseModel):
+    """
+    The resources the steps of a workflow run can use at the same time.
+    """
+
+    cpu: float | None = None
+    """
+    The number of CPUs. None means unlimited.
+    """
+
+    memory: int | None = None
+    """
+    The amount of memory in bytes. None means unlimited.
+    """
+
+    io: int = 8
+    """
+    The I/O capacity. A step with light I/O uses 1 and one with heavy I/O uses 4.
+    """
+
+    model_config = {
+        "extra": "forbid",
+        "frozen": True,
+    }
+
+    @model_validator(mode="before")
+    @classmethod
+    def _parse_memory(cls, data: Any) -> Any:
+        if isinstance(data, dict) and data.get("memory") is not None:
+            data = dict(data)
+            data["memory"] = parse_size(data["memory"])
+        return data
+
+    @classmethod
+    def detect(cls, **overrides) -> Self:
+        """
+        Return the capacity of this machine: its CPU count and available memory.
+        """
+        values = {"cpu": os.cpu_count(), "memory": _available_memory()}
+        values.update(overrides)
+        return cls(**values)
+
+
+class ResourcePool:
+    """
+    Keeps track of the resources used by the running steps
+    of the workflow runs of a runner, which may run in different threads.
+
+    A step that does not fit can still start while no other step
+    holds resources, so that steps larger than the capacity run on their own.
+    """
+
+    def __init__(self, capacity: Capacity):
+        self.capacity = capacity
+        self.cpu = 0.0
+        self.memory = 0
+        self.io = 0
+        # The number of steps that hold resources.
+        self.steps = 0
+        # The number of times resources were released, to wait for the next time.
+        self.releases = 0
+        self._condition = threading.Condition()
+
+    def fits(self, resources: StepResources) -> bool:
+        """
+        Check whether a step can start without exceeding the capacity.
+        """
+        with self._condition:
+            return self._fits(resources)
+
+    def _fits(self, resources: StepResources) -> bool:
+        if not self.steps:
+            return True
+        capacity = self.capacity
+        if capacity.cpu is not None and self.cpu + resources.cpu > capacity.cpu:
+            return False
+        if (
+            capacity.memory is not None
+            and self.memory + resources.memory > capacity.memory
+        ):
+            return False
+        return self.io + IO_WEIGHTS[resources.io] <= capacity.io
+
+    def try_acquire(self, resources: StepResources) -> bool:
+        """
+        Take the resources of a step if it fits, and return whether it did.
+        """
+        with self._condition:
+            if not self._fits(resources):
+                return False
+            self._acquire(resources)
+            return True
+
+    def acquire(self, resources: StepResources) -> None:
+        with self._condition:
+            self._acquire(resources)
+
+    def _acquire(self, resources: StepResources) -> None:
+        self.cpu += resources.cpu
+        self.memory += resources.memory
+        self.io += IO_WEIGHTS[resources.io]
+        self.steps += 1
+
+    def release(self, resources: StepResources) -> None:
+        with self._condition:
+            self.cpu -= resources.cpu
+            self.memory -= resources.memory
+            self.io -= IO_WEIGHTS[resources.io]
+            self.steps -= 1
+            self.releases += 1
+            self._condition.notify_all()
+
+    def wait(self, releases: int, timeout: float | None = None) -> None:
+        """
+        Wait until resources are released after `releases` was read,
+        or for at most `timeout` seconds.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.releases != releases, timeout)
@@ -1,48 +1,173 @@
+import contextlib
+import contextvars
+import functools
+import glob
+import hashlib
+import itertools
 import json
 import logging
-import os
-import re
-import subprocess
+import math
 import sys
 import tempfile
+import threading
+import time
 import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Any, Callable, TypeAlias
+from typing import Any, Callable, Iterable, Iterator, TypeAlias
 
 import dotmap
-from uv import find_uv_bin
 
 from tarmac.operations import Failure
 
-from .metadata import ScriptMetadata, ValueMapping, WorkflowMetadata, WorkflowStep
+from .analysis import infer_references, step_references
+from .cache import ResultCache
+from .concurrency import AdaptiveLimiter
+from .envs import ScriptEnvironments, Wheelhouse
+from .expressions import compile_expression
+from .history import StepHistory
+from .inventory import Target
+from .journal import (
+    RUN_ID_REGEX,
+    RunIndex,
+    RunJournal,
+    child_run_id,
+    new_run_id,
+    read_journal,
+    read_journal_header,
+)
+from .locks import GroupSemaphore
+from .metadata import (
+    AdaptiveConcurrency,
+    ConcurrencyGroup,
+    ScriptMetadata,
+    StepCache,
+    ValueMapping,
+    WorkflowMetadata,
+    WorkflowStep,
+)
+from .prefetch import EnvironmentPrefetcher
+from .resources import Capacity, ResourcePool
+from .scheduler import StepScheduler, StepSelection, _closure
+from .templates import substitute
+from .transport import (
+    CommandResult,
+    LocalTransport,
+    SSHTransport,
+    Transport,
+    cancel_on,
+)
+from .views import AttrView, wrap
+from .workers import WorkerPool
 
 logger = logging.getLogger(__name__)
 
 WorkflowCallback: TypeAlias = Callable[[WorkflowStep, ValueMapping], None]
 
+# The concurrency groups held by the workflows and steps that enclose
+# the current step, by lock directory and group, so that a step or nested
+# workflow in a group that is already held does not wait for itself.
+# Steps that run in other threads are started in a copy of the context.
+_held_groups: contextvars.ContextVar[frozenset[tuple[str, str]]] = (
+    contextvars.ContextVar("tarmac_held_groups", default=frozenset())
+)
+
 
 class Runner:
     """
     This class is responsible for executing scripts and workflows.
     """
 
-    # The regex for substituting variables in strings.
-    # A dollar sign means nothing unless it is followed by an opening brace
-    # and preceded by an even number of dollar signs.
-    _subst_regex = re.compile(r"(\$+)\{([^}]*)\}")
-    # The regex for substituting variables as actual values without string interpolation.
-    _full_subst_regex = re.compile(r"^\$\{([^}]*)\}$")
-
-    def __init__(self, base_path: str | Path):
+    def __init__(
+        self,
+        base_path: str | Path,
+        jobs: int = 1,
+        cwd: str | Path | None = None,
+        transport: Transport | None = None,
+        capacity: Capacity | None = None,
+        warm_workers: bool = False,
+        cached_envs: bool = False,
+        offline: bool = False,
+        prefetch: int = 0,
+    ):
         self.base_path = Path(base_path)
         if not self.base_path.is_dir():
             raise ValueError(f"Base path {base_path} is not a directory")
-        self._uv_bin = None
+        if jobs < 1:
+            raise ValueError("The number of jobs must be at least 1")
+        if cwd is not None and transport is not None:
+            raise ValueError("Cannot use `cwd` with `transport`")
+        self.jobs = jobs
+        # Scripts and shell commands run through the transport,
+        # in the current directory unless `cwd` is given.
+        self.transport = transport or LocalTransport(cwd)
+        # The resources that the parallel steps of each run share.
+        self.capacity = capacity or Capacity.detect()
+        # The resources taken by the running steps of all runs,
+        # including concurrent and nested ones.
+        self.resources = ResourcePool(self.capacity)
+        self.state_path = self.base_path / ".tarmac"
+        # The wheels that `tarmac bundle` downloads for the scripts.
+        self.wheelhouse = Wheelhouse(self.base_path / "wheelhouse")
+        # Whether scripts only install packages from the wheelhouse.
+        self.offline = offline
+        if offline and not isinstance(self.transport, LocalTransport):
+            # The wheelhouse is not copied to remote hosts.
+            raise ValueError("Scripts can only run offline locally")
+        if offline and not self.wheelhouse.directory.is_dir():
+            raise ValueError(
+                f"Wheelhouse {self.wheelhouse.directory} not found,"
+                " run `tarmac bundle` to create it"
+            )
+        # The outputs of steps with `cache` set.
+        self.cache = ResultCache(self.state_path / "cache")
+        # The latest runs of each workflow, whose journals are kept.
+        self.run_index = RunIndex(self.state_path / "runs")
+        # The parsed workflow files by file name, with the digest
+        # of their contents, so that unchanged files are parsed only once.
+        self._workflows: dict[Path, tuple[str, WorkflowMetadata]] = {}
+        # The interpreters that keep running scripts, if enabled.
+        self.workers: WorkerPool | None = None
+        if warm_workers:
+            if not isinstance(self.transport, LocalTransport):
+                raise ValueError("Warm workers can only run scripts locally")
+            self.workers = WorkerPool(
+                self.state_path / "workers",
+                self.transport._find_uv_bin(),
+                self.transport.cwd,
+            )
+        # The prebuilt environments that scripts run in, if enabled.
+        self.environments: ScriptEnvironments | None = None
+        if cached_envs:
+            if not isinstance(self.transport, LocalTransport):
+                raise ValueError("Cached script environments can only be used locally")
+            self.environments = ScriptEnvironments(
+                self.state_path / "envs",
+                self.transport._find_uv_bin(),
+                index_args=self._index_args(),
+            )
+        # The environments of the upcoming script steps of each run,
+        # prepared in the background `prefetch` at a time, if enabled.
+        self.prefetcher: EnvironmentPrefetcher | None = None
+        if prefetch:
+            if not isinstance(self.transport, LocalTransport):
+                raise ValueError("Script environments can only be prefetched locally")
+            self.prefetcher = EnvironmentPrefetcher(self.prepare_script, prefetch)
+
+    def close(self) -> None:
+        """
+        Stop the environment prefetching and the warm workers of the runner.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.workers is not None:
+            self.workers.close()
+
+    def __enter__(self):
+        return self
 
-    def _find_uv_bin(self):
-        if not self._uv_bin:
-            self._uv_bin = find_uv_bin()
-        return self._uv_bin
+    def __exit__(self, *exc_info):
+        self.close()
 
     def _get_workflow_filename(self, name: str) -> Path:
         return self.base_path / "workflows" / (name + ".yml")
@@ -50,146 +175,180 @@ class Runner:
     def _get_script_filename(self, name: str) -> Path:
         return self.base_path / "scripts" / (name + ".py")
 
-    def _substitute(self, v: Any, inputs: ValueMapping) -> Any:
-        if isinstance(v, str):
-            return self._substitute_string(v, inputs)
-        elif isinstance(v, list):
-            return [self._substitute(i, inputs) for i in v]
-        elif isinstance(v, dict):
-            return {k: self._substitute(v, inputs) for k, v in v.items()}
-        else:
-            return v
-
-    def _substitute_string(self, s: str, inputs: ValueMapping) -> Any:
-        if m := self._full_subst_regex.match(s):
-            return self._substitute_eval(m.group(1), inputs)
-
-        def subst(match):
-            escape_len = len(match.group(1))
-            prefix = "$" * (escape_len // 2)
-            if escape_len % 2 == 0:
-                return prefix + "{" + match.group(2) + "}"
-            return prefix + str(self._substitute_eval(match.group(2), inputs))
+    def _get_history_filename(self, name: str) -> Path:
+        return self.state_path / "history" / (name + ".json")
 
-        return self._subst_regex.sub(subst, s)
+    def _get_journal_filename(self, run_id: str) -> Path:
+        return self.state_path / "runs" / (run_id + ".jsonl")
 
-    def _substitute_eval(self, s: str, inputs: ValueMapping) -> str:
-        return eval(s, {}, inputs)
+    def _substitute(self, v: Any, inputs: ValueMapping) -> Any:
+        return substitute(v, inputs)
 
-    def execute_script(self, name: str, inputs: ValueMapping) -> ValueMapping:
+    def _load_script(self, name: str) -> tuple[Path, ScriptMetadata]:
         filename = self._get_script_filename(name)
         try:
             with open(filename) as f:
                 metadata = ScriptMetadata.load(f.read())
         except FileNotFoundError as e:
             raise ValueError(f"Script {name} not found") from e
+        return filename, metadata
+
+    def _index_args(self) -> list[str]:
+        if not self.offline:
+            return []
+        return self.wheelhouse.index_args()
+
+    def _script_python(self, filename: Path, metadata: ScriptMetadata) -> str | None:
+        """
+        Return the interpreter of the prebuilt environment of a script,
+        or None if it runs with `uv run`.
+        """
+        if self.environments is None:
+            return None
+        python = self.environments.python(filename, metadata)
+        return None if python is None else str(python)
+
+    def _uv_args(self, metadata: ScriptMetadata) -> list[str]:
+        # Scripts import `tarmac.operations` from the shim,
+        # so tarmac is not installed in their environments.
+        args = [
+            "run",
+            "--color",
+            "never",
+            "--no-progress",
+            "--no-config",
+            "--no-project",
+            "--no-env-file",
+            "--native-tls",
+            *self._index_args(),
+            "--script",
+        ]
+        args.extend(metadata.additional_uv_args)
+        return args
+
+    def _sync_args(self) -> list[str]:
+        # Sets up the same environment as `uv run` with `_uv_args`.
+        return [
+            "sync",
+            "--color",
+            "never",
+            "--no-progress",
+            "--no-config",
+            "--native-tls",
+            *self._index_args(),
+            "--quiet",
+            "--script",
+        ]
+
+    def _script_outputs(self, outputs_text: str, result: CommandResult) -> ValueMapping:
+        try:
+            outputs = json.loads(outputs_text)
+        except json.JSONDecodeError:
+            logger.warning("Failed to decode JSON from outputs file")
+            outputs = {
+                "succeeded": False,
+                "error": "Failed to decode JSON from outputs file",
+            }
+        if result.returncode != 0:
+            if result.stdout:
+                outputs["output"] = result.stdout
+            if result.stderr:
+                outputs["error"] = result.stderr
+            outputs["succeeded"] = False
+        else:
+            if result.stdout:
+                outputs.setdefault("output", result.stdout)
+            if result.stderr:
+                outputs.setdefault("error", result.stderr)
+            outputs.setdefault("succeeded", True)
+        if result.timed_out:
+            outputs["timed_out"] = True
+        return outputs
+
+    def prepare_script(self, name: str, warm: bool = True) -> None:
+        """
+        Set up the environment of a script ahead of running it:
+        build its prebuilt environment, start a warm worker for it,
+        or let uv install its dependencies, whichever it will run with.
+
+        Scripts with `additional_uv_args` that run with `uv run`
+        are left alone, since the arguments may change the environment.
+        """
+        filename, metadata = self._load_script(name)
+        python = self._script_python(filename, metadata)
+        if warm and self.workers is not None:
+            self.workers.prepare(filename, metadata, self._uv_args(metadata), python)
+        elif python is None and not metadata.additional_uv_args:
+            assert isinstance(self.transport, LocalTransport)
+            result = self.transport.sync_script(filename, self._sync_args())
+            if result.returncode != 0:
+                raise ValueError(
+                    f"Failed to set up the environment of {name}: {result.stderr}"
+                )
+
+    def execute_script(
+        self,
+        name: str,
+        inputs: ValueMapping,
+        timeout: float | None = None,
+        warm: bool = True,
+    ) -> ValueMapping:
+        if self.prefetcher is not None:
+            self.prefetcher.wait(name, warm)
+        filename, metadata = self._load_script(name)
         inputs = metadata.validate_inputs(inputs)
-        with (
-            tempfile.NamedTemporaryFile(mode="wb") as inputs_file,
-            tempfile.NamedTemporaryFile(mode="w+b") as outputs_file,
-        ):
-            with_tarmac = ["--with", "tarmac"]
-            if os.environ.get("TARMAC_EDITABLE_INSTALL"):
-                with_tarmac = ["--with-editable", "."]  # pragma: no cover
-            cmd = [
-                self._find_uv_bin(),
-                "run",
-                "--color",
-                "never",
-                "--no-progress",
-                "--no-config",
-                "--no-project",
-                "--no-env-file",
-                "--native-tls",
-                *with_tarmac,
-                "--script",
-            ]
-            cmd.extend(metadata.additional_uv_args)
-            cmd.append(str(filename))
-            os.chmod(inputs_file.name, 0o600)
-            os.chmod(outputs_file.name, 0o600)
-            inputs_file.write(json.dumps(inputs).encode("utf-8"))
-            inputs_file.flush()
-            inputs_file.seek(0)
-            outputs_file.write(b"{}")
-            outputs_file.flush()
-            env = os.environ.copy()
-            env["TARMAC_INPUTS_FILE"] = inputs_file.name
-            env["TARMAC_OUTPUTS_FILE"] = outputs_file.name
-            p = subprocess.Popen(
-                cmd,
-                env=env,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
+        python = self._script_python(filename, metadata)
+        if warm and self.workers is not None:
+            result, outputs = self.workers.run_script(
+                filename, metadata, self._uv_args(metadata), inputs, timeout, python
             )
-            stdout, stderr = p.communicate()
-            try:
-                outputs_file.seek(0)
-                outputs = json.load(outputs_file.file)
-            except json.JSONDecodeError:
-                logger.warning("Failed to decode JSON from outputs file")
-                outputs = {
-                    "succeeded": False,
-                    "error": "Failed to decode JSON from outputs file",
-                }
-            if p.returncode != 0:
-                if stdout:
-                    outputs["output"] = stdout
-                if stderr:
-                    outputs["error"] = stderr
-                outputs["succeeded"] = False
-            else:
-                if stdout:
-                    outputs.setdefault("output", stdout)
-                if stderr:
-                    outputs.setdefault("error", stderr)
-                outputs.setdefault("succeeded", True)
-            return outputs
+        elif python is not None:
+            assert isinstance(self.transport, LocalTransport)
+            result, outputs = self.transport.run_script(
+                filename, self._uv_args(metadata), inputs, timeout, python
+            )
+        else:
+            result, outputs = self.transport.run_script(
+                filename, self._uv_args(metadata), inputs, timeout
+            )
+        return self._script_outputs(outputs, result)
 
-    def execute_shell(
-        self, script: str | list[str], inputs: ValueMapping
-    ) -> ValueMapping:
-        env = os.environ.copy()
-        env.update(inputs.pop("env", {}))
-        cwd = inputs.pop("cwd", os.getcwd())
+    def _shell_options(
+        self, inputs: ValueMapping
+    ) -> tuple[dict[str, str], str | None, str | None]:
+        """
+        Split the inputs of a shell step into the variables to add
+        to its environment, its working directory and its standard input.
+        """
+        inputs = dict(inputs)
+        env = dict(inputs.pop("env", {}))
+        cwd = inputs.pop("cwd", None)
         stdin = inputs.pop("stdin", None)
         try:
             invalid = next(iter(inputs))
             raise ValueError(f"Invalid input for shell script: {invalid}")
         except StopIteration:
             pass
+        return env, cwd, stdin
+
+    def execute_shell(
+        self,
+        script: str | list[str],
+        inputs: ValueMapping,
+        timeout: float | None = None,
+    ) -> ValueMapping:
+        env, cwd, stdin = self._shell_options(inputs)
         if isinstance(script, str):
             script = [script]
+        result = self.transport.run_shell(script, env, cwd, stdin, timeout)
         out: ValueMapping = {
-            "succeeded": True,
-            "output": "",
-            "error": "",
-            "returncode": 0,
+            "succeeded": result.returncode == 0 and not result.timed_out,
+            "output": result.stdout,
+            "error": result.stderr,
+            "returncode": result.returncode,
         }
-        for s in script:
-            p = subprocess.Popen(
-                s,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                stdin=subprocess.PIPE if stdin else None,
-                text=True,
-                env=env,
-                cwd=cwd,
-                encoding="utf-8",
-                errors="replace",
-            )
-            stdout, stderr = p.communicate(stdin)
-            stdin = None  # only pass stdin to the first command
-            out["returncode"] = p.returncode
-            out["output"] += stdout
-            out["error"] += stderr
-            if p.returncode != 0:
-                out["succeeded"] = False
-                break
-            else:
-                out["succeeded"] = True
+        if result.timed_out:
+            out["timed_out"] = True
         return out
 
     def execute_python(
@@ -215,28 +374,594 @@ class Runner:
         inputs: ValueMapping,
         before_each: WorkflowCallback | None = None,
         after_each: WorkflowCallback | None = None,
+        timeout: float | None = None,
+        run_id: str | None = None,
+        selection: StepSelection | None = None,
+    ) -> ValueMapping:
+        """
+        Execute a workflow.
+
+        The run fails once it took `timeout` seconds
+        or the deadline of the workflow, whichever comes first.
+
+        The steps are recorded in the journal of the run under
+        `.tarmac/runs`. If a journal with the given run ID exists
+        for the same workflow definition, inputs and selection,
+        the run continues from it: the steps that succeeded are not run again.
+
+        With a selection, only the selected steps run. The outputs of the
+        other steps they read are taken from the last run that has them.
+        """
+        run = self._start_workflow(
+            name, inputs, before_each, after_each, timeout, run_id, selection
+        )
+        try:
+            with self._concurrency_slot(
+                run.metadata.concurrency, run.inputs, run.remaining()
+            ) as slot:
+                if slot is not None and slot.get("timed_out"):
+                    run.outputs["succeeded"] = False
+                elif self.jobs == 1:
+                    self._execute_steps_sequential(run)
+                else:
+                    self._execute_steps_parallel(run)
+            if slot is not None:
+                run.outputs["concurrency"] = slot
+            self._finish_workflow(run)
+        finally:
+            run.close()
+        return run.outputs
+
+    def resume_workflow(
+        self,
+        name: str,
+        run_id: str,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+    ) -> ValueMapping:
+        """
+        Continue a run of a workflow that failed or was interrupted,
+        with the inputs it was started with.
+
+        The outputs of the steps that succeeded are replayed from the journal
+        of the run, and the other steps are run, including the steps
+        of nested workflows that did not finish.
+        """
+        inputs, selection = self._resume_arguments(name, run_id)
+        return self.execute_workflow(
+            name, inputs, before_each, after_each, run_id=run_id, selection=selection
+        )
+
+    def _resume_arguments(
+        self, name: str, run_id: str
+    ) -> tuple[ValueMapping, StepSelection | None]:
+        """
+        Check that a run can be resumed and return its inputs and selection.
+        """
+        path = self._get_journal_filename(run_id)
+        try:
+            header = read_journal_header(path)
+        except FileNotFoundError:
+            raise ValueError(f"Run {run_id} not found") from None
+        if header.get("workflow") != name:
+            raise ValueError(f"Run {run_id} is not a run of workflow {name}")
+        if header.get("definition") != self._workflow_digest(name):
+            raise ValueError(f"Workflow {name} changed since run {run_id}")
+        selection = None
+        if header.get("selection") is not None:
+            selection = StepSelection.model_validate(header["selection"])
+        return header.get("inputs", {}), selection
+
+    def execute_workflow_on_targets(
+        self,
+        name: str,
+        inputs: ValueMapping,
+        targets: list[Target],
+        batch: int | str | None = None,
+        max_fail_percentage: float | None = None,
+        adaptive: bool | AdaptiveConcurrency = False,
+    ) -> ValueMapping:
+        """
+        Execute a workflow against several targets, one batch at a time.
+
+        The targets in a batch run at the same time,
+        or as many of them as the limiter allows if `adaptive` is set.
+        `batch` is a number of targets or a percentage such as "25%",
+        and defaults to all targets.
+        No more batches are started once more than `max_fail_percentage`
+        percent of the targets run so far failed,
+        or once the circuit breaker of the limiter trips.
+        Targets with identical outputs are grouped together in the result.
+        """
+        size = _batch_size(batch, len(targets))
+        limiter = self._create_limiter(adaptive, size)
+        results: dict[str, ValueMapping] = {}
+        failed: list[str] = []
+        not_run: list[str] = []
+        for start in range(0, len(targets), size):
+            chunk = targets[start : start + size]
+            stop = limiter is not None and limiter.tripped
+            if max_fail_percentage is not None and results:
+                stop = stop or len(failed) * 100 > max_fail_percentage * len(results)
+            if stop:
+                not_run.extend(target.name for target in chunk)
+                continue
+            outs = self._execute_limited(
+                (
+                    functools.partial(self._execute_on_target, name, inputs, target)
+                    for target in chunk
+                ),
+                len(chunk),
+                len(chunk),
+                limiter=limiter,
+            )
+            for target, out in zip(chunk, outs):
+                if out is None:
+                    not_run.append(target.name)
+                    continue
+                results[target.name] = out
+                if not self._step_succeeded(out):
+                    failed.append(target.name)
+        if not_run:
+            logger.warning(
+                "Stopped workflow %s after %d of %d targets failed",
+                name,
+                len(failed),
+                len(results),
+            )
+        out: ValueMapping = {
+            "succeeded": not failed and not not_run,
+            "failed": failed,
+            "not_run": not_run,
+            "results": _group_outputs(results),
+        }
+        if limiter is not None:
+            out["adaptive"] = limiter.report()
+        return out
+
+    def _execute_on_target(
+        self, name: str, inputs: ValueMapping, target: Target
     ) -> ValueMapping:
+        inputs = {**target.inputs, **inputs}
+        with contextlib.ExitStack() as stack:
+            transport: Transport
+            if target.host is not None:
+                transport = SSHTransport(
+                    target.host,
+                    user=target.user,
+                    port=target.port,
+                    cwd=target.path,
+                    ssh_options=target.ssh_options,
+                )
+            else:
+                cwd = target.path
+                if cwd is None:
+                    cwd = stack.enter_context(
+                        tempfile.TemporaryDirectory(prefix="tarmac-")
+                    )
+                transport = LocalTransport(cwd)
+            stack.enter_context(transport)
+            try:
+                runner = type(self)(
+                    self.base_path,
+                    jobs=self.jobs,
+                    transport=transport,
+                    capacity=self.capacity,
+                    warm_workers=self.workers is not None and target.host is None,
+                    cached_envs=self.environments is not None and target.host is None,
+                    offline=self.offline,
+                    prefetch=(
+                        self.prefetcher.max_workers
+                        if self.prefetcher is not None and target.host is None
+                        else 0
+                    ),
+                )
+                stack.callback(runner.close)
+                return runner.execute_workflow(name, inputs)
+            except ValueError as e:
+                logger.error(
+                    "Failed to run workflow %s on %s: %s", name, target.name, e
+                )
+                return {"succeeded": False, "error": str(e)}
+
+    def _start_workflow(
+        self,
+        name: str,
+        inputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        timeout: float | None = None,
+        run_id: str | None = None,
+        selection: StepSelection | None = None,
+    ) -> "WorkflowRun":
+        metadata = self._load_workflow(name)
+        inputs = metadata.validate_inputs(inputs)
+        history = StepHistory(self._get_history_filename(name))
+        scheduler = self._create_scheduler(metadata, history.durations)
+        limits = [t for t in (metadata.deadline, timeout) if t is not None]
+        deadline = time.monotonic() + min(limits) if limits else None
+        if run_id is None:
+            run_id = new_run_id()
+        elif not RUN_ID_REGEX.match(run_id):
+            raise ValueError(f"Invalid run ID: {run_id}")
+        journal, finished = self._open_journal(name, inputs, run_id, selection)
+        run = WorkflowRun(
+            name,
+            metadata,
+            inputs,
+            history,
+            scheduler,
+            before_each,
+            after_each,
+            deadline,
+            run_id,
+            journal,
+        )
+        if selection is not None:
+            self._select_steps(run, selection)
+        if finished:
+            self._replay_steps(run, finished)
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(self._upcoming_scripts(run))
+        return run
+
+    def _upcoming_scripts(self, run: "WorkflowRun") -> list[tuple[str, bool]]:
+        """
+        List the scripts that the steps left to run are likely to use,
+        with whether they may run in a warm worker, in declaration order.
+
+        Steps whose condition is false from the inputs alone are left out.
+        The workflows that steps run are not loaded here, since their runs
+        prefetch their own scripts when the steps start.
+        """
+        scripts: list[tuple[str, bool]] = []
+        for index in run.scheduler.pending:
+            step = run.scheduler.steps[index]
+            if step.do is not None and not _statically_false(
+                step.condition, run.inputs
+            ):
+                scripts.append((step.do, step.warm))
+        return list(dict.fromkeys(scripts))
+
+    def _select_steps(self, run: "WorkflowRun", selection: StepSelection) -> None:
+        """
+        Leave out the steps that are not selected, without loading them.
+
+        The outputs of the left out steps that the selected steps read
+        are restored from the last run that has them, if any.
+        """
+        scheduler = run.scheduler
+        steps = scheduler.steps
+        selected = selection.select(steps, scheduler.dependencies)
+        indices = {step.id: index for index, step in enumerate(steps)}
+        read = set()
+        for index in selected:
+            refs = step_references(steps[index])
+            if refs is None:
+                read |= _closure({index}, scheduler.dependencies)
+            else:
+                read |= {indices[ref] for ref in refs if ref in indices}
+        needed = {str(steps[index].id) for index in read - selected}
+        found = self._last_step_outputs(run.name, needed, run.run_id)
+        for index, step in enumerate(steps):
+            if index in selected:
+                continue
+            scheduler.restore(index)
+            if str(step.id) in found:
+                run.outputs["steps"][step.id] = found[str(step.id)]
+        logger.info(
+            "Running %d of %d steps of workflow %s, with the outputs of %d steps"
+            " from earlier runs",
+            len(selected),
+            len(steps),
+            run.name,
+            len(found),
+        )
+        if needed - found.keys():
+            logger.warning(
+                "No earlier outputs of steps %s of workflow %s",
+                ", ".join(sorted(needed - found.keys())),
+                run.name,
+            )
+
+    def _last_step_outputs(
+        self, name: str, step_ids: set[str], exclude_run_id: str
+    ) -> dict[str, ValueMapping]:
+        """
+        Find the last successful outputs of some steps of a workflow
+        in the journals of its earlier runs, the latest first.
+        """
+        found: dict[str, ValueMapping] = {}
+        if not step_ids:
+            return found
+        for run_id in reversed(self.run_index.runs(name)):
+            if run_id == exclude_run_id:
+                continue
+            try:
+                records = read_journal(self._get_journal_filename(run_id))
+            except (OSError, ValueError):
+                continue
+            if not records or records[0].get("workflow") != name:
+                continue
+            for record in reversed(records):
+                step_id = record.get("step")
+                if (
+                    record.get("event") == "finish"
+                    and step_id in step_ids
+                    and step_id not in found
+                    and self._step_succeeded(record["outputs"])
+                ):
+                    found[step_id] = record["outputs"]
+            if len(found) == len(step_ids):
+                break
+        return found
+
+    def _open_journal(
+        self,
+        name: str,
+        inputs: ValueMapping,
+        run_id: str,
+        selection: StepSelection | None = None,
+    ) -> tuple[RunJournal, dict[int, ValueMapping]]:
+        """
+        Open the journal of a run, continuing the existing one
+        if it is of the same workflow definition, inputs and selection.
+
+        Returns the journal and the outputs of the steps that finished.
+        """
+        path = self._get_journal_filename(run_id)
+        header = {
+            "workflow": name,
+            "definition": self._workflow_digest(name),
+            # Compare the inputs as they are stored in the journal.
+            "inputs": json.loads(json.dumps(inputs, default=repr)),
+            "selection": None
+            if selection is None
+            else selection.model_dump(by_alias=True, exclude_none=True),
+        }
+        self.run_index.add(name, run_id)
+        if path.exists():
+            journal = RunJournal.resume(path)
+            if all(journal.header.get(key) == value for key, value in header.items()):
+                return journal, journal.finished_steps()
+            journal.close()
+        return RunJournal.create(path, header), {}
+
+    def _replay_steps(
+        self, run: "WorkflowRun", finished: dict[int, ValueMapping]
+    ) -> None:
+        """
+        Restore the outputs of the steps that succeeded in an earlier attempt
+        at the run, as long as the steps they depend on are restored too.
+        """
+        scheduler = run.scheduler
+        count = 0
+        replayed = True
+        while replayed:
+            replayed = False
+            for index in scheduler.ready():
+                step = scheduler.steps[index]
+                out = finished.get(index)
+                if out is not None and self._step_succeeded(out):
+                    scheduler.restore(index)
+                    run.outputs["steps"][step.id] = out
+                    count += 1
+                    replayed = True
+        logger.info(
+            "Resuming run %s of workflow %s after %d finished steps",
+            run.run_id,
+            run.name,
+            count,
+        )
+
+    def _workflow_digest(self, name: str) -> str:
+        return self._read_workflow(name)[0]
+
+    def _load_workflow(self, name: str) -> WorkflowMetadata:
+        return self._read_workflow(name)[1]
+
+    def _read_workflow(self, name: str) -> tuple[str, WorkflowMetadata]:
+        """
+        Return the digest and the parsed contents of a workflow file.
+
+        The file is only parsed again once its contents changed.
+        """
         filename = self._get_workflow_filename(name)
         try:
-            with open(filename) as f:
-                metadata = WorkflowMetadata.load(f.read())
+            with open(filename, "rb") as f:
+                content = f.read()
         except FileNotFoundError as e:
             raise ValueError(f"Workflow {name} not found") from e
-        inputs = metadata.validate_inputs(inputs)
-        for step in metadata.steps:
-            step.validate_workflow_type()
-        outputs = {}
-        outputs["succeeded"] = True
-        outputs["steps"] = {}
-        for step in metadata.steps:
+        digest = hashlib.sha256(content).hexdigest()
+        cached = self._workflows.get(filename)
+        if cached is not None and cached[0] == digest:
+            return cached
+        metadata = WorkflowMetadata.load(content.decode())
+        self._workflows[filename] = (digest, metadata)
+        return digest, metadata
+
+    def _create_scheduler(
+        self,
+        metadata: WorkflowMetadata,
+        durations: dict[str, float] | None = None,
+    ) -> StepScheduler:
+        references = None
+        if metadata.infer_needs:
+            references = infer_references(metadata.steps)
+        return StepScheduler(metadata.steps, references, durations, self.resources)
+
+    def _finish_workflow(self, run: "WorkflowRun") -> None:
+        """
+        Put the step outputs in declaration order and record the step durations.
+        """
+        scheduler, outputs = run.scheduler, run.outputs
+        if not outputs["succeeded"] and run.expired():
+            outputs["timed_out"] = True
+        steps = scheduler.steps
+        results = outputs["steps"]
+        outputs["steps"] = {
+            step.id: results[step.id] for step in steps if step.id in results
+        }
+        if run.history.durations:
+            path = scheduler.predicted_critical_path()
+            logger.info(
+                "Predicted critical path of workflow %s: %s (%.1fs)",
+                run.name,
+                " -> ".join(str(steps[index].id) for index in path),
+                sum(scheduler.estimates[index] for index in path),
+            )
+        path = scheduler.actual_critical_path()
+        if path:
+            logger.info(
+                "Actual critical path of workflow %s: %s (%.1fs)",
+                run.name,
+                " -> ".join(str(steps[index].id) for index in path),
+                scheduler.finished_at[path[-1]] - scheduler.started_at[path[0]],
+            )
+        # Skipped steps say nothing about how long the step takes to run.
+        durations = {
+            str(steps[index].id): duration
+            for index, duration in scheduler.durations().items()
+            if outputs["steps"].get(steps[index].id, {}).get("succeeded", True)
+            is not None
+        }
+        if durations:
+            run.history.record(durations)
+        if run.journal is not None:
+            run.journal.record("end", succeeded=outputs["succeeded"])
+
+    def workflow_scripts(self, name: str) -> list[str]:
+        """
+        List the scripts that a workflow and the workflows it runs use.
+        """
+        scripts: list[str] = []
+        workflows = [name]
+        seen = {name}
+        while workflows:
+            metadata = self._load_workflow(workflows.pop())
+            for step in metadata.steps:
+                if step.do is not None and step.do not in scripts:
+                    scripts.append(step.do)
+                elif step.workflow is not None and step.workflow not in seen:
+                    seen.add(step.workflow)
+                    workflows.append(step.workflow)
+        return scripts
+
+    def bundle_workflow(self, name: str) -> ValueMapping:
+        """
+        Download the wheels of the packages that the scripts of a workflow
+        and the workflows it runs use into the wheelhouse,
+        so that the workflow can run with `offline`.
+        """
+        if not isinstance(self.transport, LocalTransport):
+            raise ValueError("Workflows can only be bundled locally")
+        scripts = self.workflow_scripts(name)
+        # The dependencies are locked against the package index.
+        environments = ScriptEnvironments(
+            self.state_path / "envs", self.transport._find_uv_bin()
+        )
+        requirements = []
+        for script in scripts:
+            filename, _ = self._load_script(script)
+            requirements.append(environments.requirements_file(filename))
+        added = self.wheelhouse.download(
+            requirements, uv_bin=self.transport._find_uv_bin()
+        )
+        return {"scripts": scripts, "wheels": added}
+
+    def workflow_graph(self, name: str) -> ValueMapping:
+        """
+        Describe the dependencies between the steps of a workflow.
+        """
+        metadata = self._load_workflow(name)
+        scheduler = self._create_scheduler(metadata)
+        references = scheduler.references
+        graph = {}
+        for index, step in enumerate(metadata.steps):
+            graph[step.id] = {
+                "needs": [
+                    metadata.steps[dep].id
+                    for dep in sorted(scheduler.dependencies[index])
+                ],
+                "barrier": references is not None and references[index] is None,
+            }
+        return {"steps": graph}
+
+    def _execute_steps_sequential(self, run: "WorkflowRun") -> None:
+        scheduler = run.scheduler
+        while ready := scheduler.ready():
+            if run.expired():
+                run.outputs["succeeded"] = False
+                break
+            index = ready[0]
+            if not scheduler.reserve(index):
+                # Other runs hold the resources the step needs.
+                scheduler.wait_for_resources(run.remaining())
+                continue
             out = self.execute_workflow_step(
-                step, inputs, outputs, before_each, after_each
+                run.start_step(index),
+                run.inputs,
+                run.outputs,
+                run.before_each,
+                run.after_each,
+                run.deadline,
+                run.run_id,
             )
-            succeeded = out.get("succeeded", True)
-            if succeeded is not None and not succeeded:
-                outputs["succeeded"] = False
+            run.finish_step(index, out)
+            if not self._step_succeeded(out):
+                run.outputs["succeeded"] = False
                 break
-        return outputs
+
+    def _execute_steps_parallel(self, run: "WorkflowRun") -> None:
+        # Only this thread touches the run outputs; each step gets a snapshot
+        # of the outputs of the steps that finished before it started.
+        scheduler, outputs = run.scheduler, run.outputs
+        running: dict[Future, int] = {}
+        # Running steps are killed when the deadline of the run passes,
+        # since their timeouts never go beyond it, and when a step times out.
+        timed_out = threading.Event()
+        with cancel_on(timed_out), ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while True:
+                if outputs["succeeded"] and run.expired():
+                    outputs["succeeded"] = False
+                if outputs["succeeded"]:
+                    for index in scheduler.ready():
+                        if len(running) >= self.jobs:
+                            break
+                        if not scheduler.reserve(index):
+                            continue
+                        future = pool.submit(
+                            contextvars.copy_context().run,
+                            self.execute_workflow_step,
+                            run.start_step(index),
+                            run.inputs,
+                            run.snapshot(),
+                            run.before_each,
+                            run.after_each,
+                            run.deadline,
+                            run.run_id,
+                        )
+                        running[future] = index
+                if not running:
+                    if not outputs["succeeded"] or not scheduler.ready():
+                        break
+                    # Other runs hold the resources the ready steps need.
+                    scheduler.wait_for_resources(run.remaining())
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    out = future.result()
+                    run.finish_step(index, out)
+                    if not self._step_succeeded(out):
+                        outputs["succeeded"] = False
+                    if out.get("timed_out"):
+                        timed_out.set()
+
+    @staticmethod
+    def _step_succeeded(out: ValueMapping) -> bool:
+        succeeded = out.get("succeeded", True)
+        return succeeded is None or bool(succeeded)
 
     def execute_workflow_step(
         self,
@@ -245,41 +970,516 @@ class Runner:
         outputs: ValueMapping,
         before_each: WorkflowCallback | None = None,
         after_each: WorkflowCallback | None = None,
+        deadline: float | None = None,
+        run_id: str | None = None,
+    ) -> ValueMapping:
+        """
+        Execute a workflow step and store its outputs.
+
+        `deadline` is the `time.monotonic()` value by which the step
+        must have finished, if any.
+        """
+        if step.matrix is not None:
+            instances = self._matrix_instances(step, inputs, outputs)
+            max_parallel = step.max_parallel or self.jobs
+            limiter = self._create_limiter(step.adaptive, max_parallel)
+            results = self._execute_instances(
+                instances,
+                len(instances),
+                max_parallel,
+                step.fail_fast,
+                inputs,
+                outputs,
+                before_each,
+                after_each,
+                limiter,
+                deadline,
+                run_id,
+            )
+            out = self._matrix_outputs(instances, results)
+            if limiter is not None:
+                out["adaptive"] = limiter.report()
+        elif step.for_each is not None:
+            batches = self._for_each_batches(step, inputs, outputs)
+            max_parallel = step.parallel or self.jobs
+            limiter = self._create_limiter(step.adaptive, max_parallel)
+            results = self._execute_instances(
+                self._for_each_instances(step, batches),
+                len(batches),
+                max_parallel,
+                step.fail_fast,
+                inputs,
+                outputs,
+                before_each,
+                after_each,
+                limiter,
+                deadline,
+                run_id,
+            )
+            out = self._for_each_outputs(step, batches, results)
+            if limiter is not None:
+                out["adaptive"] = limiter.report()
+        else:
+            out = self._execute_step(
+                step,
+                inputs,
+                outputs,
+                before_each,
+                after_each,
+                None,
+                deadline,
+                run_id,
+            )
+        assert isinstance(outputs["steps"], dict)
+        assert step.id is not None
+        outputs["steps"][step.id] = out
+        return out
+
+    def _execute_step(
+        self,
+        step: WorkflowStep,
+        inputs: ValueMapping,
+        outputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        variables: ValueMapping | None = None,
+        deadline: float | None = None,
+        run_id: str | None = None,
     ) -> ValueMapping:
-        step.params = {k: self._substitute(v, inputs) for k, v in step.params.items()}
-        if before_each:
-            before_each(step, step.params)
+        # The condition comes first, so that the parameters
+        # of skipped steps are never substituted.
+        timeout = _step_timeout(step.timeout, deadline)
         if step.condition is not None and not self.evaluate_condition(
-            step.condition, inputs, outputs
+            step.condition, inputs, outputs, variables, deadline
         ):
+            if before_each:
+                before_each(step, {})
             out = {"succeeded": None}
         else:
-            if step.type == "script":
-                assert step.do is not None
-                out = self.execute_script(step.do, step.params)
-            elif step.type == "shell":
-                assert step.run is not None
-                out = self.execute_shell(step.run, step.params)
-            elif step.type == "python":
-                assert step.py is not None
-                out = self.execute_python(step.py, step.params, outputs["steps"])
-            elif step.type == "workflow":
-                assert step.workflow is not None
-                out = self.execute_workflow(
-                    step.workflow, step.params, before_each, after_each
-                )
+            params = self._substitute_params(step, inputs, outputs, variables)
+            if before_each:
+                before_each(step, params)
+            namespace = (
+                self._step_namespace(inputs, outputs, variables)
+                if step.cache or step.concurrency
+                else {}
+            )
+            key = self._cache_key(step, params, namespace) if step.cache else None
+            cached = self.cache.get(key) if key is not None else None
+            if cached is not None:
+                out = {**cached, "cached": True}
+            elif timeout is not None and timeout <= 0:
+                out = {"succeeded": False, "timed_out": True}
             else:
-                raise ValueError("unknown step type")  # pragma: no cover
+                # Waiting for a turn in the group counts against the timeout.
+                expires = None if timeout is None else time.monotonic() + timeout
+                with self._concurrency_slot(
+                    step.concurrency, namespace, timeout
+                ) as slot:
+                    if slot is not None and slot.get("timed_out"):
+                        out = {"succeeded": False, "timed_out": True}
+                    else:
+                        out = self._run_step(
+                            step,
+                            params,
+                            outputs,
+                            before_each,
+                            after_each,
+                            _step_timeout(None, expires),
+                            run_id,
+                        )
+                if key is not None:
+                    self._store_cached(step, key, out)
+                if slot is not None:
+                    out["concurrency"] = slot
 
-        assert isinstance(outputs["steps"], dict)
-        assert step.id is not None
-        outputs["steps"][step.id] = out
         if after_each:
             after_each(step, out)
         return out
 
+    def _run_step(
+        self,
+        step: WorkflowStep,
+        params: ValueMapping,
+        outputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        timeout: float | None = None,
+        run_id: str | None = None,
+    ) -> ValueMapping:
+        if step.type == "script":
+            assert step.do is not None
+            return self.execute_script(step.do, params, timeout, step.warm)
+        elif step.type == "shell":
+            assert step.run is not None
+            return self.execute_shell(step.run, params, timeout)
+        elif step.type == "python":
+            assert step.py is not None
+            return self.execute_python(step.py, params, outputs["steps"])
+        elif step.type == "workflow":
+            assert step.workflow is not None
+            if run_id is not None:
+                run_id = child_run_id(run_id, str(step.id))
+            return self.execute_workflow(
+                step.workflow, params, before_each, after_each, timeout, run_id
+            )
+        else:
+            raise ValueError("unknown step type")  # pragma: no cover
+
+    def _cache_key(
+        self, step: WorkflowStep, params: ValueMapping, namespace: ValueMapping
+    ) -> str:
+        """
+        Compute the key to cache the outputs of a step under.
+        """
+        settings = step.cache if isinstance(step.cache, StepCache) else StepCache()
+        material: ValueMapping = {
+            "type": step.type,
+            "do": step.do,
+            "run": step.run,
+            "params": params,
+            "location": self.transport.location(),
+        }
+        if step.do is not None:
+            # The script file includes its metadata, and so its dependencies.
+            material["script"] = _file_digest(self._get_script_filename(step.do))
+        files: dict[str, str | None] = {}
+        for pattern in settings.files:
+            pattern = str(self._substitute(pattern, namespace))
+            matches = glob.glob(pattern, root_dir=self.base_path, recursive=True)
+            if not matches:
+                files[pattern] = None
+            for match in sorted(matches):
+                path = self.base_path / match
+                if path.is_file():
+                    files[match] = _file_digest(path)
+        material["files"] = files
+        data = json.dumps(material, sort_keys=True, default=repr)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _store_cached(self, step: WorkflowStep, key: str, out: ValueMapping) -> None:
+        # Only successful outputs are worth reusing.
+        if out.get("succeeded", True) is not True:
+            return
+        ttl = step.cache.ttl if isinstance(step.cache, StepCache) else None
+        try:
+            self.cache.put(key, out, ttl)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Failed to cache the outputs of step %s: %s", step.id, e)
+
+    def _execute_instances(
+        self,
+        instances: Iterable[tuple[WorkflowStep, ValueMapping]],
+        count: int,
+        max_parallel: int,
+        fail_fast: bool,
+        inputs: ValueMapping,
+        outputs: ValueMapping,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        limiter: AdaptiveLimiter | None = None,
+        deadline: float | None = None,
+        run_id: str | None = None,
+    ) -> list[ValueMapping | None]:
+        """
+        Run the instances of a matrix or `for_each` step.
+
+        Each instance comes with the variables to substitute it with.
+        """
+        return self._execute_limited(
+            (
+                functools.partial(
+                    self._execute_step,
+                    instance,
+                    inputs,
+                    outputs,
+                    before_each,
+                    after_each,
+                    variables,
+                    deadline,
+                    run_id,
+                )
+                for instance, variables in instances
+            ),
+            count,
+            max_parallel,
+            fail_fast,
+            limiter,
+        )
+
+    def _execute_limited(
+        self,
+        calls: Iterable[Callable[[], ValueMapping]],
+        count: int,
+        max_parallel: int,
+        fail_fast: bool = False,
+        limiter: AdaptiveLimiter | None = None,
+    ) -> list[ValueMapping | None]:
+        """
+        Make calls in threads, up to `max_parallel` at a time,
+        or as many as the limiter allows.
+
+        No more calls are started once one fails if `fail_fast` is set,
+        or once the circuit breaker of the limiter trips.
+        Returns the outputs in the order of the calls,
+        with None for the calls that were not started.
+        """
+        results: list[ValueMapping | None] = [None] * count
+        pending = enumerate(calls)
+        running: dict[Future, tuple[int, float]] = {}
+        stopped = False
+        with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+            while True:
+                if not stopped:
+                    limit = max_parallel if limiter is None else limiter.limit
+                    free = max(limit - len(running), 0)
+                    for index, call in itertools.islice(pending, free):
+                        future = pool.submit(contextvars.copy_context().run, call)
+                        running[future] = (index, time.monotonic())
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, started = running.pop(future)
+                    out = results[index] = future.result()
+                    succeeded = self._step_succeeded(out)
+                    if limiter is not None:
+                        limiter.record(time.monotonic() - started, succeeded)
+                        if limiter.tripped:
+                            stopped = True
+                    if fail_fast and not succeeded:
+                        stopped = True
+        return results
+
+    def _create_limiter(
+        self, adaptive: bool | AdaptiveConcurrency, max_parallel: int
+    ) -> AdaptiveLimiter | None:
+        if not adaptive:
+            return None
+        if not isinstance(adaptive, AdaptiveConcurrency):
+            adaptive = AdaptiveConcurrency()
+        return AdaptiveLimiter(
+            max_parallel,
+            min_limit=adaptive.min_parallel,
+            initial=adaptive.initial,
+            latency_tolerance=adaptive.latency_tolerance,
+            error_threshold=adaptive.error_threshold,
+            window=adaptive.window,
+        )
+
+    def _matrix_instances(
+        self, step: WorkflowStep, inputs: ValueMapping, outputs: ValueMapping
+    ) -> list[tuple[WorkflowStep, ValueMapping]]:
+        """
+        Expand a matrix step into one step for each combination of its values.
+
+        The ID of each step is the ID of the matrix step
+        followed by the values of its combination.
+        """
+        assert step.matrix is not None
+        namespace = self._step_namespace(inputs, outputs)
+        axes = {}
+        for key, values in step.matrix.items():
+            values = self._substitute(values, namespace)
+            if not isinstance(values, list):
+                raise ValueError(
+                    f"Matrix value {key} of step {step.id} must be a list,"
+                    f" got {values!r}"
+                )
+            axes[key] = values
+        instances = []
+        for combination in itertools.product(*axes.values()):
+            suffix = "-".join(str(value) for value in combination)
+            instance = step.model_copy(
+                update={
+                    "id": f"{step.id}-{suffix}",
+                    "matrix": None,
+                    "max_parallel": None,
+                }
+            )
+            # A key that is not an axis of the matrix is an error.
+            variables = {"matrix": wrap(dict(zip(axes, combination)), strict=True)}
+            instances.append((instance, variables))
+        return instances
+
+    def _matrix_outputs(
+        self,
+        instances: list[tuple[WorkflowStep, ValueMapping]],
+        results: list[ValueMapping | None],
+    ) -> ValueMapping:
+        """
+        Combine the outputs of the combinations of a matrix step.
+        """
+        return {
+            "succeeded": _combined_status(results),
+            "instances": {
+                instance.id: out
+                for (instance, _), out in zip(instances, results)
+                if out is not None
+            },
+        }
+
+    def _for_each_batches(
+        self, step: WorkflowStep, inputs: ValueMapping, outputs: ValueMapping
+    ) -> list[list]:
+        """
+        Split the items of a `for_each` step into the batches to run it with.
+        """
+        namespace = self._step_namespace(inputs, outputs)
+        items = self._substitute(step.for_each, namespace)
+        if not isinstance(items, list):
+            raise ValueError(
+                f"The items of step {step.id} must be a list, got {items!r}"
+            )
+        size = step.batch_size or 1
+        return [items[start : start + size] for start in range(0, len(items), size)]
+
+    def _for_each_instances(
+        self, step: WorkflowStep, batches: list[list]
+    ) -> Iterator[tuple[WorkflowStep, ValueMapping]]:
+        """
+        Generate one step for each batch of items of a `for_each` step.
+
+        The ID of each step is the ID of the `for_each` step
+        followed by the index of its batch.
+        The steps are created as they are started,
+        so that long lists of items do not create many steps up front.
+        """
+        for index, batch in enumerate(batches):
+            instance = step.model_copy(
+                update={
+                    "id": f"{step.id}-{index}",
+                    "for_each": None,
+                    "batch_size": None,
+                    "parallel": None,
+                }
+            )
+            if step.batch_size is None:
+                variables = {"item": wrap(batch[0], strict=True)}
+            else:
+                variables = {"batch": wrap(batch, strict=True)}
+            yield instance, variables
+
+    def _for_each_outputs(
+        self,
+        step: WorkflowStep,
+        batches: list[list],
+        results: list[ValueMapping | None],
+    ) -> ValueMapping:
+        """
+        Combine the outputs of the runs of a `for_each` step
+        into one result for each item.
+
+        Without a batch size, the result of an item is the output of its run.
+        Otherwise, it is the matching entry of the `results` output of its batch,
+        or just whether the batch succeeded, and the remaining batch outputs
+        are listed separately.
+        The result of an item that was not started is None.
+        """
+        out: ValueMapping = {"succeeded": _combined_status(results)}
+        if step.batch_size is None:
+            out["results"] = results
+            return out
+        items: list[ValueMapping | None] = []
+        batch_outputs: list[ValueMapping | None] = []
+        for batch, result in zip(batches, results):
+            if result is None:
+                items.extend([None] * len(batch))
+                batch_outputs.append(None)
+                continue
+            result = dict(result)
+            item_results = result.pop("results", None)
+            if not isinstance(item_results, list) or len(item_results) != len(batch):
+                item_results = [
+                    {"succeeded": result.get("succeeded", True)} for _ in batch
+                ]
+            items.extend(item_results)
+            batch_outputs.append(result)
+        out["results"] = items
+        out["batches"] = batch_outputs
+        return out
+
+    def _step_namespace(
+        self,
+        inputs: ValueMapping,
+        outputs: ValueMapping,
+        variables: ValueMapping | None = None,
+    ) -> ValueMapping:
+        # The outputs are viewed rather than copied,
+        # so the namespace costs the same however many outputs there are.
+        namespace = {"steps": AttrView(outputs["steps"]), **inputs}
+        if variables:
+            namespace.update(variables)
+        return namespace
+
+    def _substitute_params(
+        self,
+        step: WorkflowStep,
+        inputs: ValueMapping,
+        outputs: ValueMapping,
+        variables: ValueMapping | None = None,
+    ) -> ValueMapping:
+        template = step.params_template
+        if template.constant:
+            # Building the namespace costs more than the parameters.
+            return template.render({})
+        return template.render(self._step_namespace(inputs, outputs, variables))
+
+    def _concurrency_semaphore(
+        self, concurrency: ConcurrencyGroup, namespace: ValueMapping
+    ) -> GroupSemaphore:
+        group = str(self._substitute(concurrency.group, namespace))
+        return GroupSemaphore(self.state_path / "locks", group, concurrency.limit)
+
+    @contextlib.contextmanager
+    def _concurrency_slot(
+        self,
+        concurrency: ConcurrencyGroup | None,
+        namespace: ValueMapping,
+        timeout: float | None = None,
+    ) -> Iterator[ValueMapping | None]:
+        """
+        Wait for a turn in a concurrency group and hold it until the block exits.
+
+        Yields the group and how many seconds were spent waiting,
+        or None without a concurrency group.
+        If no turn came within `timeout` seconds, `timed_out` is set
+        and the block runs without holding one.
+        A group that an enclosing workflow or step holds is entered
+        without waiting, since the turn is already taken.
+        """
+        if concurrency is None:
+            yield None
+            return
+        semaphore = self._concurrency_semaphore(concurrency, namespace)
+        held = _held_groups.get()
+        key = (str(semaphore.directory), semaphore.group)
+        if key in held:
+            yield {"group": semaphore.group, "waited": 0.0}
+            return
+        waited = semaphore.acquire(timeout)
+        if waited is None:
+            assert timeout is not None
+            yield {
+                "group": semaphore.group,
+                "waited": round(timeout, 3),
+                "timed_out": True,
+            }
+            return
+        token = _held_groups.set(held | {key})
+        try:
+            yield {"group": semaphore.group, "waited": round(waited, 3)}
+        finally:
+            _held_groups.reset(token)
+            semaphore.release()
+
     def evaluate_condition(
-        self, cond, inputs: ValueMapping, outputs: ValueMapping
+        self,
+        cond,
+        inputs: ValueMapping,
+        outputs: ValueMapping,
+        variables: ValueMapping | None = None,
+        deadline: float | None = None,
     ) -> bool:
         if isinstance(cond, bool):
             return cond
@@ -287,13 +1487,18 @@ class Runner:
             raise ValueError("Invalid condition type")
 
         env = {
-            "inputs": dotmap.DotMap(inputs),
-            "steps": dotmap.DotMap(outputs["steps"]),
-            "run": lambda cmd: dotmap.DotMap(self.execute_shell(cmd, {})),
-            "isfile": os.path.isfile,
-            "isdir": os.path.isdir,
-            "exists": os.path.exists,
+            "inputs": AttrView(inputs),
+            "steps": AttrView(outputs["steps"]),
+            "run": lambda cmd: dotmap.DotMap(
+                self.execute_shell(cmd, {}, _step_timeout(None, deadline))
+            ),
+            "isfile": lambda path: self.transport.path_exists(path, "f"),
+            "isdir": lambda path: self.transport.path_exists(path, "d"),
+            "exists": lambda path: self.transport.path_exists(path),
             "platform": sys.platform,
+            "time_left": lambda: (
+                math.inf if deadline is None else deadline - time.monotonic()
+            ),
             "changed": (
                 lambda step: bool(
                     outputs.get("steps", {}).get(step, {}).get("changed", False)
@@ -306,5 +1511,170 @@ class Runner:
                 )
             ),
         }
-        code = compile(f"({cond})", "<condition>", "eval")
-        return bool(eval(code, env, {}))
+        if variables:
+            env.update(variables)
+        return bool(compile_expression(cond).evaluate(env))
+
+
+def _statically_false(cond: Any, inputs: ValueMapping) -> bool:
+    """
+    Check whether a condition is false before any step runs,
+    from the inputs of the run alone.
+    """
+    if cond is None:
+        return False
+    if isinstance(cond, bool):
+        return not cond
+    expression = compile_expression(cond)
+    if expression.references != set():
+        return False
+    try:
+        return not expression.evaluate(
+            {"inputs": AttrView(inputs), "platform": sys.platform}
+        )
+    except Exception:
+        # The condition needs more than the inputs, such as `run` or `isfile`.
+        return False
+
+
+def _file_digest(path: Path) -> str | None:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _step_timeout(timeout: float | None, deadline: float | None) -> float | None:
+    """
+    Return the time a step may run for, given its timeout and the deadline.
+    """
+    if deadline is not None:
+        left = deadline - time.monotonic()
+        timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+
+def _batch_size(batch: int | str | None, count: int) -> int:
+    if batch is None:
+        return max(count, 1)
+    if isinstance(batch, str):
+        try:
+            if batch.endswith("%"):
+                batch = int(count * float(batch[:-1]) / 100)
+            else:
+                batch = int(batch)
+        except ValueError:
+            raise ValueError(f"Invalid batch size: {batch}") from None
+        batch = max(batch, 1)
+    if batch < 1:
+        raise ValueError("The batch size must be at least 1")
+    return batch
+
+
+def _group_outputs(results: dict[str, ValueMapping]) -> list[ValueMapping]:
+    """
+    Group the targets with identical outputs, in order of the first target.
+    """
+    groups: dict[str, ValueMapping] = {}
+    for name, out in results.items():
+        key = json.dumps(out, sort_keys=True, default=repr)
+        group = groups.setdefault(key, {"targets": [], "outputs": out})
+        group["targets"].append(name)
+    return list(groups.values())
+
+
+def _combined_status(results: list[ValueMapping | None]) -> bool | None:
+    """
+    Combine the `succeeded` outputs of the instances of a step.
+
+    The step failed if any instance failed or was not started,
+    and is skipped if every instance was skipped.
+    """
+    if any(out is None for out in results):
+        return False
+    statuses = [out.get("succeeded", True) for out in results if out is not None]
+    if statuses and all(status is None for status in statuses):
+        return None
+    return all(status is None or bool(status) for status in statuses)
+
+
+class WorkflowRun:
+    """
+    The state of a single run of a workflow.
+
+    Runners keep everything that changes during a run here,
+    never on themselves or on the workflow definition,
+    so that one runner can execute many workflows at the same time.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        metadata: WorkflowMetadata,
+        inputs: ValueMapping,
+        history: StepHistory,
+        scheduler: StepScheduler,
+        before_each: WorkflowCallback | None = None,
+        after_each: WorkflowCallback | None = None,
+        deadline: float | None = None,
+        run_id: str = "",
+        journal: RunJournal | None = None,
+    ):
+        self.name = name
+        self.metadata = metadata
+        self.inputs = inputs
+        self.history = history
+        self.scheduler = scheduler
+        self.before_each = before_each
+        self.after_each = after_each
+        # The `time.monotonic()` value by which the run must have finished.
+        self.deadline = deadline
+        self.run_id = run_id
+        self.journal = journal
+        self.outputs: ValueMapping = {"succeeded": True, "steps": {}}
+
+    def start_step(self, index: int) -> WorkflowStep:
+        """
+        Mark a ready step as started and return it.
+        """
+        self.scheduler.start(index)
+        step = self.scheduler.steps[index]
+        if self.journal is not None:
+            self.journal.record("start", step=step.id, index=index)
+        return step
+
+    def finish_step(self, index: int, out: ValueMapping) -> None:
+        """
+        Mark a started step as finished with its outputs.
+        """
+        self.scheduler.finish(index)
+        step = self.scheduler.steps[index]
+        self.outputs["steps"][step.id] = out
+        if self.journal is not None:
+            self.journal.record("finish", step=step.id, index=index, outputs=out)
+
+    def expired(self) -> bool:
+        """
+        Check whether the deadline of the run has passed.
+        """
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self) -> float | None:
+        """
+        Return the number of seconds left until the deadline of the run, if any.
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def snapshot(self) -> ValueMapping:
+        """
+        Return a copy of the outputs for a step that runs alongside others.
+        """
+        return {"steps": dict(self.outputs["steps"])}
+
+    def close(self) -> None:
+        self.scheduler.release_resources()
+        if self.journal is not None:
+            self.journal.close()
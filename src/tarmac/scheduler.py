@@ -0,0 +1,362 @@
+import time
+
+from pydantic import BaseModel, Field
+
+from .metadata import StepResources, WorkflowStep
+from .resources import ResourcePool
+
+
+def resolve_dependencies(
+    steps: list[WorkflowStep], references: list[set[str] | None] | None = None
+) -> list[set[int]]:
+    """
+    Resolve the dependencies of each workflow step to step indices.
+
+    Without `references`, a step without `needs` depends on the step
+    declared before it, so that workflows keep running in declaration order.
+
+    With `references` (see `tarmac.analysis.infer_references`), a step
+    depends on the earlier steps whose outputs it reads, in addition to its
+    `needs`. A step whose references are None is a barrier: it depends on
+    every earlier step and every later step depends on it.
+
+    When any step has `needs` or `references` are given, dependencies are
+    found by step ID, so no two steps may have the same non-empty ID.
+    """
+    by_id = references is not None or any(step.needs is not None for step in steps)
+    ids = {}
+    for index, step in enumerate(steps):
+        if by_id and step.id and step.id in ids:
+            raise ValueError(f"Duplicate step ID {step.id}")
+        ids[step.id] = index
+    dependencies = []
+    earlier: dict[str | None, int] = {}
+    barriers: list[int] = []
+    for index, step in enumerate(steps):
+        deps = set()
+        if references is not None:
+            refs = references[index]
+            if refs is None:
+                deps.update(range(index))
+            else:
+                deps.update(earlier[ref] for ref in refs if ref in earlier)
+            deps.update(barriers)
+        elif step.needs is None:
+            deps.update({index - 1} if index > 0 else set())
+        if step.needs is not None:
+            needs = [step.needs] if isinstance(step.needs, str) else step.needs
+            for need in needs:
+                if need not in ids:
+                    raise ValueError(f"Step {step.id} needs unknown step {need}")
+                if ids[need] == index:
+                    raise ValueError(f"Step {step.id} cannot need itself")
+                deps.add(ids[need])
+        if references is not None and references[index] is None:
+            barriers.append(index)
+        dependencies.append(deps)
+        earlier[step.id] = index
+    _topological_order(steps, dependencies)
+    return dependencies
+
+
+def _topological_order(
+    steps: list[WorkflowStep], dependencies: list[set[int]]
+) -> list[int]:
+    order = []
+    remaining = {index: set(deps) for index, deps in enumerate(dependencies)}
+    while remaining:
+        ready = [index for index, deps in remaining.items() if not deps]
+        if not ready:
+            cycle = ", ".join(str(steps[index].id) for index in sorted(remaining))
+            raise ValueError(f"Dependency cycle between steps: {cycle}")
+        for index in ready:
+            del remaining[index]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+        order.extend(ready)
+    return order
+
+
+class StepSelection(BaseModel):
+    """
+    Selects the workflow steps to run, by step ID or tag.
+
+    Each given list narrows the selection: the selected steps match `only`,
+    come at or after a step matching `from`, and at or before
+    a step matching `until`, following the step dependencies.
+    """
+
+    only: list[str] | None = None
+    """
+    The steps to run, and no others.
+    """
+
+    start: list[str] | None = Field(alias="from", default=None)
+    """
+    The steps to start from, along with the steps that depend on them.
+    """
+
+    until: list[str] | None = None
+    """
+    The steps to stop after, along with the steps they depend on.
+    """
+
+    model_config = {
+        "extra": "forbid",
+        "frozen": True,
+        "populate_by_name": True,
+    }
+
+    def select(
+        self, steps: list[WorkflowStep], dependencies: list[set[int]]
+    ) -> set[int]:
+        """
+        Return the indices of the selected steps.
+        """
+        dependents: list[set[int]] = [set() for _ in steps]
+        for index, deps in enumerate(dependencies):
+            for dep in deps:
+                dependents[dep].add(index)
+        selected = set(range(len(steps)))
+        if self.only is not None:
+            selected &= _matching_steps(steps, self.only)
+        if self.start is not None:
+            selected &= _closure(_matching_steps(steps, self.start), dependents)
+        if self.until is not None:
+            selected &= _closure(_matching_steps(steps, self.until), dependencies)
+        return selected
+
+
+def _matching_steps(steps: list[WorkflowStep], patterns: list[str]) -> set[int]:
+    matched = set()
+    for pattern in patterns:
+        found = {
+            index
+            for index, step in enumerate(steps)
+            if step.id == pattern or pattern in step.tags
+        }
+        if not found:
+            raise ValueError(f"No step has the ID or tag {pattern}")
+        matched |= found
+    return matched
+
+
+def _closure(indices: set[int], edges: list[set[int]]) -> set[int]:
+    # The given steps and every step reachable from them.
+    result = set(indices)
+    stack = list(indices)
+    while stack:
+        for other in edges[stack.pop()]:
+            if other not in result:
+                result.add(other)
+                stack.append(other)
+    return result
+
+
+class StepScheduler:
+    """
+    Keeps track of which workflow steps are ready to run.
+
+    A step is ready once all the steps it depends on have finished.
+    Ready steps are handed out longest remaining path first,
+    estimated from the given step durations, then in declaration order.
+    With a resource pool, a step that declares resources can only start
+    while they fit in the pool, or when no other step holds resources.
+    The pool may be shared with other runs, such as those of nested workflows,
+    whose steps take their own resources instead of the step that runs them.
+    """
+
+    def __init__(
+        self,
+        steps: list[WorkflowStep],
+        references: list[set[str] | None] | None = None,
+        durations: dict[str, float] | None = None,
+        resources: ResourcePool | None = None,
+    ):
+        self.steps = steps
+        self.resources = resources
+        self.references = references
+        self.dependencies = resolve_dependencies(steps, references)
+        self.dependents: list[set[int]] = [set() for _ in steps]
+        for index, deps in enumerate(self.dependencies):
+            for dep in deps:
+                self.dependents[dep].add(index)
+        self.estimates = self._estimate_durations(durations or {})
+        self.priorities = self._remaining_path_lengths()
+        self.started_at: dict[int, float] = {}
+        self.finished_at: dict[int, float] = {}
+        self._pending = set(range(len(steps)))
+        self._running: set[int] = set()
+        self._finished: set[int] = set()
+        # The steps whose resources are taken, and the number of releases
+        # of the pool when a step last did not fit.
+        self._holding: set[int] = set()
+        self._releases = 0
+
+    def _estimate_durations(self, durations: dict[str, float]) -> list[float]:
+        # Steps without history are assumed to take an average amount of time.
+        known = [durations[step.id] for step in self.steps if step.id in durations]
+        default = sum(known) / len(known) if known else 0.0
+        return [durations.get(step.id, default) for step in self.steps]
+
+    def _remaining_path_lengths(self) -> list[float]:
+        lengths = [0.0] * len(self.steps)
+        for index in reversed(_topological_order(self.steps, self.dependencies)):
+            lengths[index] = self.estimates[index] + max(
+                (lengths[dep] for dep in self.dependents[index]), default=0.0
+            )
+        return lengths
+
+    @property
+    def running(self) -> set[int]:
+        """
+        The indices of the steps that have been started but not finished.
+        """
+        return set(self._running)
+
+    @property
+    def pending(self) -> list[int]:
+        """
+        The indices of the steps that have not been started, in declaration order.
+        """
+        return sorted(self._pending)
+
+    def ready(self) -> list[int]:
+        """
+        Return the indices of the steps that can be started now,
+        the most urgent first.
+        """
+        return sorted(
+            (
+                index
+                for index in self._pending
+                if self.dependencies[index] <= self._finished
+            ),
+            key=lambda index: (-self.priorities[index], index),
+        )
+
+    def _resources(self, index: int) -> StepResources | None:
+        step = self.steps[index]
+        if self.resources is None or step.type == "workflow":
+            return None
+        return step.resources
+
+    def fits(self, index: int) -> bool:
+        """
+        Check whether the resources of a ready step are available.
+        """
+        resources = self._resources(index)
+        if resources is None:
+            return True
+        assert self.resources is not None
+        return self.resources.fits(resources)
+
+    def reserve(self, index: int) -> bool:
+        """
+        Take the resources of a ready step if they are available,
+        and return whether the step can be started.
+        """
+        resources = self._resources(index)
+        if resources is None or index in self._holding:
+            return True
+        assert self.resources is not None
+        releases = self.resources.releases
+        if not self.resources.try_acquire(resources):
+            self._releases = releases
+            return False
+        self._holding.add(index)
+        return True
+
+    def wait_for_resources(self, timeout: float | None = None) -> None:
+        """
+        Wait until resources are released after a step did not fit,
+        or for at most `timeout` seconds.
+        """
+        if self.resources is not None:
+            self.resources.wait(self._releases, timeout)
+
+    def start(self, index: int) -> None:
+        """
+        Mark a ready step as started, taking its resources if not reserved.
+        """
+        resources = self._resources(index)
+        if resources is not None and index not in self._holding:
+            assert self.resources is not None
+            self.resources.acquire(resources)
+            self._holding.add(index)
+        self._pending.remove(index)
+        self._running.add(index)
+        self.started_at[index] = time.monotonic()
+
+    def finish(self, index: int) -> None:
+        """
+        Mark a started step as finished.
+        """
+        self._release(index)
+        self._running.remove(index)
+        self._finished.add(index)
+        self.finished_at[index] = time.monotonic()
+
+    def _release(self, index: int) -> None:
+        if index in self._holding:
+            self._holding.remove(index)
+            resources = self._resources(index)
+            assert self.resources is not None and resources is not None
+            self.resources.release(resources)
+
+    def release_resources(self) -> None:
+        """
+        Give back the resources of the steps that never finished,
+        such as when the run stops on an error.
+        """
+        for index in list(self._holding):
+            self._release(index)
+
+    def restore(self, index: int) -> None:
+        """
+        Mark a ready step as finished without running it,
+        such as a step whose outputs are replayed from an earlier run.
+        """
+        self._pending.remove(index)
+        self._finished.add(index)
+
+    def durations(self) -> dict[int, float]:
+        """
+        Return how long each finished step took to run.
+        """
+        return {
+            index: self.finished_at[index] - self.started_at[index]
+            for index in self.finished_at
+        }
+
+    def predicted_critical_path(self) -> list[int]:
+        """
+        Return the path through the steps that is expected to take the longest.
+        """
+        roots = [index for index, deps in enumerate(self.dependencies) if not deps]
+        path: list[int] = []
+        candidates = roots
+        while candidates:
+            index = max(candidates, key=lambda i: (self.priorities[i], -i))
+            path.append(index)
+            candidates = list(self.dependents[index])
+        return path
+
+    def actual_critical_path(self) -> list[int]:
+        """
+        Return the chain of finished steps that determined when the run ended.
+
+        Each step in the chain is the dependency of the next step
+        that finished last.
+        """
+        if not self.finished_at:
+            return []
+        index = max(self.finished_at, key=lambda i: self.finished_at[i])
+        path = [index]
+        while deps := [
+            dep for dep in self.dependencies[index] if dep in self.finished_at
+        ]:
+            index = max(deps, key=lambda i: self.finished_at[i])
+            path.append(index)
+        path.reverse()
+        return path
@@ -0,0 +1,49 @@
+import atexit
+import functools
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from . import operations
+
+# The package that scripts import `tarmac.operations` from,
+# so that tarmac does not have to be installed in their environments.
+SHIM_PACKAGE = "tarmac"
+
+
+def shim_files() -> dict[str, str]:
+    """
+    Return the files of the shim package, by path relative to its parent.
+
+    The shim only holds `tarmac.operations`, which only uses the standard library.
+    """
+    with open(operations.__file__) as f:
+        source = f.read()
+    return {
+        f"{SHIM_PACKAGE}/__init__.py": "",
+        f"{SHIM_PACKAGE}/operations.py": source,
+    }
+
+
+@functools.cache
+def shim_directory() -> Path:
+    """
+    Write the shim package to a private directory of this process,
+    and return the directory to add to the path of the interpreter.
+    """
+    directory = Path(tempfile.mkdtemp(prefix="tarmac-shim-"))
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    for name, content in shim_files().items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return directory
+
+
+def python_path(directory: str, env: dict[str, str] | None = None) -> str:
+    """
+    Return the PYTHONPATH of an environment with a directory in front.
+    """
+    existing = (os.environ if env is None else env).get("PYTHONPATH")
+    return directory + os.pathsep + existing if existing else directory
@@ -0,0 +1,143 @@
+import functools
+import re
+from typing import Any, Callable, Iterator, Mapping
+
+from .expressions import Expression, compile_expression
+from .views import unwrap
+
+# The regex for substituting variables in strings.
+# A dollar sign means nothing unless it is followed by an opening brace
+# and preceded by an even number of dollar signs.
+SUBSTITUTION_REGEX = re.compile(r"(\$+)\{([^}]*)\}")
+# The regex for substituting variables as actual values without string interpolation.
+FULL_SUBSTITUTION_REGEX = re.compile(r"^\$\{([^}]*)\}$")
+
+Renderer = Callable[[Mapping[str, Any]], Any]
+
+
+class Template:
+    """
+    A parameter value with `${...}` substitutions, compiled once.
+
+    Compiling splits the strings in the value into literal segments
+    and compiled expressions, so that rendering only evaluates
+    the expressions. A value without substitutions is constant
+    and can be rendered without a namespace.
+    """
+
+    __slots__ = ("value", "_render")
+
+    def __init__(self, value: Any):
+        self.value = value
+        self._render = _compile(value)
+
+    @property
+    def constant(self) -> bool:
+        """
+        Whether the value has no substitutions.
+        """
+        return self._render is None
+
+    def render(self, namespace: Mapping[str, Any]) -> Any:
+        """
+        Return the value with the expressions evaluated in a namespace.
+
+        Lists and dictionaries are always new objects.
+        """
+        if self._render is None:
+            return _copy(self.value)
+        return self._render(namespace)
+
+
+def template_expressions(value: Any) -> Iterator[str]:
+    """
+    Find the source of the expressions substituted in a value.
+    """
+    if isinstance(value, str):
+        if m := FULL_SUBSTITUTION_REGEX.match(value):
+            yield m.group(1)
+            return
+        for match in SUBSTITUTION_REGEX.finditer(value):
+            if len(match.group(1)) % 2 == 1:
+                yield match.group(2)
+    elif isinstance(value, list):
+        for item in value:
+            yield from template_expressions(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from template_expressions(item)
+
+
+def substitute(value: Any, namespace: Mapping[str, Any]) -> Any:
+    """
+    Substitute the expressions in a value that is only used once.
+    """
+    return Template(value).render(namespace)
+
+
+def _copy(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    return value
+
+
+def _compile(value: Any) -> Renderer | None:
+    # Returns None for values without substitutions.
+    if isinstance(value, str):
+        return _compile_string(value)
+    if isinstance(value, list):
+        items = [(item, _compile(item)) for item in value]
+        if all(render is None for _, render in items):
+            return None
+        return lambda namespace: [
+            _copy(item) if render is None else render(namespace)
+            for item, render in items
+        ]
+    if isinstance(value, dict):
+        entries = [(key, item, _compile(item)) for key, item in value.items()]
+        if all(render is None for _, _, render in entries):
+            return None
+        return lambda namespace: {
+            key: _copy(item) if render is None else render(namespace)
+            for key, item, render in entries
+        }
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_string(s: str) -> Renderer | None:
+    if m := FULL_SUBSTITUTION_REGEX.match(s):
+        expression = compile_expression(m.group(1))
+        return lambda namespace: unwrap(expression.evaluate(namespace))
+
+    parts: list[str | Expression] = []
+    position = 0
+    for match in SUBSTITUTION_REGEX.finditer(s):
+        parts.append(s[position : match.start()])
+        position = match.end()
+        escape_len = len(match.group(1))
+        parts.append("$" * (escape_len // 2))
+        if escape_len % 2 == 0:
+            parts.append("{" + match.group(2) + "}")
+        else:
+            parts.append(compile_expression(match.group(2)))
+    if position == 0:
+        return None
+    parts.append(s[position:])
+
+    # Merge the adjacent literal segments.
+    segments: list[str | Expression] = []
+    for part in parts:
+        if isinstance(part, str) and segments and isinstance(segments[-1], str):
+            segments[-1] += part
+        elif part != "":
+            segments.append(part)
+    if all(isinstance(segment, str) for segment in segments):
+        literal = "".join(segments)  # type: ignore[arg-type]
+        return lambda namespace: literal
+    return lambda namespace: "".join(
+        segment if isinstance(segment, str) else str(segment.evaluate(namespace))
+        for segment in segments
+    )
@@ -0,0 +1,557 @@
+import contextlib
+import contextvars
+import hashlib
+import json
+import math
+import os
+import shlex
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import IO, Iterator, NamedTuple
+
+from uv import find_uv_bin
+
+from .metadata import ValueMapping
+from .shim import python_path, shim_directory, shim_files
+
+
+class CommandResult(NamedTuple):
+    """
+    The result of running commands through a transport.
+    """
+
+    returncode: int
+    stdout: str
+    stderr: str
+    timed_out: bool = False
+
+
+# The events that stop the commands run in the current context as if they
+# timed out, such as when a step running next to them in a run times out.
+_cancel_events: contextvars.ContextVar[tuple[threading.Event, ...]] = (
+    contextvars.ContextVar("_cancel_events", default=())
+)
+
+# How often a command that can be cancelled checks whether it was, in seconds.
+CANCEL_POLL_INTERVAL = 0.05
+
+
+@contextlib.contextmanager
+def cancel_on(event: threading.Event) -> Iterator[None]:
+    """
+    Stop the commands run in this context, and in the threads and tasks
+    started from it, once `event` is set.
+    """
+    token = _cancel_events.set(_cancel_events.get() + (event,))
+    try:
+        yield
+    finally:
+        _cancel_events.reset(token)
+
+
+def cancelled() -> bool:
+    """
+    Check whether the commands run in this context were cancelled.
+    """
+    return any(event.is_set() for event in _cancel_events.get())
+
+
+def wait_interval(deadline: float | None) -> float | None:
+    """
+    Return how long to wait for a command before checking again
+    whether it was cancelled or its deadline passed.
+    """
+    left = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+    if _cancel_events.get():
+        left = CANCEL_POLL_INTERVAL if left is None else min(left, CANCEL_POLL_INTERVAL)
+    return left
+
+
+def kill_process_group(p) -> None:
+    """
+    Kill a process started in a new session, along with its children,
+    such as the Python interpreter started by `uv run`.
+    """
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(p.pid, signal.SIGKILL)
+        else:  # pragma: no cover
+            p.kill()
+    except ProcessLookupError:  # pragma: no cover
+        pass
+
+
+def communicate(
+    p: subprocess.Popen, stdin: str | None = None, timeout: float | None = None
+) -> tuple[str, str, bool]:
+    """
+    Wait for a process started in a new session and return its output.
+
+    If the process takes longer than `timeout` seconds, is cancelled
+    (see `cancel_on`), or the wait is interrupted, its process group is killed.
+    The returned flag tells whether the process timed out or was cancelled,
+    in which case the output is partial.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                stdout, stderr = p.communicate(stdin, timeout=wait_interval(deadline))
+                break
+            except subprocess.TimeoutExpired:
+                if cancelled() or (
+                    deadline is not None and time.monotonic() >= deadline
+                ):
+                    raise
+            # The input was sent by the first call.
+            stdin = None
+    except subprocess.TimeoutExpired:
+        kill_process_group(p)
+        stdout, stderr = p.communicate()
+        return stdout, stderr, True
+    except BaseException:
+        kill_process_group(p)
+        p.wait()
+        raise
+    return stdout, stderr, False
+
+
+class Transport:
+    """
+    Runs the commands of a runner, either locally or on another host.
+
+    Subclasses implement `run_shell` and `run_script`.
+    """
+
+    cwd: str | None = None
+
+    def run_shell(
+        self,
+        commands: list[str],
+        env: dict[str, str],
+        cwd: str | None = None,
+        stdin: str | None = None,
+        timeout: float | None = None,
+    ) -> CommandResult:
+        """
+        Run shell commands one after the other, until one of them fails.
+
+        `env` is added to the environment of the commands,
+        `cwd` is relative to the working directory of the transport,
+        and `stdin` is passed to the first command only.
+        The commands are killed once they took `timeout` seconds in total.
+        The result has the output of all commands run
+        and the return code of the last one.
+        """
+        raise NotImplementedError
+
+    def run_script(
+        self,
+        script: Path,
+        uv_args: list[str],
+        inputs: ValueMapping,
+        timeout: float | None = None,
+    ) -> tuple[CommandResult, str]:
+        """
+        Run a script with uv, killing it after `timeout` seconds.
+
+        Returns the result of the command and the contents of its outputs file.
+        """
+        raise NotImplementedError
+
+    def location(self) -> str:
+        """
+        Describe where the commands run, so that cached step outputs
+        from one place are not reused in another.
+        """
+        raise NotImplementedError
+
+    def path_exists(self, path: str, kind: str = "e") -> bool:
+        """
+        Check whether a path exists, like `test -e` (or `-f` or `-d`).
+        """
+        result = self.run_shell([f"test -{kind} {shlex.quote(path)}"], {})
+        return result.returncode == 0
+
+    def close(self) -> None:
+        """
+        Release any connections held by the transport.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalTransport(Transport):
+    """
+    Runs commands on this machine.
+    """
+
+    def __init__(self, cwd: str | Path | None = None):
+        self.cwd = str(Path(cwd).absolute()) if cwd is not None else None
+        self._uv_bin = None
+
+    def _find_uv_bin(self):
+        if not self._uv_bin:
+            self._uv_bin = find_uv_bin()
+        return self._uv_bin
+
+    def location(self) -> str:
+        return f"local:{self.cwd or os.getcwd()}"
+
+    def resolve_cwd(self, cwd: str | None) -> str | None:
+        if self.cwd is None:
+            return cwd
+        return os.path.join(self.cwd, cwd) if cwd else self.cwd
+
+    def run_shell(
+        self,
+        commands: list[str],
+        env: dict[str, str],
+        cwd: str | None = None,
+        stdin: str | None = None,
+        timeout: float | None = None,
+    ) -> CommandResult:
+        full_env = os.environ.copy()
+        full_env.update(env)
+        cwd = self.resolve_cwd(cwd)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        returncode = 0
+        stdout = stderr = ""
+        for command in commands:
+            p = subprocess.Popen(
+                command,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                stdin=subprocess.PIPE if stdin else None,
+                text=True,
+                env=full_env,
+                cwd=cwd,
+                encoding="utf-8",
+                errors="replace",
+                start_new_session=True,
+            )
+            left = None if deadline is None else max(deadline - time.monotonic(), 0)
+            out, err, timed_out = communicate(p, stdin, left)
+            stdin = None  # only pass stdin to the first command
+            returncode = p.returncode
+            stdout += out
+            stderr += err
+            if timed_out:
+                return CommandResult(returncode, stdout, stderr, True)
+            if returncode != 0:
+                break
+        return CommandResult(returncode, stdout, stderr)
+
+    def script_command(
+        self, script: Path, uv_args: list[str], python: str | None = None
+    ) -> list[str]:
+        """
+        Return the command that runs a script with uv,
+        or directly with the interpreter of a prebuilt environment.
+        """
+        if python is not None:
+            return [python, str(script.absolute())]
+        return [self._find_uv_bin(), *uv_args, str(script.absolute())]
+
+    def run_script(
+        self,
+        script: Path,
+        uv_args: list[str],
+        inputs: ValueMapping,
+        timeout: float | None = None,
+        python: str | None = None,
+    ) -> tuple[CommandResult, str]:
+        with script_files(inputs) as (env, outputs_file):
+            p = subprocess.Popen(
+                self.script_command(script, uv_args, python),
+                env=env,
+                cwd=self.cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                start_new_session=True,
+            )
+            stdout, stderr, timed_out = communicate(p, timeout=timeout)
+            outputs_file.seek(0)
+            outputs = outputs_file.read().decode("utf-8", errors="replace")
+        return CommandResult(p.returncode, stdout, stderr, timed_out), outputs
+
+    def sync_script(self, script: Path, uv_args: list[str]) -> CommandResult:
+        """
+        Set up the environment that uv runs a script in, without running it.
+        """
+        p = subprocess.run(
+            [self._find_uv_bin(), *uv_args, str(script.absolute())],
+            cwd=self.cwd,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+        )
+        return CommandResult(p.returncode, p.stdout, p.stderr)
+
+    def path_exists(self, path: str, kind: str = "e") -> bool:
+        path = self.resolve_cwd(path) or path
+        if kind == "f":
+            return os.path.isfile(path)
+        if kind == "d":
+            return os.path.isdir(path)
+        return os.path.exists(path)
+
+
+@contextlib.contextmanager
+def script_files(inputs: ValueMapping) -> Iterator[tuple[dict[str, str], IO[bytes]]]:
+    """
+    Create the files for passing inputs to and outputs from a local script.
+
+    Yields the environment to run the script with and the outputs file.
+    """
+    with (
+        tempfile.NamedTemporaryFile(mode="wb") as inputs_file,
+        tempfile.NamedTemporaryFile(mode="w+b") as outputs_file,
+    ):
+        os.chmod(inputs_file.name, 0o600)
+        os.chmod(outputs_file.name, 0o600)
+        inputs_file.write(json.dumps(inputs).encode("utf-8"))
+        inputs_file.flush()
+        inputs_file.seek(0)
+        outputs_file.write(b"{}")
+        outputs_file.flush()
+        env = os.environ.copy()
+        env["PYTHONPATH"] = python_path(str(shim_directory()), env)
+        env["TARMAC_INPUTS_FILE"] = inputs_file.name
+        env["TARMAC_OUTPUTS_FILE"] = outputs_file.name
+        yield env, outputs_file
+
+
+class SSHTransport(Transport):
+    """
+    Runs commands on another host over SSH.
+
+    All commands share one multiplexed connection to the host
+    (OpenSSH's ControlMaster), which stays open until `close` is called,
+    or `persist` seconds after the last command.
+    The commands of a shell step, or a script with its inputs and outputs,
+    are sent to the host in a single round trip. Scripts are sent
+    on the standard input of the remote shell, so that their size and the size
+    of their inputs are not limited by the length of a command line.
+    When commands time out, both the local ssh process and,
+    where the host has coreutils `timeout`, the commands on the host are killed.
+    """
+
+    # The uv command on the host.
+    uv_command = "uv"
+
+    def __init__(
+        self,
+        host: str,
+        user: str | None = None,
+        port: int | None = None,
+        cwd: str | None = None,
+        ssh_options: list[str] | None = None,
+        persist: int = 60,
+        control_dir: str | Path | None = None,
+    ):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.cwd = cwd
+        self.ssh_options = list(ssh_options or [])
+        self.persist = persist
+        # Unix socket paths are short, so the control socket name is a hash.
+        key = hashlib.sha1(f"{user}@{host}:{port}".encode()).hexdigest()[:16]
+        self.control_path = str(
+            Path(control_dir or tempfile.gettempdir()) / f"tarmac-ssh-{key}"
+        )
+
+    def location(self) -> str:
+        return f"ssh:{self.user or ''}@{self.host}:{self.port or ''}:{self.cwd or ''}"
+
+    def _ssh_args(self) -> list[str]:
+        args = [
+            "ssh",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_path}",
+            "-o",
+            f"ControlPersist={self.persist}",
+            "-o",
+            "BatchMode=yes",
+        ]
+        if self.user:
+            args.extend(["-l", self.user])
+        if self.port:
+            args.extend(["-p", str(self.port)])
+        args.extend(self.ssh_options)
+        args.append(self.host)
+        return args
+
+    def _remote_command(self, command: str) -> list[str]:
+        """
+        Return the command that runs a POSIX shell command line on the host.
+        """
+        return [*self._ssh_args(), command]
+
+    def _run(
+        self,
+        script: str,
+        stdin: str | None = None,
+        timeout: float | None = None,
+        script_on_stdin: bool = False,
+    ) -> CommandResult:
+        """
+        Run a POSIX shell script on the host, passed on the command line,
+        or on the standard input when the script does not read it.
+        """
+        if script_on_stdin:
+            assert stdin is None
+            shell, stdin = "sh -s", script
+        else:
+            shell = "sh -c " + shlex.quote(script)
+        command = shell
+        if timeout is not None:
+            # Also stop the commands on the host, if it has coreutils `timeout`,
+            # which kills the whole process group of the commands.
+            seconds = max(math.ceil(timeout), 1)
+            command = (
+                "if command -v timeout >/dev/null 2>&1; then"
+                f" exec timeout -s KILL {seconds} {shell}; fi; exec {shell}"
+            )
+        p = subprocess.Popen(
+            self._remote_command(command),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            start_new_session=True,
+        )
+        stdout, stderr, timed_out = communicate(p, stdin, timeout)
+        return CommandResult(p.returncode, stdout, stderr, timed_out)
+
+    def _prelude(self, env: dict[str, str], cwd: str | None) -> list[str]:
+        lines = []
+        directory = cwd
+        if self.cwd is not None:
+            directory = os.path.join(self.cwd, cwd) if cwd else self.cwd
+        if directory:
+            lines.append(f"cd {shlex.quote(directory)} || exit 1")
+        for key, value in env.items():
+            if not key.isidentifier():
+                raise ValueError(f"Invalid environment variable name: {key}")
+            lines.append(f"export {key}={shlex.quote(str(value))}")
+        return lines
+
+    def shell_script(
+        self, commands: list[str], env: dict[str, str], cwd: str | None = None
+    ) -> str:
+        """
+        Return the script that runs shell commands one after the other
+        until one fails. Only the first command reads the standard input.
+        """
+        lines = self._prelude(env, cwd)
+        for index, command in enumerate(commands):
+            redirect = "" if index == 0 else " </dev/null"
+            lines.append(f"sh -c {shlex.quote(command)}{redirect} || exit $?")
+        return "\n".join(lines)
+
+    def run_shell(
+        self,
+        commands: list[str],
+        env: dict[str, str],
+        cwd: str | None = None,
+        stdin: str | None = None,
+        timeout: float | None = None,
+    ) -> CommandResult:
+        return self._run(self.shell_script(commands, env, cwd), stdin, timeout)
+
+    def script_script(
+        self, script: str, uv_args: list[str], inputs: ValueMapping, marker: str
+    ) -> str:
+        """
+        Return the script that runs a Python script with uv on the host
+        and prints its outputs file after the marker.
+
+        The files are written with here-documents, since the script
+        is read from the standard input of the remote shell.
+        """
+        # The script imports `tarmac.operations` from its own directory.
+        files = {
+            "script.py": script,
+            **shim_files(),
+            "inputs.json": json.dumps(inputs),
+        }
+        lines = [
+            "dir=$(mktemp -d) || exit 1",
+            "trap 'rm -rf \"$dir\"' EXIT",
+        ]
+        for name, content in files.items():
+            if os.path.dirname(name):
+                lines.append(f'mkdir -p "$dir/{os.path.dirname(name)}" || exit 1')
+            lines.extend(_here_document(f'"$dir/{name}"', content))
+        lines += [
+            "printf '{}' > \"$dir/outputs.json\"",
+            *self._prelude({}, None),
+            'TARMAC_INPUTS_FILE="$dir/inputs.json"'
+            ' TARMAC_OUTPUTS_FILE="$dir/outputs.json"'
+            f" {shlex.quote(self.uv_command)} {shlex.join(uv_args)}"
+            ' "$dir/script.py" </dev/null',
+            "rc=$?",
+            f"printf '\\n%s\\n' {shlex.quote(marker)}",
+            'cat "$dir/outputs.json"',
+            'exit "$rc"',
+        ]
+        return "\n".join(lines)
+
+    def run_script(
+        self,
+        script: Path,
+        uv_args: list[str],
+        inputs: ValueMapping,
+        timeout: float | None = None,
+    ) -> tuple[CommandResult, str]:
+        marker = f"--- tarmac outputs {uuid.uuid4().hex} ---"
+        with open(script) as f:
+            source = f.read()
+        result = self._run(
+            self.script_script(source, uv_args, inputs, marker),
+            timeout=timeout,
+            script_on_stdin=True,
+        )
+        stdout, found, outputs = result.stdout.rpartition(f"\n{marker}\n")
+        if not found:
+            # The connection failed or timed out before the script finished.
+            return result, ""
+        return result._replace(stdout=stdout), outputs
+
+    def close(self) -> None:
+        subprocess.run(
+            [*self._ssh_args()[:-1], "-O", "exit", self.host],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+def _here_document(path: str, content: str) -> list[str]:
+    """
+    Return the lines of a shell command that writes content to a file.
+
+    Content that does not end with a newline is written with one.
+    """
+    delimiter = f"TARMAC_EOF_{uuid.uuid4().hex}"
+    return [
+        f"cat > {path} <<'{delimiter}' || exit 1",
+        *([content.removesuffix("\n")] if content else []),
+        delimiter,
+    ]
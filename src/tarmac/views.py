@@ -0,0 +1,86 @@
+from typing import Any, Iterator, Mapping
+
+
+class AttrView(Mapping[str, Any]):
+    """
+    A read-only view of a mapping with attribute access, for conditions
+    and substitutions.
+
+    Unlike a DotMap, it does not copy the mapping: nested mappings and lists
+    are only wrapped when they are accessed, so it costs the same however
+    many outputs the mapping holds. A missing key gives an empty view,
+    so that `steps.build.changed` is falsy for a step that did not run,
+    unless the view is strict, in which case it is an error.
+    """
+
+    __slots__ = ("_data", "_strict")
+
+    def __init__(self, data: Mapping[str, Any] | None = None, strict: bool = False):
+        object.__setattr__(self, "_data", {} if data is None else data)
+        object.__setattr__(self, "_strict", strict)
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            if self._strict:
+                raise KeyError(f"No key {key!r} in {list(self._data)}") from None
+            return AttrView()
+        return wrap(value, self._strict)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(e.args[0]) from None
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("The view is read-only")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._data
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, AttrView):
+            other = other._data
+        return self._data == other
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"AttrView({self._data!r})"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self._data:
+            return wrap(self._data[key], self._strict)
+        return default
+
+
+def wrap(value: Any, strict: bool = False) -> Any:
+    """
+    Wrap the mappings in a value in views, at its top level only.
+    """
+    if isinstance(value, Mapping) and not isinstance(value, AttrView):
+        return AttrView(value, strict)
+    if isinstance(value, list):
+        return [wrap(item, strict) for item in value]
+    return value
+
+
+def unwrap(value: Any) -> Any:
+    """
+    Replace the views in a value, or in a list, with the mappings they show.
+    """
+    if isinstance(value, AttrView):
+        return value._data
+    if isinstance(value, list):
+        return [unwrap(item) for item in value]
+    return value
@@ -0,0 +1,93 @@
+"""
+The loop of a warm worker interpreter, which runs scripts one after the other.
+
+The source of this module is appended to a launcher script that has the
+metadata of the scripts the worker runs, so it only uses the standard library.
+Each request is a line of JSON on the standard input, with the script to run,
+the variables to add to its environment and the files to write its standard
+output and error to. The worker answers each request with a line of JSON
+holding the return code of the script. A request without a script
+is answered as soon as it is read, once the environment is set up.
+"""
+
+import json
+import os
+import runpy
+import sys
+import traceback
+
+
+def run_script(script: str, env: dict[str, str]) -> int:
+    """
+    Run a script in a fresh module namespace, like `python script`.
+
+    The environment variables, the working directory, the module path
+    and the modules of the worker are restored afterwards, so that
+    nothing the script changes is seen by the next one.
+    """
+    environ = dict(os.environ)
+    modules = set(sys.modules)
+    os.environ.update(env)
+    cwd = os.getcwd()
+    sys.argv = [script]
+    sys.path.insert(0, os.path.dirname(script))
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException as e:
+        # Leave out the frames of this module and runpy.
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != script:
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb or e.__traceback__)
+        return 1
+    finally:
+        if os.path.dirname(script) in sys.path:
+            sys.path.remove(os.path.dirname(script))
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        for name in set(sys.modules) - modules:
+            del sys.modules[name]
+    return 0
+
+
+def main() -> None:
+    # The requests and answers get their own descriptors,
+    # so that scripts cannot read or write them.
+    requests = os.fdopen(os.dup(0), "r")
+    answers = os.fdopen(os.dup(1), "w")
+    null = os.open(os.devnull, os.O_RDWR)
+    os.dup2(null, 0)
+    os.dup2(null, 1)
+    for line in requests:
+        request = json.loads(line)
+        if "script" not in request:
+            answers.write(json.dumps({"returncode": 0}) + "\n")
+            answers.flush()
+            continue
+        stdout = os.open(request["stdout"], os.O_WRONLY | os.O_APPEND)
+        stderr = os.open(request["stderr"], os.O_WRONLY | os.O_APPEND)
+        saved_stderr = os.dup(2)
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        os.close(stdout)
+        os.close(stderr)
+        try:
+            returncode = run_script(request["script"], request["env"])
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(null, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stderr)
+        answers.write(json.dumps({"returncode": returncode}) + "\n")
+        answers.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+import hashlib
+import json
+import logging
+import os
+import select
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from . import worker as worker_loop
+from .metadata import ScriptMetadata, ValueMapping, metadata_block
+from .shim import python_path, shim_directory
+from .transport import (
+    CommandResult,
+    cancelled,
+    kill_process_group,
+    script_files,
+    wait_interval,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def environment_key(
+    source: str,
+    metadata: ScriptMetadata,
+    uv_args: list[str],
+    python: str | None = None,
+) -> str:
+    """
+    Compute the key of the environment a script runs in, from its
+    `# /// script` metadata, its dependencies and the arguments to uv,
+    or the interpreter of its prebuilt environment.
+    """
+    material = {
+        "script": metadata_block(source, "script"),
+        "dependencies": metadata.dependencies,
+        "uv_args": uv_args,
+        "python": python,
+    }
+    data = json.dumps(material, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class Worker:
+    """
+    A long-lived interpreter that runs scripts with the same environment.
+
+    The interpreter is started with uv once, so the environment is resolved
+    and the modules the scripts import are loaded only for the first script.
+    Each script still runs in a fresh module namespace.
+    """
+
+    def __init__(self, command: list[str], cwd: str | None, key: str):
+        self.key = key
+        # The number of scripts the worker ran.
+        self.runs = 0
+        # The digest of each script the worker ran, when it last ran it.
+        self.scripts: dict[str, str] = {}
+        self._killed = False
+        # The output of uv and of the interpreter outside of the scripts.
+        self._log = tempfile.TemporaryFile()
+        env = os.environ.copy()
+        env["PYTHONPATH"] = python_path(str(shim_directory()), env)
+        self.process = subprocess.Popen(
+            command,
+            cwd=cwd,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._log,
+            text=True,
+            start_new_session=True,
+        )
+
+    @property
+    def alive(self) -> bool:
+        return not self._killed and self.process.poll() is None
+
+    def run_script(
+        self,
+        script: Path,
+        digest: str,
+        inputs: ValueMapping,
+        timeout: float | None = None,
+    ) -> tuple[CommandResult, str]:
+        """
+        Run a script in the worker, killing the worker after `timeout` seconds.
+
+        Returns the result of the script and the contents of its outputs file,
+        like `Transport.run_script`.
+        """
+        self.runs += 1
+        self.scripts[str(script.absolute())] = digest
+        with (
+            script_files(inputs) as (env, outputs_file),
+            tempfile.NamedTemporaryFile(mode="w+b") as stdout_file,
+            tempfile.NamedTemporaryFile(mode="w+b") as stderr_file,
+        ):
+            request = {
+                "script": str(script.absolute()),
+                "env": {
+                    name: env[name]
+                    for name in ("TARMAC_INPUTS_FILE", "TARMAC_OUTPUTS_FILE")
+                },
+                "stdout": stdout_file.name,
+                "stderr": stderr_file.name,
+            }
+            returncode, timed_out = self._request(request, timeout)
+            stdout = stdout_file.read().decode("utf-8", errors="replace")
+            stderr = stderr_file.read().decode("utf-8", errors="replace")
+            if returncode is None:
+                # The worker exited, usually because uv failed
+                # to set up the environment.
+                returncode = self.process.wait()
+                self._log.seek(0)
+                stderr = self._log.read().decode("utf-8", errors="replace") + stderr
+            outputs_file.seek(0)
+            outputs = outputs_file.read().decode("utf-8", errors="replace")
+        return CommandResult(returncode, stdout, stderr, timed_out), outputs
+
+    def ping(self, timeout: float | None = None) -> bool:
+        """
+        Wait until the worker is ready to run scripts.
+
+        Returns whether it is, which is false when uv failed
+        to set up the environment or `timeout` seconds passed.
+        """
+        returncode, _ = self._request({}, timeout)
+        return returncode is not None and self.alive
+
+    def _request(self, request: dict, timeout: float | None) -> tuple[int | None, bool]:
+        assert self.process.stdin is not None and self.process.stdout is not None
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            return None, False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                if cancelled() or (
+                    deadline is not None and time.monotonic() >= deadline
+                ):
+                    self.kill()
+                    return self.process.wait(), True
+                ready, _, _ = select.select(
+                    [self.process.stdout], [], [], wait_interval(deadline)
+                )
+                if ready:
+                    break
+            line = self.process.stdout.readline()
+        except BaseException:
+            self.kill()
+            raise
+        if not line:
+            return None, False
+        return json.loads(line)["returncode"], False
+
+    def kill(self) -> None:
+        """
+        Kill the worker with the script it is running.
+        """
+        self._killed = True
+        kill_process_group(self.process)
+
+    def close(self) -> None:
+        """
+        Let the worker exit once it finished its script, or kill it.
+        """
+        if self.alive:
+            assert self.process.stdin is not None
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.kill()
+        if self.process.returncode is None:
+            self.process.wait()
+        if self.process.stdout is not None:
+            self.process.stdout.close()
+        self._log.close()
+
+
+class WorkerPool:
+    """
+    Keeps warm workers for running scripts, by the environment they need.
+
+    Scripts with the same `# /// script` metadata, dependencies and uv arguments
+    share workers. A worker is replaced after `max_runs` scripts,
+    when one of the scripts it ran changed since, and when a script
+    it ran failed to finish. As many workers as there are scripts running
+    at the same time are kept for each environment.
+    """
+
+    def __init__(
+        self,
+        state_path: Path,
+        uv_bin: str,
+        cwd: str | None = None,
+        max_runs: int = 100,
+    ):
+        if max_runs < 1:
+            raise ValueError("The number of runs of a worker must be at least 1")
+        self.state_path = state_path
+        self.uv_bin = uv_bin
+        self.cwd = cwd
+        self.max_runs = max_runs
+        self._idle: dict[str, list[Worker]] = {}
+        self._busy: set[Worker] = set()
+        self._lock = threading.Lock()
+
+    def _launcher(self, key: str, source: str) -> Path:
+        """
+        Write the script that starts a worker for an environment.
+        """
+        path = self.state_path / (key + ".py")
+        with open(worker_loop.__file__) as f:
+            content = metadata_block(source, "script") + "\n" + f.read()
+        if not path.exists() or path.read_text() != content:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = path.with_suffix(f".{os.getpid()}.tmp")
+            temporary.write_text(content)
+            os.replace(temporary, path)
+        return path
+
+    def acquire(
+        self,
+        script: Path,
+        metadata: ScriptMetadata,
+        uv_args: list[str],
+        python: str | None = None,
+    ) -> tuple[Worker, str]:
+        """
+        Take an idle worker for a script, or start one, with uv
+        or with the interpreter of a prebuilt environment.
+
+        Returns the worker and the digest of the script to pass to it.
+        """
+        with open(script, "rb") as f:
+            data = f.read()
+        source = data.decode("utf-8", errors="replace")
+        digest = hashlib.sha256(data).hexdigest()
+        key = environment_key(source, metadata, uv_args, python)
+        path = str(script.absolute())
+        stale = []
+        found = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate = idle.pop()
+                if not candidate.alive or candidate.scripts.get(path, digest) != digest:
+                    stale.append(candidate)
+                    continue
+                found = candidate
+                break
+            if found is None:
+                launcher = str(self._launcher(key, source))
+                if python is not None:
+                    command = [python, launcher]
+                else:
+                    command = [self.uv_bin, *uv_args, launcher]
+                found = Worker(command, self.cwd, key)
+                logger.debug("Started a worker for %s", script)
+            self._busy.add(found)
+        for candidate in stale:
+            candidate.close()
+        return found, digest
+
+    def release(self, worker: Worker) -> None:
+        """
+        Return a worker to the pool once its script finished.
+        """
+        with self._lock:
+            self._busy.discard(worker)
+            keep = worker.alive and worker.runs < self.max_runs
+            if keep:
+                self._idle.setdefault(worker.key, []).append(worker)
+        if not keep:
+            worker.close()
+
+    def prepare(
+        self,
+        script: Path,
+        metadata: ScriptMetadata,
+        uv_args: list[str],
+        python: str | None = None,
+    ) -> None:
+        """
+        Start a worker for a script ahead of running it,
+        and wait until its environment is set up.
+        """
+        worker, _ = self.acquire(script, metadata, uv_args, python)
+        try:
+            if not worker.ping():
+                raise ValueError(f"Failed to start a worker for {script.name}")
+        finally:
+            self.release(worker)
+
+    def run_script(
+        self,
+        script: Path,
+        metadata: ScriptMetadata,
+        uv_args: list[str],
+        inputs: ValueMapping,
+        timeout: float | None = None,
+        python: str | None = None,
+    ) -> tuple[CommandResult, str]:
+        """
+        Run a script in a warm worker, like `Transport.run_script`.
+        """
+        worker, digest = self.acquire(script, metadata, uv_args, python)
+        try:
+            return worker.run_script(script, digest, inputs, timeout)
+        finally:
+            self.release(worker)
+
+    def close(self) -> None:
+        """
+        Stop the idle workers, and kill the busy ones.
+        """
+        with self._lock:
+            idle = [worker for workers in self._idle.values() for worker in workers]
+            busy = list(self._busy)
+            self._idle.clear()
+            self._busy.clear()
+        for worker in busy:
+            worker.kill()
+        for worker in idle + busy:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
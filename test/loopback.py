@@ -0,0 +1,22 @@
+from uv import find_uv_bin
+
+from tarmac.transport import SSHTransport
+
+
+class LoopbackTransport(SSHTransport):
+    """
+    An `SSHTransport` that runs its remote commands on this machine
+    with `sh`, instead of connecting to a host.
+
+    It exercises the same scripts as `SSHTransport`, for testing.
+    """
+
+    def __init__(self, cwd: str | None = None):
+        super().__init__("localhost", cwd=cwd)
+        self.uv_command = find_uv_bin()
+
+    def _remote_command(self, command: str) -> list[str]:
+        return ["sh", "-c", command]
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,148 @@
+import time
+from pathlib import Path
+
+
+def test_step_references():
+    from tarmac.analysis import step_references
+    from tarmac.metadata import WorkflowStep
+
+    def refs(**kw):
+        return step_references(WorkflowStep(**kw))
+
+    assert refs(run="echo hello") == set()
+    assert refs(run="echo ${steps.build.version}") == set()
+    assert refs(run="echo", **{"with": {"stdin": "${steps.build.output}"}}) == {"build"}
+    assert refs(
+        run="echo",
+        **{"with": {"env": {"A": "$${steps.a.output}", "B": ["${steps['b']}"]}}},
+    ) == {"b"}
+    assert refs(run="echo", **{"if": "steps.a.succeeded and changed('b')"}) == {
+        "a",
+        "b",
+    }
+    assert refs(run="echo", **{"if": "skipped('a')"}) == {"a"}
+    assert refs(
+        run="echo",
+        concurrency={"group": "${steps.pick.output.strip()}"},
+        cache={"files": ["${steps.files.output}/*.txt"]},
+    ) == {"pick", "files"}
+    assert refs(run="echo", **{"if": True}) == set()
+    assert refs(py="outputs['x'] = steps['a']['x'] + steps.get('b', {})") == {
+        "a",
+        "b",
+    }
+    assert refs(py="outputs['x'] = inputs['x']") == set()
+
+
+def test_undetermined_references():
+    from tarmac.analysis import step_references
+    from tarmac.metadata import WorkflowStep
+
+    def refs(**kw):
+        return step_references(WorkflowStep(**kw))
+
+    assert refs(py="outputs['n'] = len(steps)") is None
+    assert refs(py="for s in steps: pass") is None
+    assert refs(py="outputs['x'] = steps[inputs['name']]") is None
+    assert refs(py="outputs[") is None
+    assert refs(run="echo", **{"if": "changed(inputs.name)"}) is None
+    assert refs(run="echo", **{"with": {"stdin": "${steps}"}}) is None
+
+
+def test_inferred_graph(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            infer_needs: true
+            steps:
+              - id: a
+                run: echo a
+              - id: b
+                run: echo b
+              - id: c
+                run: cat
+                with:
+                  stdin: ${steps.a.output}
+                if: changed('b')
+              - id: d
+                py: outputs['count'] = len(steps)
+              - id: e
+                run: echo e
+              - id: f
+                run: echo f
+                needs: [e, a]
+            """
+        )
+    assert runner.workflow_graph("workflow") == {
+        "steps": {
+            "a": {"needs": [], "barrier": False},
+            "b": {"needs": [], "barrier": False},
+            "c": {"needs": ["a", "b"], "barrier": False},
+            "d": {"needs": ["a", "b", "c"], "barrier": True},
+            "e": {"needs": ["d"], "barrier": False},
+            "f": {"needs": ["a", "d", "e"], "barrier": False},
+        }
+    }
+
+
+def test_sequential_graph(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: a
+                run: echo a
+              - id: b
+                run: echo b
+                needs: []
+              - id: c
+                run: echo c
+            """
+        )
+    assert runner.workflow_graph("workflow") == {
+        "steps": {
+            "a": {"needs": [], "barrier": False},
+            "b": {"needs": [], "barrier": False},
+            "c": {"needs": ["b"], "barrier": False},
+        }
+    }
+
+
+def test_run_inferred_workflow(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=4)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            infer_needs: true
+            steps:
+              - id: a
+                run: sleep 0.5; echo a
+              - id: b
+                run: sleep 0.5; echo b
+              - id: c
+                run: sleep 0.5; echo c
+              - id: d
+                py: outputs['joined'] = inputs['a'] + inputs['b'] + inputs['c']
+                with:
+                  a: ${steps.a.output}
+                  b: ${steps.b.output}
+                  c: ${steps.c.output}
+            """
+        )
+    start = time.monotonic()
+    outputs = runner.execute_workflow("workflow", {})
+    elapsed = time.monotonic() - start
+    assert elapsed < 1.2
+    assert outputs["succeeded"] is True
+    assert outputs["steps"]["d"]["joined"] == "a\nb\nc\n"
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+
+def test_async_workflow(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+    from tarmac.runner import Runner
+
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - name: step1
+                run:
+                  - cat
+                  - echo "Goodbye, World!"
+                with:
+                  stdin: "Hello, World!\\n"
+              - name: step2
+                py: outputs['test'] = steps['step1']['output']
+              - name: step3
+                workflow: workflow2
+              - name: step4
+                run: exit 3
+                if: changed('step1')
+            """
+        )
+    with open(config_dir / "workflows" / "workflow2.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - name: nested
+                run: echo "Nested"
+            """
+        )
+    expected = Runner(base_path=str(config_dir)).execute_workflow("workflow", {})
+    outputs = asyncio.run(
+        AsyncRunner(base_path=str(config_dir)).execute_workflow("workflow", {})
+    )
+    assert outputs == expected
+    assert outputs["steps"]["step2"]["test"] == "Hello, World!\nGoodbye, World!\n"
+    assert outputs["steps"]["step4"] == {"succeeded": None}
+
+
+def test_async_script(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+
+    runner = AsyncRunner(base_path=str(config_dir))
+    (config_dir / "scripts").mkdir()
+    with open(config_dir / "scripts" / "script.py", "w") as f:
+        f.write(
+            """
+# /// tarmac
+# inputs:
+#   name:
+#     type: str
+# ///
+from tarmac.operations import run
+def main(op):
+    op.log("Hello, " + op.inputs["name"])
+run(main)
+"""
+        )
+    outputs = asyncio.run(runner.execute_script("script", {"name": "World"}))
+    assert outputs == {"succeeded": True, "output": "Hello, World\n"}
+
+
+def test_async_workflows_share_event_loop(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+
+    runner = AsyncRunner(base_path=str(config_dir), jobs=2)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            inputs:
+              n:
+                type: int
+            steps:
+              - id: sleep1
+                run: sleep 0.5
+                needs: []
+              - id: sleep2
+                run: sleep 0.5
+                needs: []
+              - id: echo
+                run: echo $N
+                with:
+                  env:
+                    N: "n=${n}"
+            """
+        )
+
+    async def main():
+        return await asyncio.gather(
+            *(runner.execute_workflow("workflow", {"n": n}) for n in range(50))
+        )
+
+    start = time.monotonic()
+    results = asyncio.run(main())
+    elapsed = time.monotonic() - start
+    assert elapsed < 3
+    assert all(outputs["succeeded"] for outputs in results)
+    assert [list(outputs["steps"]) for outputs in results] == [
+        ["sleep1", "sleep2", "echo"]
+    ] * 50
+    assert [outputs["steps"]["echo"]["output"] for outputs in results] == [
+        f"n={n}\n" for n in range(50)
+    ]
+
+
+def test_async_cancellation(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+
+    runner = AsyncRunner(base_path=str(config_dir), jobs=2)
+    (config_dir / "workflows").mkdir()
+    pid_file = config_dir / "pid"
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            f"""
+            steps:
+              - id: hang
+                run: echo $$ > {pid_file}; exec sleep 30
+                needs: []
+              - id: also_hang
+                run: sleep 30
+                needs: []
+            """
+        )
+
+    async def main():
+        task = asyncio.create_task(runner.execute_workflow("workflow", {}))
+        while not pid_file.exists() or not pid_file.read_text():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start < 5
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+def test_async_runner_keeps_loop_responsive(
+    config_dir: Path, monkeypatch: pytest.MonkeyPatch
+):
+    from tarmac.async_runner import AsyncRunner
+    from tarmac.journal import RunJournal
+    from tarmac.runner import Runner
+
+    # Slow disks: each journal record and cache key takes a while.
+    record, cache_key = RunJournal.record, Runner._cache_key
+
+    def slow_record(self, *args, **kwargs):
+        time.sleep(0.1)
+        return record(self, *args, **kwargs)
+
+    def slow_cache_key(self, *args, **kwargs):
+        time.sleep(0.1)
+        return cache_key(self, *args, **kwargs)
+
+    monkeypatch.setattr(RunJournal, "record", slow_record)
+    monkeypatch.setattr(Runner, "_cache_key", slow_cache_key)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: first
+                run: echo first
+                cache: {}
+              - id: second
+                run: echo second
+                cache: {}
+            """
+        )
+    runner = AsyncRunner(base_path=str(config_dir))
+
+    async def main():
+        gaps = []
+
+        async def ticker():
+            last = time.monotonic()
+            while True:
+                await asyncio.sleep(0.01)
+                now = time.monotonic()
+                gaps.append(now - last)
+                last = now
+
+        task = asyncio.create_task(ticker())
+        try:
+            outputs = await runner.execute_workflow("workflow", {})
+        finally:
+            task.cancel()
+        return outputs, gaps
+
+    outputs, gaps = asyncio.run(main())
+    assert outputs["succeeded"] is True
+    assert len(gaps) > 20
+    assert max(gaps) < 0.08
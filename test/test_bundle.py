@@ -0,0 +1,125 @@
+from pathlib import Path
+
+import pytest
+from pytest import MonkeyPatch
+
+
+def _write_workflows(config_dir: Path) -> None:
+    (config_dir / "workflows").mkdir()
+    (config_dir / "scripts").mkdir()
+    with open(config_dir / "workflows" / "main.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: first
+                do: first
+              - id: nested
+                workflow: nested
+              - run: echo
+            """
+        )
+    with open(config_dir / "workflows" / "nested.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - do: second
+              - do: first
+            """
+        )
+    for name in ("first", "second"):
+        with open(config_dir / "scripts" / f"{name}.py", "w") as f:
+            f.write(
+                """
+# /// script
+# dependencies = ["dotmap"]
+# ///
+import dotmap
+from tarmac.operations import run
+
+def main(op):
+    op.outputs["bundled"] = True
+
+run(main)
+"""
+            )
+
+
+def test_workflow_scripts(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_workflows(config_dir)
+    with open(config_dir / "workflows" / "loop.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - workflow: nested
+              - workflow: loop
+            """
+        )
+    runner = Runner(base_path=str(config_dir))
+    assert runner.workflow_scripts("main") == ["first", "second"]
+    assert runner.workflow_scripts("nested") == ["second", "first"]
+    assert runner.workflow_scripts("loop") == ["second", "first"]
+    with pytest.raises(ValueError, match="Wheelhouse .* not found"):
+        Runner(base_path=str(config_dir), offline=True)
+
+
+def test_bundle_and_run_offline(config_dir: Path, monkeypatch: MonkeyPatch):
+    from tarmac.runner import Runner
+
+    _write_workflows(config_dir)
+    result = Runner(base_path=str(config_dir)).bundle_workflow("main")
+    assert result["scripts"] == ["first", "second"]
+    # Only the dependencies of the scripts are bundled, without tarmac.
+    assert [wheel.split("-")[0] for wheel in result["wheels"]] == ["dotmap"]
+    wheelhouse = config_dir / "wheelhouse"
+    assert sorted(path.name for path in wheelhouse.glob("*.whl")) == result["wheels"]
+    # Bundling again downloads nothing new.
+    assert Runner(base_path=str(config_dir)).bundle_workflow("main")["wheels"] == []
+
+    # With an empty uv cache, the packages can only come from the wheelhouse.
+    monkeypatch.setenv("UV_CACHE_DIR", str(config_dir / "uv-cache"))
+    runner = Runner(base_path=str(config_dir), offline=True)
+    outputs = runner.execute_workflow("main", {})
+    assert outputs["succeeded"] is True
+    assert outputs["steps"]["first"]["bundled"] is True
+    assert outputs["steps"]["nested"]["succeeded"] is True
+    with Runner(base_path=str(config_dir), offline=True, cached_envs=True) as runner:
+        assert runner.execute_script("second", {})["bundled"] is True
+
+
+def test_offline_remote_target(config_dir: Path, monkeypatch: MonkeyPatch):
+    from loopback import LoopbackTransport
+
+    from tarmac.inventory import Inventory
+    from tarmac.runner import Runner
+
+    monkeypatch.setattr(
+        "tarmac.runner.SSHTransport",
+        lambda host, cwd=None, **options: LoopbackTransport(cwd),
+    )
+    _write_workflows(config_dir)
+    (config_dir / "wheelhouse").mkdir()
+    with pytest.raises(ValueError, match="Scripts can only run offline locally"):
+        Runner(
+            base_path=str(config_dir),
+            transport=LoopbackTransport(str(config_dir)),
+            offline=True,
+        )
+
+    # The wheelhouse is not on remote hosts, so their targets fail.
+    inventory = Inventory.load(
+        f"""
+        targets:
+          remote:
+            host: example.com
+            path: {config_dir}
+        """
+    )
+    runner = Runner(base_path=str(config_dir), offline=True)
+    outputs = runner.execute_workflow_on_targets("main", {}, inventory.select("remote"))
+    assert outputs["succeeded"] is False
+    assert outputs["results"][0]["outputs"] == {
+        "succeeded": False,
+        "error": "Scripts can only run offline locally",
+    }
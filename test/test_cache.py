@@ -0,0 +1,230 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+
+def test_result_cache(tmp_path: Path):
+    from tarmac.cache import ResultCache
+
+    cache = ResultCache(tmp_path)
+    assert cache.get("ab12") is None
+    cache.put("ab12", {"succeeded": True, "output": "x"})
+    assert cache.get("ab12") == {"succeeded": True, "output": "x"}
+    assert (tmp_path / "ab" / "ab12.json").exists()
+
+    cache.put("cd34", {"succeeded": True}, ttl=0.01)
+    time.sleep(0.05)
+    assert cache.get("cd34") is None
+    assert not (tmp_path / "cd" / "cd34.json").exists()
+
+
+def test_result_cache_eviction(tmp_path: Path):
+    from tarmac.cache import ResultCache
+
+    cache = ResultCache(tmp_path)
+    for index, key in enumerate(["aa", "bb", "cc"]):
+        cache.put(key, {"output": "x" * 100})
+        os.utime(cache._path(key), (index, index))
+    # Using an entry makes it the most recently used one.
+    assert cache.get("aa") is not None
+    size = cache._path("aa").stat().st_size
+    cache.max_size = 2 * size + 16  # timestamps vary in length
+    cache.put("dd", {"output": "x" * 100})
+    assert cache.get("bb") is None
+    assert cache.get("cc") is None
+    assert cache.get("aa") is not None
+    assert cache.get("dd") is not None
+
+    cache.max_size = 10**9
+    cache.put("ee", {"output": "y"}, ttl=0.01)
+    time.sleep(0.05)
+    removed, freed = cache.prune()
+    assert removed == 1
+    assert freed > 0
+    assert cache.prune(max_size=0)[0] == 2
+
+
+def test_result_cache_scans_only_over_limit(tmp_path: Path):
+    from tarmac.cache import ResultCache
+
+    cache = ResultCache(tmp_path)
+    scans = []
+    prune = cache.prune
+
+    def counted_prune(*args, **kwargs):
+        scans.append(args)
+        return prune(*args, **kwargs)
+
+    cache.prune = counted_prune  # type: ignore[method-assign]
+    for index in range(50):
+        cache.put(f"{index:04}", {"output": "x" * 100})
+    # The directory is scanned once to count the entries.
+    assert len(scans) == 1
+    size = cache._path("0000").stat().st_size
+    cache.max_size = 50 * size + size // 2
+    cache.put("0000", {"output": "x" * 100})
+    assert len(scans) == 1
+    cache.put("new", {"output": "x" * 100})
+    assert len(scans) == 2
+    assert len(list(tmp_path.glob("*/*.json"))) == 50
+
+
+def test_cache_validation():
+    from tarmac.metadata import WorkflowStep
+
+    step = WorkflowStep(run="true", cache={"files": ["a.txt"], "ttl": 60})
+    assert step.cache
+    with pytest.raises(ValueError, match="Only script and shell steps"):
+        WorkflowStep(py="pass", cache=True)
+    with pytest.raises(ValueError, match="`ttl` must be positive"):
+        WorkflowStep(run="true", cache={"ttl": 0})
+
+
+def test_cached_shell_step(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    (config_dir / "templates").mkdir()
+    (config_dir / "templates" / "site.conf").write_text("one")
+    counter = config_dir / "counter"
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            f"""
+            inputs:
+              version:
+                type: str
+            steps:
+              - id: render
+                run: echo rendered >> {counter}; echo "$VERSION"
+                with:
+                  env:
+                    VERSION: ${{version}}
+                cache:
+                  files: ["templates/*.conf"]
+            """
+        )
+
+    first = runner.execute_workflow("workflow", {"version": "1"})
+    assert first["steps"]["render"]["output"] == "1\n"
+    assert "cached" not in first["steps"]["render"]
+    second = runner.execute_workflow("workflow", {"version": "1"})
+    assert second["steps"]["render"]["cached"] is True
+    assert second["steps"]["render"]["output"] == "1\n"
+    assert counter.read_text().count("rendered") == 1
+
+    # Different parameters or input files are a different key.
+    runner.execute_workflow("workflow", {"version": "2"})
+    assert counter.read_text().count("rendered") == 2
+    (config_dir / "templates" / "site.conf").write_text("two")
+    runner.execute_workflow("workflow", {"version": "2"})
+    assert counter.read_text().count("rendered") == 3
+    runner.execute_workflow("workflow", {"version": "2"})
+    assert counter.read_text().count("rendered") == 3
+
+
+def test_failures_are_not_cached(config_dir: Path):
+    from tarmac.metadata import WorkflowStep
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    counter = config_dir / "counter"
+    step = WorkflowStep(id="fail", run=f"echo x >> {counter}; exit 1", cache=True)
+    for _ in range(2):
+        out = runner.execute_workflow_step(step, {}, {"steps": {}})
+        assert out["succeeded"] is False
+    assert counter.read_text() == "x\nx\n"
+
+
+def test_cached_script_step(config_dir: Path):
+    from tarmac.metadata import WorkflowStep
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "scripts").mkdir()
+    script = config_dir / "scripts" / "stamp.py"
+    script.write_text(
+        """
+import time
+from tarmac.operations import run
+def main(op):
+    op.outputs["stamp"] = time.time_ns()
+run(main)
+"""
+    )
+    step = WorkflowStep(id="stamp", do="stamp", cache=True)
+    first = runner.execute_workflow_step(step, {}, {"steps": {}})
+    second = runner.execute_workflow_step(step, {}, {"steps": {}})
+    assert second["cached"] is True
+    assert second["stamp"] == first["stamp"]
+    # Changing the script, including its metadata, invalidates the outputs.
+    script.write_text(
+        "# /// tarmac\n# description: stamp\n# ///\n" + script.read_text()
+    )
+    third = runner.execute_workflow_step(step, {}, {"steps": {}})
+    assert "cached" not in third
+    assert third["stamp"] != first["stamp"]
+
+
+def test_cache_prune_command(config_dir: Path):
+    from tarmac.cache import ResultCache
+
+    cache = ResultCache(config_dir / ".tarmac" / "cache")
+    cache.put("aa", {"output": "x"})
+    cache.put("bb", {"output": "x"}, ttl=0.01)
+    time.sleep(0.05)
+    command = [sys.executable, "-m", "tarmac", "cache", "prune", "-b"]
+    result = subprocess.run(
+        command + [str(config_dir)], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.startswith("Removed 1 cached outputs")
+    assert cache.get("aa") is not None
+    result = subprocess.run(
+        command + [str(config_dir), "--max-size", "0"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.startswith("Removed 1 cached outputs")
+    assert cache.get("aa") is None
+
+
+def test_command_arguments(config_dir: Path):
+    command = [sys.executable, "-m", "tarmac"]
+    # The base path may come before the subcommand.
+    result = subprocess.run(
+        command + ["cache", "-b", str(config_dir), "prune"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.startswith("Removed 0 cached outputs")
+    result = subprocess.run(
+        command + ["env", "-b", str(config_dir), "list"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout == ""
+
+    # A workflow named like a command runs with an option before it.
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "cache.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: hello
+                run: echo hello
+            """
+        )
+    result = subprocess.run(
+        command + ["-b", str(config_dir), "cache", "--output-format", "json"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert '"output": "hello\\n"' in result.stdout
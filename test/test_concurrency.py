@@ -0,0 +1,135 @@
+from pathlib import Path
+
+import pytest
+
+
+def test_additive_increase_multiplicative_decrease():
+    from tarmac.concurrency import AdaptiveLimiter
+
+    now = [0.0]
+    limiter = AdaptiveLimiter(8, clock=lambda: now[0])
+    assert limiter.limit == 1
+    # One more task per `limit` tasks that succeed in time.
+    for _ in range(1 + 2 + 3):
+        now[0] += 1
+        limiter.record(1.0, True)
+    assert limiter.limit == 4
+    # Slow tasks halve the limit, at most once per `limit` tasks.
+    limiter.record(3.0, True)
+    assert limiter.limit == 2
+    limiter.record(3.0, True)
+    assert limiter.limit == 2
+    limiter.record(3.0, True)
+    assert limiter.limit == 1
+    for _ in range(20):
+        limiter.record(1.0, True)
+    assert limiter.limit == 6
+    assert limiter.timeline[:4] == [(0.0, 1), (1.0, 2), (3.0, 3), (6.0, 4)]
+    assert limiter.timeline[-1] == (6.0, 6)
+    assert not limiter.tripped
+
+
+def test_bounds():
+    from tarmac.concurrency import AdaptiveLimiter
+
+    limiter = AdaptiveLimiter(3, min_limit=2, initial=10)
+    assert limiter.limit == 3
+    for _ in range(10):
+        limiter.record(1.0, True)
+    assert limiter.limit == 3
+    limiter.record(1.0, False)
+    assert limiter.limit == 2
+    with pytest.raises(ValueError, match="maximum concurrency must be at least 1"):
+        AdaptiveLimiter(0)
+
+
+def test_circuit_breaker():
+    from tarmac.concurrency import AdaptiveLimiter
+
+    limiter = AdaptiveLimiter(4, error_threshold=0.5, window=6)
+    for succeeded in [True, True, True, False]:
+        limiter.record(1.0, succeeded)
+    assert not limiter.tripped
+    limiter.record(1.0, False)
+    assert not limiter.tripped
+    limiter.record(1.0, False)
+    assert limiter.tripped
+    assert limiter.limit == 0
+    assert limiter.report()["timeline"][-1][1] == 0
+    assert limiter.report()["tripped"] is True
+
+
+def test_adaptive_for_each(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: ok
+                py: outputs['n'] = inputs['n']
+                for_each: ${list(range(10))}
+                parallel: 4
+                adaptive: true
+                with:
+                  n: ${item}
+              - id: failing
+                py: assert inputs['n'] < 2
+                for_each: ${list(range(20))}
+                parallel: 2
+                fail-fast: false
+                adaptive:
+                  error-threshold: 0.4
+                with:
+                  n: ${item}
+            """
+        )
+    outputs = runner.execute_workflow("workflow", {})
+    ok = outputs["steps"]["ok"]
+    assert ok["succeeded"] is True
+    assert [out["n"] for out in ok["results"]] == list(range(10))
+    timeline = ok["adaptive"]["timeline"]
+    assert timeline[0] == [0.0, 1]
+    assert [limit for _, limit in timeline] == [1, 2, 3, 4]
+    assert ok["adaptive"]["tripped"] is False
+
+    failing = outputs["steps"]["failing"]
+    assert failing["succeeded"] is False
+    assert failing["adaptive"]["tripped"] is True
+    started = [out for out in failing["results"] if out is not None]
+    assert 5 <= len(started) < 20
+    assert failing["results"][-1] is None
+
+
+def test_adaptive_targets(config_dir: Path):
+    from tarmac.inventory import Target
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: fail
+                run: "false"
+            """
+        )
+    targets = [Target(name=f"t{i}") for i in range(12)]
+    outputs = runner.execute_workflow_on_targets(
+        "workflow", {}, targets, batch=4, adaptive=True
+    )
+    assert outputs["adaptive"]["tripped"] is True
+    assert outputs["failed"] == [f"t{i}" for i in range(5)]
+    assert outputs["not_run"] == [f"t{i}" for i in range(5, 12)]
+
+
+def test_invalid_adaptive():
+    from tarmac.metadata import WorkflowStep
+
+    with pytest.raises(ValueError, match="Cannot use `adaptive` without"):
+        WorkflowStep(run="true", adaptive=True)
+    with pytest.raises(ValueError, match="`error-threshold` must be between 0 and 1"):
+        WorkflowStep(run="true", for_each=[1], adaptive={"error-threshold": 0})
@@ -136,3 +136,65 @@ steps:
         )
     with pytest.raises(ValueError, match="Invalid condition type"):
         runner.execute_workflow("invalid_condition", {})
+
+
+def test_skipped_step_params_not_substituted(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+steps:
+  - id: skipped
+    py: outputs['value'] = inputs['value']
+    if: False
+    with:
+      value: ${undefined_name}
+  - id: nested
+    workflow: missing
+    if: False
+"""
+        )
+    calls = []
+    outputs = runner.execute_workflow(
+        "workflow", {}, before_each=lambda step, params: calls.append(params)
+    )
+    assert outputs["succeeded"] is True
+    assert outputs["steps"]["skipped"] == {"succeeded": None}
+    assert outputs["steps"]["nested"] == {"succeeded": None}
+    assert calls == [{}, {}]
+
+
+def test_attr_view():
+    from tarmac.views import AttrView, unwrap
+
+    data = {"build": {"output": "ok", "files": [{"name": "a"}], "changed": True}}
+    view = AttrView(data)
+    assert view.build.output == "ok"
+    assert view["build"].files[0].name == "a"
+    assert view.build.changed is True
+    assert not view.missing
+    assert not view.missing.deeper
+    assert view.get("missing") is None
+    assert "missing" not in data  # looking up a key does not add it
+    assert view.build == data["build"]
+    assert unwrap(view.build) is data["build"]
+    assert unwrap(view.build.files) == [{"name": "a"}]
+    with pytest.raises(AttributeError, match="read-only"):
+        view.build = 1
+    # The view follows the mapping instead of copying it.
+    data["deploy"] = {"output": "done"}
+    assert view.deploy.output == "done"
+
+
+def test_conditions_use_live_outputs(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    outputs = {"steps": {"build": {"changed": True, "files": ["a"] * 100000}}}
+    condition = "steps.build.changed and inputs.mode == 'fast' and not steps.x"
+    assert runner.evaluate_condition(condition, {"mode": "fast"}, outputs)
+    outputs["steps"]["build"]["changed"] = False
+    assert not runner.evaluate_condition(condition, {"mode": "fast"}, outputs)
@@ -0,0 +1,145 @@
+import subprocess
+import sys
+from pathlib import Path
+
+SCRIPT = """
+# /// script
+# dependencies = ["dotmap"]
+# ///
+
+# /// tarmac
+# description: {description}
+# ///
+import sys
+import dotmap
+from tarmac.operations import run
+
+def main(op):
+    op.outputs["python"] = sys.executable
+
+run(main)
+"""
+
+
+def _write_script(config_dir: Path, name: str, description: str) -> None:
+    (config_dir / "scripts").mkdir(exist_ok=True)
+    with open(config_dir / "scripts" / f"{name}.py", "w") as f:
+        f.write(SCRIPT.format(description=description))
+
+
+def test_cached_environments(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_script(config_dir, "first", "First")
+    _write_script(config_dir, "second", "First")
+    envs = config_dir / ".tarmac" / "envs"
+    with Runner(base_path=str(config_dir), cached_envs=True) as runner:
+        assert runner.environments is not None
+        first = runner.execute_script("first", {})
+        assert first["succeeded"] is True
+        assert Path(first["python"]).parent.parent.parent == envs
+        # The same metadata is locked once.
+        assert runner.execute_script("second", {})["python"] == first["python"]
+        assert len(list((envs / "locks").glob("*/environment"))) == 1
+
+        # Changed metadata is locked again, to the same environment.
+        _write_script(config_dir, "second", "Second")
+        assert runner.execute_script("second", {})["python"] == first["python"]
+        assert len(list((envs / "locks").glob("*/environment"))) == 2
+        (environment,) = runner.environments.list()
+        # tarmac is not installed in the environment.
+        (package,) = environment["packages"]
+        assert package.startswith("dotmap==")
+        assert environment["size"] > 0
+
+        assert runner.environments.prune(3600) == (0, 0)
+        removed, freed = runner.environments.prune(0)
+        assert (removed, freed) == (1, environment["size"])
+        assert runner.environments.list() == []
+        assert not list((envs / "locks").iterdir())
+
+        # A removed environment is built again.
+        assert runner.execute_script("first", {})["python"] == first["python"]
+
+        # Scripts with uv arguments keep running with `uv run`.
+        with open(config_dir / "scripts" / "uv.py", "w") as f:
+            f.write(
+                SCRIPT.replace(
+                    "# description: {description}", "# additional_uv_args: [-q]"
+                )
+            )
+        assert runner.execute_script("uv", {})["python"] != first["python"]
+
+
+def test_env_command(config_dir: Path):
+    _write_script(config_dir, "script", "Script")
+    command = [sys.executable, "-m", "tarmac"]
+    result = subprocess.run(
+        command + ["script", "--script", "--cached-envs", "-b", str(config_dir)],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+    result = subprocess.run(
+        command + ["env", "list", "-b", str(config_dir)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.count("\n") == 1
+    assert " bytes  dotmap==" in result.stdout
+
+    result = subprocess.run(
+        command + ["env", "prune", "-b", str(config_dir), "--max-age", "0"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.startswith("Removed 1 environments (")
+
+
+def test_concurrent_environments(tmp_path: Path, monkeypatch):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    from tarmac.envs import ScriptEnvironments
+    from tarmac.metadata import ScriptMetadata
+
+    built: list[str] = []
+    active: list[str] = []
+    overlap = 0
+    lock = threading.Lock()
+
+    def prepare(self, key: str, source: str) -> Path:
+        nonlocal overlap
+        with lock:
+            if key in built:
+                return tmp_path / key
+            built.append(key)
+            active.append(key)
+            overlap = max(overlap, len(active))
+        time.sleep(0.3)
+        with lock:
+            active.remove(key)
+        return tmp_path / key
+
+    monkeypatch.setattr(ScriptEnvironments, "_prepare", prepare)
+    for name in ("first", "second"):
+        _write_script(tmp_path, name, name)
+    environments = ScriptEnvironments(tmp_path / "envs")
+    scripts = ["first", "second", "first"]
+    with ThreadPoolExecutor(3) as pool:
+        pythons = list(
+            pool.map(
+                lambda name: environments.python(
+                    tmp_path / "scripts" / f"{name}.py", ScriptMetadata()
+                ),
+                scripts,
+            )
+        )
+    # Different metadata is prepared at the same time, the same metadata once.
+    assert overlap == 2
+    assert len(built) == 2
+    assert pythons[0] == pythons[2] != pythons[1]
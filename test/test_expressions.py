@@ -0,0 +1,111 @@
+import pytest
+
+
+def test_expressions():
+    from tarmac.expressions import Expression
+    from tarmac.views import AttrView
+
+    namespace = {
+        "steps": AttrView({"build": {"output": "ok\n", "files": ["a", "b"]}}),
+        "n": 3,
+        "name": "Web",
+        "matrix": AttrView({"region": "eu"}),
+        "time_left": lambda: 10.0,
+    }
+    cases = {
+        "n + 1": 4,
+        "n * 2 - 1": 5,
+        "n // 2 + n % 2": 2,
+        "-n": -3,
+        "not n": False,
+        "0 < n < 5": True,
+        "1 < n < 2": False,
+        "n in [1, 2, 3]": True,
+        "name is None": False,
+        "steps.build.output.strip() == 'ok'": True,
+        "steps['build'].files[-1]": "b",
+        "steps.build.files[0:1]": ["a"],
+        "len(steps.build.files)": 2,
+        "name.lower() + '-' + matrix.region": "web-eu",
+        "','.join(sorted(['b', 'a']))": "a,b",
+        "dict(alice='bob')['alice']": "bob",
+        "{'a': n, 'b': (1, 2)}": {"a": 3, "b": (1, 2)},
+        "n > 1 and name or 'none'": "Web",
+        "'yes' if time_left() > 5 else 'no'": "yes",
+        "steps.missing.output": AttrView(),
+        "list(range(3))": [0, 1, 2],
+    }
+    for source, expected in cases.items():
+        assert Expression(source).evaluate(namespace) == expected, source
+        assert eval(source, {}, namespace) == expected, source
+
+    with pytest.raises(NameError, match="name 'alice' is not defined"):
+        Expression("alice").evaluate(namespace)
+    with pytest.raises(SyntaxError):
+        Expression("123.456.789")
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "__import__('os')",
+        "().__class__",
+        "open('/etc/passwd')",
+        "eval('1')",
+        "getattr(n, 'real')",
+        "name.format(n)",
+        "[x for x in steps]",
+        "lambda: 1",
+        "(x := 1)",
+        "f'{n}'",
+        "2 ** 100",
+        "len(*steps)",
+        "dict(**steps)",
+        "steps._data",
+        "(lambda: 1)()",
+    ],
+)
+def test_rejected_expressions(source: str):
+    from tarmac.expressions import Expression
+
+    with pytest.raises(ValueError, match="is not allowed in expressions"):
+        Expression(source)
+
+
+def test_rejected_at_load_time():
+    from tarmac.metadata import WorkflowMetadata
+
+    with pytest.raises(ValueError, match="Calling open is not allowed"):
+        WorkflowMetadata.load(
+            """
+            steps:
+              - id: read
+                run: echo
+                if: open('/etc/passwd')
+            """
+        )
+    with pytest.raises(ValueError, match="Attribute __class__ is not allowed"):
+        WorkflowMetadata.load(
+            """
+            steps:
+              - id: read
+                run: echo
+                for_each: ${().__class__}
+            """
+        )
+
+
+def test_expression_references():
+    from tarmac.expressions import Expression
+
+    assert Expression("steps.a.output + steps['b'].output").references == {"a", "b"}
+    assert Expression("steps.get('a') and changed('b') or skipped('c')").references == {
+        "a",
+        "b",
+        "c",
+    }
+    assert Expression("n + 1").references == set()
+    assert Expression("len(steps)").references is None
+    assert Expression("steps[name]").references is None
+    assert Expression("steps.keys()").references is None
+    assert Expression("changed(name)").references is None
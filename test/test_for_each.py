@@ -0,0 +1,243 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+
+def test_for_each_step(config_dir: Path):
+    from tarmac.metadata import ValueMapping, WorkflowStep
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            inputs:
+              users:
+                type: list
+            steps:
+              - id: greet
+                py: outputs['greeting'] = 'hello ' + inputs['name']
+                for_each: ${users}
+                with:
+                  name: ${item.name}
+            """
+        )
+    seen: list[tuple[str, ValueMapping]] = []
+
+    def before_each(step: WorkflowStep, params: ValueMapping):
+        seen.append((str(step.id), params))
+
+    outputs = runner.execute_workflow(
+        "workflow",
+        {"users": [{"name": "alice"}, {"name": "bob"}]},
+        before_each=before_each,
+    )
+    assert outputs["succeeded"] is True
+    assert outputs["steps"]["greet"] == {
+        "succeeded": True,
+        "results": [
+            {"succeeded": True, "greeting": "hello alice"},
+            {"succeeded": True, "greeting": "hello bob"},
+        ],
+    }
+    assert seen == [("greet-0", {"name": "alice"}), ("greet-1", {"name": "bob"})]
+
+
+def test_for_each_batches(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: square
+                py: |
+                  outputs['results'] = [{'square': n * n} for n in inputs['numbers']]
+                  outputs['count'] = len(inputs['numbers'])
+                for_each: ${list(range(5))}
+                batch-size: 2
+                with:
+                  numbers: ${batch}
+              - id: count
+                run: cat
+                for_each: ${['a', 'b', 'c']}
+                batch-size: 2
+                with:
+                  stdin: ${''.join(batch)}
+            """
+        )
+    outputs = runner.execute_workflow("workflow", {})
+    assert outputs["succeeded"] is True
+    assert outputs["steps"]["square"] == {
+        "succeeded": True,
+        "results": [{"square": n * n} for n in range(5)],
+        "batches": [
+            {"succeeded": True, "count": 2},
+            {"succeeded": True, "count": 2},
+            {"succeeded": True, "count": 1},
+        ],
+    }
+    count = outputs["steps"]["count"]
+    assert count["results"] == [{"succeeded": True}] * 3
+    assert [batch["output"] for batch in count["batches"]] == ["ab", "c"]
+
+
+def test_for_each_parallel(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: sleep
+                run: sleep 0.3
+                for_each: ${list(range(8))}
+                batch-size: 2
+                parallel: 4
+            """
+        )
+    start = time.monotonic()
+    outputs = runner.execute_workflow("workflow", {})
+    elapsed = time.monotonic() - start
+    assert outputs["succeeded"] is True
+    assert len(outputs["steps"]["sleep"]["results"]) == 8
+    assert elapsed < 0.8
+
+
+def test_for_each_failure(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: check
+                py: assert inputs['n'] != 1
+                for_each: ${[0, 1, 2]}
+                with:
+                  n: ${item}
+              - id: check_all
+                py: assert inputs['n'] != 1
+                for_each: ${[0, 1, 2]}
+                fail-fast: false
+                with:
+                  n: ${item}
+                needs: []
+            """
+        )
+    outputs = runner.execute_workflow("workflow", {})
+    assert outputs["succeeded"] is False
+    results = outputs["steps"]["check"]["results"]
+    assert results[0] == {"succeeded": True}
+    assert results[1]["succeeded"] is False
+    assert "AssertionError" in results[1]["error"]
+    assert results[2] is None
+
+    runner = Runner(base_path=str(config_dir), jobs=2)
+    outputs = runner.execute_workflow("workflow", {})
+    results = outputs["steps"]["check_all"]["results"]
+    assert [out["succeeded"] for out in results] == [True, False, True]
+
+
+def test_invalid_for_each(config_dir: Path):
+    from tarmac.metadata import WorkflowStep
+    from tarmac.runner import Runner
+
+    with pytest.raises(ValueError, match="Cannot use `for_each` with `matrix`"):
+        WorkflowStep(run="true", for_each=[1], matrix={"n": [1]})
+    with pytest.raises(ValueError, match="Cannot use `batch-size` without"):
+        WorkflowStep(run="true", **{"batch-size": 2})
+    with pytest.raises(ValueError, match="Cannot use `parallel` without"):
+        WorkflowStep(run="true", parallel=2)
+    with pytest.raises(ValueError, match="`batch-size` must be at least 1"):
+        WorkflowStep(run="true", for_each=[1], **{"batch-size": 0})
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: step
+                run: "true"
+                for_each: ${'a, b'}
+            """
+        )
+    with pytest.raises(ValueError, match="The items of step step must be a list"):
+        runner.execute_workflow("workflow", {})
+
+
+def test_for_each_references():
+    from tarmac.analysis import step_references
+    from tarmac.metadata import WorkflowStep
+
+    step = WorkflowStep(run="true", for_each="${steps.list.items}")
+    assert step_references(step) == {"list"}
+
+
+def test_async_for_each(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+
+    runner = AsyncRunner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: echo
+                run: sleep 0.3; cat
+                for_each: ${['a', 'b', 'c', 'd']}
+                batch-size: 2
+                parallel: 2
+                with:
+                  stdin: ${''.join(batch)}
+            """
+        )
+    start = time.monotonic()
+    outputs = asyncio.run(runner.execute_workflow("workflow", {}))
+    elapsed = time.monotonic() - start
+    assert elapsed < 0.6
+    assert outputs["succeeded"] is True
+    assert [batch["output"] for batch in outputs["steps"]["echo"]["batches"]] == [
+        "ab",
+        "cd",
+    ]
+
+
+def test_for_each_item_variable(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: whole
+                py: outputs['item'] = inputs['item']
+                for_each: ${[dict(name='alice')]}
+                with:
+                  item: ${item}
+              - id: missing
+                py: pass
+                for_each: ${[dict(name='alice')]}
+                with:
+                  age: ${item.age}
+            """
+        )
+    seen = []
+    with pytest.raises(AttributeError, match="No key 'age'"):
+        runner.execute_workflow(
+            "workflow", {}, before_each=lambda step, params: seen.append(params)
+        )
+    assert seen == [{"item": {"name": "alice"}}]
+    assert type(seen[0]["item"]) is dict
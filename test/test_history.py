@@ -0,0 +1,97 @@
+import json
+import logging
+from pathlib import Path
+
+import pytest
+
+
+def test_step_history(config_dir: Path):
+    from tarmac.history import StepHistory
+
+    path = config_dir / "history" / "workflow.json"
+    history = StepHistory(path)
+    assert history.durations == {}
+    history.record({"a": 2.0, "b": 1.0})
+    history.record({"a": 4.0})
+    assert StepHistory(path).durations == {"a": 3.0, "b": 1.0}
+
+    with open(path, "w") as f:
+        f.write("not json")
+    assert StepHistory(path).durations == {}
+
+
+def test_priority_order():
+    from tarmac.metadata import WorkflowStep
+    from tarmac.scheduler import StepScheduler
+
+    steps = [
+        WorkflowStep(id="short", run="true", needs=[]),
+        WorkflowStep(id="long", run="true", needs=[]),
+        WorkflowStep(id="after_long", run="true", needs=["long"]),
+        WorkflowStep(id="unknown", run="true", needs=[]),
+    ]
+    assert StepScheduler(steps).ready() == [0, 1, 3]
+
+    durations = {"short": 1.0, "long": 2.0, "after_long": 2.0}
+    scheduler = StepScheduler(steps, durations=durations)
+    assert scheduler.priorities == [1.0, 4.0, 2.0, pytest.approx(5 / 3)]
+    assert scheduler.ready() == [1, 3, 0]
+    assert scheduler.predicted_critical_path() == [1, 2]
+
+
+def test_actual_critical_path():
+    from tarmac.metadata import WorkflowStep
+    from tarmac.scheduler import StepScheduler
+
+    steps = [
+        WorkflowStep(id="a", run="true", needs=[]),
+        WorkflowStep(id="b", run="true", needs=[]),
+        WorkflowStep(id="c", run="true", needs=["a", "b"]),
+    ]
+    scheduler = StepScheduler(steps)
+    assert scheduler.actual_critical_path() == []
+    scheduler.start(0)
+    scheduler.start(1)
+    scheduler.finish(0)
+    scheduler.finish(1)
+    scheduler.start(2)
+    scheduler.finish(2)
+    assert scheduler.actual_critical_path() == [1, 2]
+
+
+def test_workflow_history(config_dir: Path, caplog: pytest.LogCaptureFixture):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=2)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: fast
+                run: "true"
+                needs: []
+              - id: slow
+                run: sleep 0.2
+                needs: []
+              - id: skipped
+                run: "true"
+                if: false
+            """
+        )
+    with caplog.at_level(logging.INFO, logger="tarmac.runner"):
+        runner.execute_workflow("workflow", {})
+    assert "Predicted critical path" not in caplog.text
+    assert "Actual critical path of workflow workflow: slow -> skipped" in caplog.text
+
+    with open(config_dir / ".tarmac" / "history" / "workflow.json") as f:
+        durations = json.load(f)["durations"]
+    assert set(durations) == {"fast", "slow"}
+    assert durations["slow"] > durations["fast"]
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger="tarmac.runner"):
+        runner.execute_workflow("workflow", {})
+    assert "Predicted critical path of workflow workflow: slow -> skipped" in (
+        caplog.text
+    )
@@ -0,0 +1,188 @@
+from pathlib import Path
+
+import pytest
+
+INVENTORY = """
+targets:
+  web1:
+    inputs:
+      region: eu
+  web2:
+    inputs:
+      region: us
+  web3:
+    inputs:
+      region: eu
+  db1:
+    inputs:
+      role: database
+groups:
+  web:
+    targets: [web1, web2, web3]
+    inputs:
+      role: web
+"""
+
+
+def test_select_targets():
+    from tarmac.inventory import Inventory
+
+    inventory = Inventory.load(INVENTORY)
+    targets = inventory.select("web")
+    assert [t.name for t in targets] == ["web1", "web2", "web3"]
+    assert targets[0].inputs == {"role": "web", "region": "eu"}
+    assert inventory.targets["web1"].inputs == {"region": "eu"}
+    assert [t.name for t in inventory.select("db1, web2")] == ["web2", "db1"]
+    assert [t.name for t in inventory.select("all")] == ["web1", "web2", "web3", "db1"]
+    with pytest.raises(ValueError, match="Unknown target or group: web4"):
+        inventory.select("web4")
+    with pytest.raises(ValueError, match="Group g contains unknown target x"):
+        Inventory.load("groups: {g: {targets: [x]}}")
+
+
+def test_local_target_directory(config_dir: Path, tmp_path: Path):
+    from tarmac.inventory import Target
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: write
+                run: mkdir sub && echo hello > sub/file
+              - id: read
+                run: pwd && cat file
+                with:
+                  cwd: sub
+                if: isfile('sub/file')
+            """
+        )
+    target = tmp_path / "target"
+    target.mkdir()
+    outputs = runner.execute_workflow_on_targets(
+        "workflow", {}, [Target(name="fixed", path=str(target)), Target(name="temp")]
+    )
+    assert outputs["succeeded"] is True
+    assert (target / "sub" / "file").read_text() == "hello\n"
+    groups = outputs["results"]
+    assert [group["targets"] for group in groups] == [["fixed"], ["temp"]]
+    read = groups[0]["outputs"]["steps"]["read"]
+    assert read["output"] == f"{target / 'sub'}\nhello\n"
+    temp_dir = groups[1]["outputs"]["steps"]["read"]["output"].splitlines()[0]
+    assert temp_dir != str(target / "sub")
+    assert not Path(temp_dir).exists()
+
+
+def test_rolling_targets(config_dir: Path):
+    from tarmac.inventory import Inventory
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            inputs:
+              role:
+                type: str
+              region:
+                type: str
+                required: false
+                default: none
+            steps:
+              - id: deploy
+                py: |
+                  assert inputs['region'] != 'us'
+                  outputs['where'] = inputs['role'] + '@' + inputs['region']
+                with:
+                  role: ${role}
+                  region: ${region}
+            """
+        )
+    inventory = Inventory.load(INVENTORY)
+
+    outputs = runner.execute_workflow_on_targets(
+        "workflow", {}, inventory.select("all"), batch="2"
+    )
+    assert outputs["succeeded"] is False
+    assert outputs["failed"] == ["web2"]
+    assert outputs["not_run"] == []
+    groups = outputs["results"]
+    assert [group["targets"] for group in groups] == [
+        ["web1", "web3"],
+        ["web2"],
+        ["db1"],
+    ]
+    assert groups[0]["outputs"]["steps"]["deploy"]["where"] == "web@eu"
+    assert groups[2]["outputs"]["steps"]["deploy"]["where"] == "database@none"
+
+    outputs = runner.execute_workflow_on_targets(
+        "workflow", {}, inventory.select("all"), batch="50%", max_fail_percentage=40
+    )
+    assert outputs["failed"] == ["web2"]
+    assert outputs["not_run"] == ["web3", "db1"]
+
+    outputs = runner.execute_workflow_on_targets(
+        "workflow", {"region": "us"}, inventory.select("db1,web1")
+    )
+    assert outputs["failed"] == ["web1", "db1"]
+    assert [group["targets"] for group in outputs["results"]] == [["web1", "db1"]]
+
+    outputs = runner.execute_workflow_on_targets(
+        "workflow", {"unknown": "x"}, inventory.select("db1")
+    )
+    assert outputs["results"] == [
+        {
+            "targets": ["db1"],
+            "outputs": {"succeeded": False, "error": "Unknown input: unknown"},
+        }
+    ]
+
+    with pytest.raises(ValueError, match="Invalid batch size: x"):
+        runner.execute_workflow_on_targets("workflow", {}, [], batch="x")
+    with pytest.raises(ValueError, match="The batch size must be at least 1"):
+        runner.execute_workflow_on_targets("workflow", {}, [], batch=0)
+
+
+def test_remote_target(config_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    from loopback import LoopbackTransport
+
+    from tarmac.inventory import Inventory
+    from tarmac.runner import Runner
+
+    created = []
+
+    def loopback(host, user=None, port=None, cwd=None, ssh_options=None):
+        created.append((host, user, port, cwd, ssh_options))
+        return LoopbackTransport(cwd)
+
+    monkeypatch.setattr("tarmac.runner.SSHTransport", loopback)
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: pwd
+                run: pwd
+            """
+        )
+    inventory = Inventory.load(
+        f"""
+        targets:
+          remote:
+            host: example.com
+            user: deploy
+            port: 2222
+            path: {config_dir}
+        """
+    )
+    outputs = runner.execute_workflow_on_targets(
+        "workflow", {}, inventory.select("remote")
+    )
+    assert created == [("example.com", "deploy", 2222, str(config_dir), [])]
+    assert outputs["succeeded"] is True
+    steps = outputs["results"][0]["outputs"]["steps"]
+    assert steps["pwd"]["output"] == f"{config_dir}\n"
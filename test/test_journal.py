@@ -0,0 +1,235 @@
+import asyncio
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+
+def test_run_journal(tmp_path: Path):
+    from tarmac.journal import RunJournal, read_journal_header
+
+    path = tmp_path / "runs" / "1.jsonl"
+    journal = RunJournal.create(path, {"workflow": "deploy", "inputs": {}})
+    journal.record("start", step="build", index=0)
+    journal.record("finish", step="build", index=0, outputs={"succeeded": True})
+    journal.record("start", step="push", index=1)
+    journal.close()
+    assert read_journal_header(path)["workflow"] == "deploy"
+
+    # A record cut off by a crash is dropped when the journal is resumed.
+    with open(path, "a") as f:
+        f.write('{"event": "finish", "step": "pu')
+    journal = RunJournal.resume(path)
+    assert journal.finished_steps() == {0: {"succeeded": True}}
+    journal.record("finish", step="push", index=1, outputs={"succeeded": False})
+    journal.close()
+    lines = path.read_text().splitlines()
+    assert len(lines) == 5
+    assert json.loads(lines[-1])["step"] == "push"
+
+    (tmp_path / "bad.jsonl").write_text("{}\n")
+    with pytest.raises(ValueError, match="Invalid run journal"):
+        read_journal_header(tmp_path / "bad.jsonl")
+
+
+def _write_workflow(config_dir: Path, fail: Path) -> Path:
+    counter = config_dir / "counter"
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            f"""
+            inputs:
+              name:
+                type: str
+            steps:
+              - id: first
+                run: echo first >> {counter}; echo "$NAME"
+                with:
+                  env:
+                    NAME: ${{name}}
+              - id: second
+                run: echo second >> {counter}; test ! -e {fail}
+              - id: third
+                run: echo third >> {counter}; echo "${{FIRST}}"
+                with:
+                  env:
+                    FIRST: ${{steps.first.output}}
+            """
+        )
+    return counter
+
+
+def test_resume_workflow(config_dir: Path):
+    from tarmac.runner import Runner
+
+    fail = config_dir / "fail"
+    fail.touch()
+    counter = _write_workflow(config_dir, fail)
+    runner = Runner(base_path=str(config_dir))
+    outputs = runner.execute_workflow("workflow", {"name": "x"}, run_id="r1")
+    assert outputs["succeeded"] is False
+    assert counter.read_text() == "first\nsecond\n"
+    assert (config_dir / ".tarmac" / "runs" / "r1.jsonl").exists()
+
+    fail.unlink()
+    outputs = runner.resume_workflow("workflow", "r1")
+    assert outputs["succeeded"] is True
+    assert counter.read_text() == "first\nsecond\nsecond\nthird\n"
+    # The replayed outputs are available to the steps that were run.
+    assert outputs["steps"]["first"]["output"] == "x\n"
+    assert outputs["steps"]["third"]["output"] == "x\n\n"
+
+
+def test_resume_errors(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_workflow(config_dir, config_dir / "fail")
+    with open(config_dir / "workflows" / "other.yml", "w") as f:
+        f.write("steps: []\n")
+    runner = Runner(base_path=str(config_dir))
+    with pytest.raises(ValueError, match="Run r1 not found"):
+        runner.resume_workflow("workflow", "r1")
+    with pytest.raises(ValueError, match="Invalid run ID"):
+        runner.execute_workflow("workflow", {"name": "x"}, run_id="../r1")
+    runner.execute_workflow("workflow", {"name": "x"}, run_id="r1")
+    with pytest.raises(ValueError, match="is not a run of workflow other"):
+        runner.resume_workflow("other", "r1")
+    with open(config_dir / "workflows" / "workflow.yml", "a") as f:
+        f.write("\n# changed\n")
+    with pytest.raises(ValueError, match="Workflow workflow changed since run r1"):
+        runner.resume_workflow("workflow", "r1")
+
+
+def test_same_run_id_with_other_inputs(config_dir: Path):
+    from tarmac.runner import Runner
+
+    counter = _write_workflow(config_dir, config_dir / "fail")
+    runner = Runner(base_path=str(config_dir))
+    runner.execute_workflow("workflow", {"name": "x"}, run_id="r1")
+    outputs = runner.execute_workflow("workflow", {"name": "y"}, run_id="r1")
+    assert outputs["steps"]["first"]["output"] == "y\n"
+    assert counter.read_text().count("first") == 2
+
+
+def test_run_retention(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_workflow(config_dir, config_dir / "fail")
+    runner = Runner(base_path=str(config_dir))
+    runner.run_index.keep = 2
+    runs = config_dir / ".tarmac" / "runs"
+    for run_id in ("r1", "r2", "r3"):
+        runner.execute_workflow("workflow", {"name": run_id}, run_id=run_id)
+    # Only the journals of the latest runs of the workflow are kept.
+    assert runner.run_index.runs("workflow") == ["r2", "r3"]
+    assert sorted(path.name for path in runs.glob("*.jsonl")) == [
+        "r2.jsonl",
+        "r3.jsonl",
+    ]
+    # Resuming a run makes it the latest one.
+    runner.resume_workflow("workflow", "r2")
+    assert runner.run_index.runs("workflow") == ["r3", "r2"]
+
+    # Earlier outputs are looked up through the index, the latest run first.
+    stray = (runs / "r3.jsonl").read_text().replace("r3\\n", "stray\\n")
+    assert "stray" in stray
+    (runs / "stray.jsonl").write_text(stray)
+    found = runner._last_step_outputs("workflow", {"first"}, "r2")
+    assert found["first"]["output"] == "r3\n"
+
+
+def test_resume_nested_workflow(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+    from tarmac.runner import Runner
+
+    fail = config_dir / "fail"
+    fail.touch()
+    counter = _write_workflow(config_dir, fail)
+    with open(config_dir / "workflows" / "outer.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: nested
+                workflow: workflow
+                with:
+                  name: z
+            """
+        )
+    runner = Runner(base_path=str(config_dir), jobs=2)
+    outputs = runner.execute_workflow("outer", {}, run_id="r2")
+    assert outputs["succeeded"] is False
+    assert (config_dir / ".tarmac" / "runs" / "r2.nested.jsonl").exists()
+
+    fail.unlink()
+    async_runner = AsyncRunner(base_path=str(config_dir))
+    outputs = asyncio.run(async_runner.resume_workflow("outer", "r2"))
+    assert outputs["succeeded"] is True
+    # The nested workflow continued from its failed step too.
+    assert counter.read_text() == "first\nsecond\nsecond\nthird\n"
+    assert outputs["steps"]["nested"]["steps"]["third"]["output"] == "z\n\n"
+
+
+def test_resume_after_crash(config_dir: Path):
+    from tarmac.runner import Runner
+
+    log = config_dir / "log"
+    ready = config_dir / "ready"
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        # The steps have no IDs, and the second one kills the runner.
+        f.write(
+            f"""
+            steps:
+              - run: echo one >> {log}
+              - run: if test -e {ready}; then echo two >> {log}; else kill -9 $PPID; fi
+            """
+        )
+    script = (
+        "import sys\n"
+        "from tarmac.runner import Runner\n"
+        "Runner(base_path=sys.argv[1]).execute_workflow('workflow', {}, run_id='r1')\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script, str(config_dir)])
+    assert result.returncode == -9
+    assert log.read_text() == "one\n"
+
+    ready.touch()
+    outputs = Runner(base_path=str(config_dir)).resume_workflow("workflow", "r1")
+    assert outputs["succeeded"] is True
+    # Only the step that finished is replayed.
+    assert log.read_text() == "one\ntwo\n"
+
+
+def test_resume_command(config_dir: Path):
+    fail = config_dir / "fail"
+    fail.touch()
+    counter = _write_workflow(config_dir, fail)
+    command = [sys.executable, "-m", "tarmac", "workflow", "-b", str(config_dir)]
+    result = subprocess.run(
+        command + ["-i", "name=x", "--output-format", "json"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert json.loads(result.stdout)["succeeded"] is False
+    hint = result.stderr.strip().splitlines()[-1]
+    assert hint.startswith("Resume this run with: tarmac workflow --resume ")
+    run_id = hint.rsplit(" ", 1)[1]
+
+    fail.unlink()
+    result = subprocess.run(
+        command + ["--resume", run_id, "--output-format", "json"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert json.loads(result.stdout)["succeeded"] is True
+    assert counter.read_text() == "first\nsecond\nsecond\nthird\n"
+
+    result = subprocess.run(
+        command + ["--resume", "missing"], capture_output=True, text=True
+    )
+    assert result.returncode == 2
+    assert "Run missing not found" in result.stderr
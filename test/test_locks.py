@@ -0,0 +1,337 @@
+import asyncio
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+
+def test_concurrency_group():
+    from tarmac.metadata import WorkflowMetadata, WorkflowStep
+
+    step = WorkflowStep(run="true", concurrency={"group": "apt"})
+    assert step.concurrency is not None
+    assert step.concurrency.limit == 1
+    with pytest.raises(ValueError, match="`limit` must be at least 1"):
+        WorkflowStep(run="true", concurrency={"group": "apt", "limit": 0})
+    with pytest.raises(ValueError, match="`group` must not be empty"):
+        WorkflowStep(run="true", concurrency={"group": ""})
+    metadata = WorkflowMetadata(concurrency={"group": "deploy", "limit": 2})
+    assert metadata.concurrency is not None
+    assert metadata.concurrency.limit == 2
+
+
+def test_semaphore_is_fair(tmp_path: Path):
+    from tarmac.locks import GroupSemaphore
+
+    holder = GroupSemaphore(tmp_path, "db/primary")
+    first = GroupSemaphore(tmp_path, "db/primary")
+    second = GroupSemaphore(tmp_path, "db/primary")
+    holder.acquire()
+    first.join()
+    second.join()
+    assert not first.try_acquire()
+    holder.release()
+    # The second waiter may not overtake the first one.
+    assert not second.try_acquire()
+    assert first.try_acquire()
+    assert not second.try_acquire()
+    first.release()
+    assert second.try_acquire()
+    second.release()
+
+
+def test_semaphore_limit(tmp_path: Path):
+    from tarmac.locks import GroupSemaphore
+
+    semaphores = [GroupSemaphore(tmp_path, "build", limit=2) for _ in range(3)]
+    semaphores[0].acquire()
+    semaphores[1].acquire()
+    assert not semaphores[2].try_acquire()
+    semaphores[0].release()
+    assert semaphores[2].try_acquire()
+    semaphores[1].release()
+    semaphores[2].release()
+
+
+def test_semaphore_timeout(tmp_path: Path):
+    from tarmac.locks import GroupSemaphore
+
+    holder = GroupSemaphore(tmp_path, "build")
+    holder.acquire()
+    start = time.monotonic()
+    assert GroupSemaphore(tmp_path, "build").acquire(timeout=0.2) is None
+    assert 0.2 <= time.monotonic() - start < 0.5
+    # The waiter that gave up left the queue.
+    holder.release()
+    assert GroupSemaphore(tmp_path, "build").acquire(timeout=0.2) is not None
+
+
+def test_semaphore_drops_dead_waiters(tmp_path: Path):
+    from tarmac.locks import GroupSemaphore
+
+    p = subprocess.Popen([sys.executable, "-c", "pass"])
+    p.wait()
+    with open(tmp_path / "build.queue", "w") as f:
+        f.write(f'[["gone", {p.pid}]]')
+    semaphore = GroupSemaphore(tmp_path, "build")
+    assert semaphore.try_acquire()
+    semaphore.release()
+
+
+def test_semaphore_across_processes(tmp_path: Path):
+    from tarmac.locks import GroupSemaphore
+
+    script = (
+        "import sys, time\n"
+        "from pathlib import Path\n"
+        "from tarmac.locks import GroupSemaphore\n"
+        "semaphore = GroupSemaphore(Path(sys.argv[1]), 'deploy')\n"
+        "semaphore.acquire()\n"
+        "print('locked', flush=True)\n"
+        "time.sleep(0.5)\n"
+    )
+    p = subprocess.Popen(
+        [sys.executable, "-c", script, str(tmp_path)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert p.stdout is not None
+        assert p.stdout.readline() == "locked\n"
+        waited = GroupSemaphore(tmp_path, "deploy").acquire()
+    finally:
+        p.wait()
+    # The slot is freed when the other process exits.
+    assert waited >= 0.2
+
+
+def test_step_concurrency(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=4)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: deploy
+                run: sleep 0.3
+                matrix:
+                  region: [eu, us, ap, sa]
+                concurrency:
+                  group: deploy-${inputs_group}
+                  limit: 2
+              - id: unrelated
+                run: "true"
+                concurrency:
+                  group: other
+            inputs:
+              inputs_group:
+                type: str
+            """
+        )
+    start = time.monotonic()
+    outputs = runner.execute_workflow("workflow", {"inputs_group": "prod"})
+    elapsed = time.monotonic() - start
+    assert outputs["succeeded"] is True
+    assert 0.6 <= elapsed < 1.0
+    instances = outputs["steps"]["deploy"]["instances"]
+    groups = {out["concurrency"]["group"] for out in instances.values()}
+    assert groups == {"deploy-prod"}
+    waits = sorted(out["concurrency"]["waited"] for out in instances.values())
+    assert waits[1] < 0.1
+    assert waits[2] >= 0.2
+    assert outputs["steps"]["unrelated"]["concurrency"]["group"] == "other"
+    assert (config_dir / ".tarmac" / "locks" / "deploy-prod.0.lock").exists()
+
+
+def _write_workflow_with_group(config_dir: Path):
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            concurrency:
+              group: release
+            steps:
+              - id: release
+                run: sleep 0.3
+            """
+        )
+
+
+def test_workflow_concurrency(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_workflow_with_group(config_dir)
+    runner = Runner(base_path=str(config_dir))
+    results = []
+
+    def run():
+        results.append(runner.execute_workflow("workflow", {}))
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    assert elapsed >= 0.6
+    assert all(out["succeeded"] for out in results)
+    waits = sorted(out["concurrency"]["waited"] for out in results)
+    assert waits[0] < 0.1
+    assert waits[1] >= 0.2
+
+
+def test_async_workflow_concurrency(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+
+    _write_workflow_with_group(config_dir)
+    runner = AsyncRunner(base_path=str(config_dir))
+
+    async def main():
+        return await asyncio.gather(
+            runner.execute_workflow("workflow", {}),
+            runner.execute_workflow("workflow", {}),
+        )
+
+    start = time.monotonic()
+    results = asyncio.run(main())
+    elapsed = time.monotonic() - start
+    assert elapsed >= 0.6
+    assert all(out["succeeded"] for out in results)
+    waits = sorted(out["concurrency"]["waited"] for out in results)
+    assert waits[1] >= 0.2
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_reentrant_concurrency_group(jobs: int, config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+    from tarmac.runner import Runner
+
+    (config_dir / "workflows").mkdir(exist_ok=True)
+    with open(config_dir / "workflows" / "outer.yml", "w") as f:
+        f.write(
+            """
+            concurrency:
+              group: deploy
+            steps:
+              - id: step
+                run: "true"
+                concurrency:
+                  group: deploy
+              - id: other
+                run: "true"
+                needs: []
+                concurrency:
+                  group: other
+              - id: nested
+                workflow: inner
+            """
+        )
+    with open(config_dir / "workflows" / "inner.yml", "w") as f:
+        f.write(
+            """
+            concurrency:
+              group: deploy
+            steps:
+              - id: step
+                run: "true"
+                concurrency:
+                  group: deploy
+            """
+        )
+    results = []
+
+    def run():
+        runner = Runner(base_path=str(config_dir), jobs=jobs)
+        results.append(runner.execute_workflow("outer", {}))
+        async_runner = AsyncRunner(base_path=str(config_dir), jobs=jobs)
+        results.append(asyncio.run(async_runner.execute_workflow("outer", {})))
+
+    # The steps and nested workflow do not wait for the group the run holds.
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    for outputs in results:
+        assert outputs["succeeded"] is True
+        assert outputs["steps"]["step"]["concurrency"] == {
+            "group": "deploy",
+            "waited": 0.0,
+        }
+        assert outputs["steps"]["nested"]["concurrency"]["group"] == "deploy"
+        assert outputs["steps"]["other"]["concurrency"]["group"] == "other"
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_concurrency_wait_timeout(jobs: int, config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+    from tarmac.locks import GroupSemaphore
+    from tarmac.runner import Runner
+
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "step.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: wait
+                run: "true"
+                timeout: 0.4
+                concurrency:
+                  group: busy
+            """
+        )
+    with open(config_dir / "workflows" / "run.yml", "w") as f:
+        f.write(
+            """
+            deadline: 0.4
+            concurrency:
+              group: busy
+            steps:
+              - run: "true"
+            """
+        )
+    holder = GroupSemaphore(config_dir / ".tarmac" / "locks", "busy")
+    holder.acquire()
+    try:
+        for runner in (
+            Runner(base_path=str(config_dir), jobs=jobs),
+            AsyncRunner(base_path=str(config_dir), jobs=jobs),
+        ):
+            for name in ("step", "run"):
+                start = time.monotonic()
+                outputs = runner.execute_workflow(name, {})
+                if asyncio.iscoroutine(outputs):
+                    outputs = asyncio.run(outputs)
+                # The wait for the group is bounded by the timeout.
+                assert time.monotonic() - start < 1.0
+                assert outputs["succeeded"] is False
+                if name == "step":
+                    outputs = outputs["steps"]["wait"]
+                assert outputs["timed_out"] is True
+                assert outputs["concurrency"]["timed_out"] is True
+    finally:
+        holder.release()
+
+    # The time spent waiting is taken from the timeout of the step.
+    with open(config_dir / "workflows" / "step.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: wait
+                run: sleep 0.4
+                timeout: 0.6
+                concurrency:
+                  group: busy
+            """
+        )
+    holder.acquire()
+    threading.Timer(0.3, holder.release).start()
+    outputs = Runner(base_path=str(config_dir), jobs=jobs).execute_workflow("step", {})
+    step = outputs["steps"]["wait"]
+    assert step["concurrency"]["waited"] >= 0.25
+    assert step["timed_out"] is True
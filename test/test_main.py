@@ -2,6 +2,8 @@ import subprocess
 import sys
 from pathlib import Path
 
+import pytest
+
 
 def run_tarmac(*args: str) -> subprocess.CompletedProcess:
     """Run the tarmac command with the given arguments."""
@@ -22,6 +24,8 @@ def test_help():
     assert "--base-path" in output
     assert "--inputs" in output
     assert "--output-file" in output
+    assert "--jobs" in output
+    assert "--capacity" in output
 
 
 def test_version():
@@ -415,3 +419,99 @@ run(main)
         '  "output": "This is a test log message\\n"\n'
         "}"
     )
+
+
+def test_graph_output(config_dir: Path):
+    """Test printing the dependencies between the workflow steps."""
+    import json
+
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "simple.yml", "w") as f:
+        f.write(
+            """
+infer_needs: true
+steps:
+  - id: first
+    run: echo first
+  - id: second
+    run: cat
+    with:
+      stdin: ${steps.first.output}
+"""
+        )
+    p = run_tarmac(
+        "simple",
+        "--base-path",
+        str(config_dir),
+        "--graph",
+        "--output-format",
+        "json",
+    )
+    assert json.loads(p.stdout) == {
+        "steps": {
+            "first": {"needs": [], "barrier": False},
+            "second": {"needs": ["first"], "barrier": False},
+        }
+    }
+
+
+def test_targets_output(config_dir: Path):
+    """Test running a workflow against inventory targets."""
+    import json
+
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "simple.yml", "w") as f:
+        f.write(
+            """
+inputs:
+  name:
+    type: str
+steps:
+  - id: greet
+    run: echo "hello $NAME"
+    with:
+      env:
+        NAME: ${name}
+"""
+        )
+    with open(config_dir / "inventory.yml", "w") as f:
+        f.write(
+            """
+targets:
+  one:
+    inputs:
+      name: world
+  two:
+    inputs:
+      name: world
+  three:
+    inputs:
+      name: there
+groups:
+  pair:
+    targets: [one, two]
+"""
+        )
+    p = run_tarmac(
+        "simple",
+        "--base-path",
+        str(config_dir),
+        "--targets",
+        "pair,three",
+        "--batch",
+        "1",
+        "--output-format",
+        "json",
+    )
+    result = json.loads(p.stdout)
+    assert result["succeeded"] is True
+    assert [group["targets"] for group in result["results"]] == [
+        ["one", "two"],
+        ["three"],
+    ]
+    assert (
+        result["results"][1]["outputs"]["steps"]["greet"]["output"] == "hello there\n"
+    )
+
+    with pytest.raises(RuntimeError, match="--batch requires --targets"):
+        run_tarmac("simple", "--base-path", str(config_dir), "--batch", "1")
@@ -0,0 +1,266 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+
+def test_matrix_step(config_dir: Path):
+    from tarmac.metadata import ValueMapping, WorkflowStep
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            inputs:
+              regions:
+                type: list
+            steps:
+              - id: deploy
+                py: outputs['target'] = inputs['target']
+                matrix:
+                  service: [api, web]
+                  region: ${regions}
+                with:
+                  target: ${matrix.service}@${matrix.region}
+              - id: after
+                py: outputs['seen'] = sorted(steps['deploy']['instances'])
+            """
+        )
+    seen: list[tuple[str, ValueMapping]] = []
+
+    def before_each(step: WorkflowStep, params: ValueMapping):
+        seen.append((str(step.id), params))
+
+    outputs = runner.execute_workflow(
+        "workflow", {"regions": ["eu", "us"]}, before_each=before_each
+    )
+    assert outputs["succeeded"] is True
+    assert list(outputs["steps"]) == ["deploy", "after"]
+    deploy = outputs["steps"]["deploy"]
+    assert deploy["succeeded"] is True
+    assert deploy["instances"] == {
+        "deploy-api-eu": {"succeeded": True, "target": "api@eu"},
+        "deploy-api-us": {"succeeded": True, "target": "api@us"},
+        "deploy-web-eu": {"succeeded": True, "target": "web@eu"},
+        "deploy-web-us": {"succeeded": True, "target": "web@us"},
+    }
+    assert outputs["steps"]["after"]["seen"] == list(deploy["instances"])
+    assert seen[:4] == [
+        ("deploy-api-eu", {"target": "api@eu"}),
+        ("deploy-api-us", {"target": "api@us"}),
+        ("deploy-web-eu", {"target": "web@eu"}),
+        ("deploy-web-us", {"target": "web@us"}),
+    ]
+
+
+def test_matrix_max_parallel(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: sleep
+                run: sleep 0.3
+                matrix:
+                  n: [1, 2, 3, 4]
+                max-parallel: 2
+            """
+        )
+    start = time.monotonic()
+    outputs = runner.execute_workflow("workflow", {})
+    elapsed = time.monotonic() - start
+    assert outputs["succeeded"] is True
+    assert len(outputs["steps"]["sleep"]["instances"]) == 4
+    assert 0.6 <= elapsed < 1.1
+
+
+def test_matrix_fail_fast(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: check
+                run: test "$N" != 2
+                matrix:
+                  n: ["1", "2", "3"]
+                with:
+                  env:
+                    N: ${matrix.n}
+              - id: all
+                run: test "$N" != 2
+                matrix:
+                  n: ["1", "2", "3"]
+                with:
+                  env:
+                    N: ${matrix.n}
+                fail-fast: false
+                needs: []
+            """
+        )
+    outputs = runner.execute_workflow("workflow", {})
+    assert outputs["succeeded"] is False
+    check = outputs["steps"]["check"]
+    assert check["succeeded"] is False
+    assert list(check["instances"]) == ["check-1", "check-2"]
+    assert check["instances"]["check-2"]["succeeded"] is False
+    assert "all" not in outputs["steps"]
+
+    runner = Runner(base_path=str(config_dir), jobs=2)
+    outputs = runner.execute_workflow("workflow", {})
+    instances = outputs["steps"]["all"]["instances"]
+    assert outputs["steps"]["all"]["succeeded"] is False
+    assert [out["succeeded"] for out in instances.values()] == [True, False, True]
+
+
+def test_matrix_condition(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: some
+                run: echo "$N"
+                matrix:
+                  n: [1, 2]
+                with:
+                  env:
+                    N: n=${matrix.n}
+                if: matrix.n == 2
+              - id: none
+                run: "true"
+                matrix:
+                  n: [1, 2]
+                if: false
+              - id: empty
+                run: "true"
+                matrix:
+                  n: []
+            """
+        )
+    outputs = runner.execute_workflow("workflow", {})
+    assert outputs["succeeded"] is True
+    assert outputs["steps"]["some"]["succeeded"] is True
+    assert outputs["steps"]["some"]["instances"]["some-1"] == {"succeeded": None}
+    assert outputs["steps"]["some"]["instances"]["some-2"]["output"] == "n=2\n"
+    assert outputs["steps"]["none"]["succeeded"] is None
+    assert outputs["steps"]["empty"] == {"succeeded": True, "instances": {}}
+
+
+def test_invalid_matrix(config_dir: Path):
+    from tarmac.metadata import WorkflowStep
+    from tarmac.runner import Runner
+
+    with pytest.raises(ValueError, match="Cannot use `max-parallel` without `matrix`"):
+        WorkflowStep(run="true", **{"max-parallel": 2})
+    with pytest.raises(ValueError, match="`max-parallel` must be at least 1"):
+        WorkflowStep(run="true", matrix={"n": [1]}, **{"max-parallel": 0})
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: step
+                run: "true"
+                matrix:
+                  n: ${'1, 2'}
+            """
+        )
+    with pytest.raises(ValueError, match="Matrix value n of step step must be a list"):
+        runner.execute_workflow("workflow", {})
+
+
+def test_matrix_references():
+    from tarmac.analysis import step_references
+    from tarmac.metadata import WorkflowStep
+
+    step = WorkflowStep(
+        run="true",
+        matrix={"n": "${steps.list.items}"},
+        **{"if": "matrix.n > 1"},
+    )
+    assert step_references(step) == {"list"}
+
+
+def test_async_matrix(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+
+    runner = AsyncRunner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: sleep
+                run: sleep 0.3; echo "$N"
+                matrix:
+                  n: ["1", "2", "3"]
+                with:
+                  env:
+                    N: ${matrix.n}
+                max-parallel: 3
+            """
+        )
+    start = time.monotonic()
+    outputs = asyncio.run(runner.execute_workflow("workflow", {}))
+    elapsed = time.monotonic() - start
+    assert elapsed < 0.8
+    assert outputs["succeeded"] is True
+    assert [
+        out["output"] for out in outputs["steps"]["sleep"]["instances"].values()
+    ] == ["1\n", "2\n", "3\n"]
+
+
+def test_matrix_variable(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: whole
+                py: outputs['matrix'] = inputs['matrix']
+                matrix:
+                  n: [1]
+                with:
+                  matrix: ${matrix}
+            """
+        )
+    with open(config_dir / "workflows" / "missing.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: missing
+                py: pass
+                matrix:
+                  n: [1]
+                with:
+                  m: ${matrix.m}
+            """
+        )
+    seen = []
+    outputs = runner.execute_workflow(
+        "workflow", {}, before_each=lambda step, params: seen.append(params)
+    )
+    instance = outputs["steps"]["whole"]["instances"]["whole-1"]
+    assert instance["matrix"] == {"n": 1}
+    assert type(seen[0]["matrix"]) is dict
+    # Unlike with a DotMap, a key that is not an axis is an error.
+    with pytest.raises(AttributeError, match="No key 'm'"):
+        runner.execute_workflow("missing", {})
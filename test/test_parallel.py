@@ -0,0 +1,167 @@
+import time
+from pathlib import Path
+
+import pytest
+
+
+def test_parallel_steps(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=3)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: step1
+                run: sleep 0.5
+                needs: []
+              - id: step2
+                run: sleep 0.5
+                needs: []
+              - id: step3
+                run: sleep 0.5
+                needs: []
+              - id: step4
+                py: outputs['seen'] = sorted(steps)
+                needs: [step1, step2, step3]
+            """
+        )
+    start = time.monotonic()
+    outputs = runner.execute_workflow("workflow", {})
+    elapsed = time.monotonic() - start
+    assert elapsed < 1.2
+    assert outputs["succeeded"] is True
+    assert list(outputs["steps"]) == ["step1", "step2", "step3", "step4"]
+    assert outputs["steps"]["step4"]["seen"] == ["step1", "step2", "step3"]
+
+
+def test_steps_without_needs_run_in_order(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=4)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: step1
+                run: sleep 0.2
+              - id: step2
+                py: outputs['seen'] = sorted(steps)
+              - id: step3
+                py: outputs['seen'] = sorted(steps)
+            """
+        )
+    outputs = runner.execute_workflow("workflow", {})
+    assert outputs["steps"]["step2"]["seen"] == ["step1"]
+    assert outputs["steps"]["step3"]["seen"] == ["step1", "step2"]
+
+
+def test_needs_later_step(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: step1
+                py: outputs['seen'] = sorted(steps)
+                needs: step2
+              - id: step2
+                py: outputs['seen'] = sorted(steps)
+                needs: []
+            """
+        )
+    outputs = runner.execute_workflow("workflow", {})
+    assert list(outputs["steps"]) == ["step1", "step2"]
+    assert outputs["steps"]["step1"]["seen"] == ["step2"]
+    assert outputs["steps"]["step2"]["seen"] == []
+
+
+def test_parallel_fail_fast(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=2)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: fail
+                run: exit 1
+                needs: []
+              - id: slow
+                run: sleep 0.3
+                needs: []
+              - id: after_fail
+                run: echo "Never runs"
+                needs: [fail]
+              - id: after_slow
+                run: echo "Never runs"
+                needs: [slow]
+            """
+        )
+    outputs = runner.execute_workflow("workflow", {})
+    assert outputs["succeeded"] is False
+    assert list(outputs["steps"]) == ["fail", "slow"]
+    assert outputs["steps"]["fail"]["succeeded"] is False
+    assert outputs["steps"]["slow"]["succeeded"] is True
+
+
+def test_invalid_needs(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=2)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: step1
+                run: echo "Hello, World!"
+                needs: [nonexistent]
+            """
+        )
+    with pytest.raises(ValueError, match="Step step1 needs unknown step nonexistent"):
+        runner.execute_workflow("workflow", {})
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: step1
+                run: echo "Hello, World!"
+                needs: [step2]
+              - id: step2
+                run: echo "Hello, World!"
+                needs: [step1]
+            """
+        )
+    with pytest.raises(
+        ValueError, match="Dependency cycle between steps: step1, step2"
+    ):
+        runner.execute_workflow("workflow", {})
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: step1
+                run: echo "Hello, World!"
+              - id: step1
+                run: echo "Hello, World!"
+              - id: step2
+                run: echo "Hello, World!"
+                needs: [step1]
+            """
+        )
+    with pytest.raises(ValueError, match="Duplicate step ID step1"):
+        runner.execute_workflow("workflow", {})
+
+
+def test_invalid_jobs(config_dir: Path):
+    from tarmac.runner import Runner
+
+    with pytest.raises(ValueError, match="The number of jobs must be at least 1"):
+        Runner(base_path=str(config_dir), jobs=0)
@@ -0,0 +1,176 @@
+from pathlib import Path
+
+import pytest
+
+SCRIPT = """
+# /// script
+# dependencies = []
+# ///
+import os
+from tarmac.operations import run
+
+def main(op):
+    op.outputs["pid"] = os.getpid()
+
+run(main)
+"""
+
+
+def _write_workflows(config_dir: Path) -> None:
+    (config_dir / "workflows").mkdir()
+    (config_dir / "scripts").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            inputs:
+              flag:
+                type: bool
+                required: false
+                default: false
+            steps:
+              - id: wait
+                run: sleep 0.5
+              - id: first
+                do: first
+              - id: flagged
+                do: flagged
+                if: inputs.flag and platform
+              - id: after
+                do: after
+                if: steps.first.succeeded
+              - id: never
+                do: never
+                if: false
+              - id: cold
+                do: first
+                warm: false
+              - id: file
+                do: file
+                if: isfile('missing')
+              - id: nested
+                workflow: nested
+            """
+        )
+    with open(config_dir / "workflows" / "nested.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - do: nested
+                warm: false
+            """
+        )
+    for name in ("first", "flagged", "after", "never", "file", "nested"):
+        with open(config_dir / "scripts" / f"{name}.py", "w") as f:
+            f.write(SCRIPT)
+
+
+def test_upcoming_scripts(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_workflows(config_dir)
+    runner = Runner(base_path=str(config_dir))
+    run = runner._start_workflow("workflow", {})
+    run.close()
+    assert runner._upcoming_scripts(run) == [
+        ("first", True),
+        ("after", True),
+        ("first", False),
+        ("file", True),
+    ]
+    # Nested workflows are only loaded when their steps start.
+    assert config_dir / "workflows" / "nested.yml" not in runner._workflows
+    run = runner._start_workflow("workflow", {"flag": True})
+    run.close()
+    assert ("flagged", True) in runner._upcoming_scripts(run)
+
+    with pytest.raises(ValueError, match="at least 1"):
+        Runner(base_path=str(config_dir), prefetch=-1)
+
+
+@pytest.mark.parametrize("mode", ["uv", "cached_envs", "warm_workers"])
+def test_prefetch_environments(mode: str, config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_workflows(config_dir)
+    options = {mode: True} if mode != "uv" else {}
+    with Runner(base_path=str(config_dir), prefetch=2, **options) as runner:
+        assert runner.prefetcher is not None
+        prepared = []
+        prepare = runner.prefetcher.prepare
+
+        def record(name: str, warm: bool) -> None:
+            prepared.append((name, warm))
+            prepare(name, warm)
+
+        runner.prefetcher.prepare = record
+        outputs = runner.execute_workflow("workflow", {})
+        assert outputs["succeeded"] is True
+        assert outputs["steps"]["flagged"]["succeeded"] is None
+        # The environments are ready while the first step runs.
+        assert ("first", True) in prepared
+        assert ("after", True) in prepared
+        assert ("flagged", True) not in prepared
+        assert ("never", True) not in prepared
+        # The run of the nested workflow prefetches its own scripts.
+        assert ("nested", False) in prepared
+        assert ("nested", True) not in prepared
+        if runner.workers is not None:
+            # The steps run in the workers started ahead of them.
+            steps = outputs["steps"]
+            assert steps["first"]["pid"] == steps["after"]["pid"]
+            assert steps["cold"]["pid"] != steps["first"]["pid"]
+
+
+def test_prefetch_concurrency(config_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    import sys
+    import threading
+    import time
+
+    from tarmac.envs import ScriptEnvironments
+    from tarmac.runner import Runner
+
+    built: list[str] = []
+    active: list[str] = []
+    overlap = 0
+    lock = threading.Lock()
+
+    def prepare(self, key: str, source: str) -> Path:
+        nonlocal overlap
+        with lock:
+            built.append(key)
+            active.append(key)
+            overlap = max(overlap, len(active))
+        time.sleep(0.3)
+        with lock:
+            active.remove(key)
+        return Path(sys.executable)
+
+    monkeypatch.setattr(ScriptEnvironments, "_prepare", prepare)
+    (config_dir / "workflows").mkdir()
+    (config_dir / "scripts").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - do: first
+              - do: second
+              - do: third
+            """
+        )
+    for name in ("first", "second", "third"):
+        # Different metadata, so that each script gets its own environment.
+        with open(config_dir / "scripts" / f"{name}.py", "w") as f:
+            f.write(
+                SCRIPT.replace(
+                    "import os",
+                    f"# /// tarmac\n# description: {name}\n# ///\nimport os",
+                )
+            )
+    with Runner(base_path=str(config_dir), cached_envs=True, prefetch=2) as runner:
+        runner._start_workflow("workflow", {}).close()
+        deadline = time.monotonic() + 5
+        while len(built) < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    # The environments are prepared two at a time.
+    assert len(set(built)) == 3
+    assert overlap == 2
@@ -0,0 +1,111 @@
+import threading
+from pathlib import Path
+
+import pytest
+
+
+def test_step_definitions_are_immutable():
+    from pydantic import ValidationError
+
+    from tarmac.metadata import WorkflowStep
+
+    step = WorkflowStep(name="step1", run="echo", **{"with": {"stdin": "${x}"}})
+    assert step.id == "step1"
+    assert step.type == "shell"
+    with pytest.raises(ValidationError):
+        step.params = {}
+    with pytest.raises(ValidationError):
+        step.type = "python"
+
+
+def test_concurrent_workflow_runs(config_dir: Path):
+    from tarmac.metadata import ValueMapping, WorkflowStep
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=2)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            inputs:
+              n:
+                type: int
+            steps:
+              - id: shell
+                run:
+                  - cat
+                  - echo "$N"
+                with:
+                  stdin: "stdin=${n}\\n"
+                  env:
+                    N: "env=${n}"
+              - id: python
+                py: outputs['n'] = inputs['n'] * 2
+                with:
+                  n: ${n}
+                needs: []
+              - id: combined
+                py: outputs['text'] = inputs['text']
+                with:
+                  text: "${steps.shell.output}${steps.python.n}"
+                needs: [shell, python]
+              - id: nested
+                workflow: nested
+                with:
+                  n: ${n}
+                if: steps.combined.succeeded
+            """
+        )
+    with open(config_dir / "workflows" / "nested.yml", "w") as f:
+        f.write(
+            """
+            inputs:
+              n:
+                type: int
+            steps:
+              - id: echo
+                run: echo ${n}
+                with:
+                  env:
+                    UNUSED: "n=${n}"
+            """
+        )
+
+    threads = 16
+    runs_per_thread = 5
+    barrier = threading.Barrier(threads)
+    results: dict[int, ValueMapping] = {}
+    errors: list[BaseException] = []
+    params_seen: dict[int, list[ValueMapping]] = {}
+
+    def before_each(step: WorkflowStep, params: ValueMapping):
+        if step.id == "python":
+            params_seen.setdefault(params["n"], []).append(params)
+
+    def worker(thread: int):
+        try:
+            barrier.wait()
+            for i in range(runs_per_thread):
+                n = thread * runs_per_thread + i
+                results[n] = runner.execute_workflow(
+                    "workflow", {"n": n}, before_each=before_each
+                )
+        except BaseException as e:  # pragma: no cover
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    assert errors == []
+    assert sorted(results) == list(range(threads * runs_per_thread))
+    for n, outputs in results.items():
+        assert outputs["succeeded"] is True
+        assert list(outputs["steps"]) == ["shell", "python", "combined", "nested"]
+        assert outputs["steps"]["shell"]["output"] == f"stdin={n}\nenv={n}\n"
+        assert outputs["steps"]["python"]["n"] == n * 2
+        assert outputs["steps"]["combined"]["text"] == f"stdin={n}\nenv={n}\n{n * 2}"
+        assert outputs["steps"]["nested"]["steps"]["echo"]["succeeded"] is True
+        assert params_seen[n] == [{"n": n}]
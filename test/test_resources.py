@@ -0,0 +1,183 @@
+import time
+from pathlib import Path
+
+import pytest
+
+
+def test_parse_size():
+    from tarmac.metadata import parse_size
+
+    assert parse_size(100) == 100
+    assert parse_size("100") == 100
+    assert parse_size("1k") == 1024
+    assert parse_size("512M") == 512 * 1024**2
+    assert parse_size("1.5GiB") == 3 * 1024**3 // 2
+    assert parse_size("2 TB") == 2 * 1024**4
+    with pytest.raises(ValueError, match="Invalid size: lots"):
+        parse_size("lots")
+
+
+def test_step_resources():
+    from tarmac.metadata import WorkflowStep
+
+    step = WorkflowStep(run="true", resources={"cpu": 2, "memory": "1G", "io": "heavy"})
+    assert step.resources is not None
+    assert step.resources.memory == 1024**3
+    with pytest.raises(ValueError, match="`cpu` must not be negative"):
+        WorkflowStep(run="true", resources={"cpu": -1})
+    with pytest.raises(ValueError):
+        WorkflowStep(run="true", resources={"io": "extreme"})
+
+
+def test_resource_pool():
+    from tarmac.metadata import StepResources, parse_size
+    from tarmac.resources import Capacity, ResourcePool
+
+    capacity = Capacity(cpu=4, memory="1G", io=4)
+    assert capacity.memory == 1024**3
+    pool = ResourcePool(capacity)
+    compile_step = StepResources(cpu=3, memory=parse_size("512M"))
+    migrate = StepResources(cpu=2)
+    rsync = StepResources(io="heavy")
+    assert pool.fits(compile_step)
+    pool.acquire(compile_step)
+    assert not pool.fits(migrate)
+    assert pool.fits(rsync)
+    pool.acquire(rsync)
+    assert not pool.fits(StepResources(io="light"))
+    assert not pool.fits(StepResources(memory=parse_size("600M")))
+    pool.release(compile_step)
+    assert pool.fits(migrate)
+
+    unlimited = ResourcePool(Capacity())
+    assert unlimited.fits(StepResources(cpu=1000, memory=parse_size("1T")))
+
+    detected = Capacity.detect(io=2)
+    assert detected.cpu is not None and detected.cpu >= 1
+    assert detected.io == 2
+
+
+def test_scheduler_resources():
+    from tarmac.metadata import WorkflowStep
+    from tarmac.resources import Capacity, ResourcePool
+    from tarmac.scheduler import StepScheduler
+
+    steps = [
+        WorkflowStep(id="big", run="true", needs=[], resources={"cpu": 8}),
+        WorkflowStep(id="small", run="true", needs=[], resources={"cpu": 1}),
+        WorkflowStep(id="free", run="true", needs=[]),
+    ]
+    scheduler = StepScheduler(steps, resources=ResourcePool(Capacity(cpu=2)))
+    # A step larger than the capacity can still run on its own.
+    assert scheduler.fits(0)
+    scheduler.start(0)
+    assert not scheduler.fits(1)
+    assert scheduler.fits(2)
+    scheduler.finish(0)
+    assert scheduler.fits(1)
+
+
+def test_workflow_waits_for_resources(config_dir: Path):
+    from tarmac.resources import Capacity
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=4, capacity=Capacity(cpu=2))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: compile
+                run: sleep 0.4
+                needs: []
+                resources:
+                  cpu: 2
+              - id: migrate
+                run: sleep 0.4
+                needs: []
+                resources:
+                  cpu: 1
+              - id: sync1
+                run: sleep 0.4
+                needs: []
+                resources:
+                  io: heavy
+              - id: sync2
+                run: sleep 0.4
+                needs: []
+                resources:
+                  io: heavy
+              - id: sync3
+                run: sleep 0.4
+                needs: []
+                resources:
+                  io: heavy
+            """
+        )
+    start = time.monotonic()
+    outputs = runner.execute_workflow("workflow", {})
+    elapsed = time.monotonic() - start
+    assert outputs["succeeded"] is True
+    # compile, sync1 and sync2 run first; migrate and sync3 wait for them.
+    assert 0.8 <= elapsed < 1.2
+
+
+def test_runs_share_resources(config_dir: Path):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from tarmac.async_runner import AsyncRunner
+    from tarmac.resources import Capacity
+    from tarmac.runner import Runner
+
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "parent.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: first
+                workflow: child
+                needs: []
+                resources:
+                  cpu: 2
+              - id: second
+                workflow: child
+                needs: []
+            """
+        )
+    with open(config_dir / "workflows" / "child.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - run: sleep 0.4
+                resources:
+                  cpu: 2
+            """
+        )
+    capacity = Capacity(cpu=2)
+
+    # The steps of parallel nested workflows do not run at the same time.
+    runner = Runner(base_path=str(config_dir), jobs=2, capacity=capacity)
+    start = time.monotonic()
+    assert runner.execute_workflow("parent", {})["succeeded"] is True
+    assert time.monotonic() - start >= 0.8
+    assert runner.resources.steps == 0
+
+    # Nor do those of concurrent runs.
+    runner = Runner(base_path=str(config_dir), capacity=capacity)
+    start = time.monotonic()
+    with ThreadPoolExecutor(2) as pool:
+        results = list(pool.map(lambda _: runner.execute_workflow("child", {}), [0, 1]))
+    assert all(outputs["succeeded"] for outputs in results)
+    assert time.monotonic() - start >= 0.8
+
+    async def run_both(runner: AsyncRunner) -> list:
+        return await asyncio.gather(
+            runner.execute_workflow("child", {}), runner.execute_workflow("child", {})
+        )
+
+    runner = AsyncRunner(base_path=str(config_dir), capacity=capacity)
+    start = time.monotonic()
+    results = asyncio.run(run_both(runner))
+    assert all(outputs["succeeded"] for outputs in results)
+    assert time.monotonic() - start >= 0.8
@@ -0,0 +1,114 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+
+def test_step_selection():
+    from tarmac.metadata import WorkflowStep
+    from tarmac.scheduler import StepSelection, resolve_dependencies
+
+    steps = [
+        WorkflowStep(id="build", run="true", needs=[]),
+        WorkflowStep(id="test", run="true", needs=["build"], tags=["check"]),
+        WorkflowStep(id="lint", run="true", needs=[], tags=["check"]),
+        WorkflowStep(id="deploy", run="true", needs=["test", "lint"]),
+    ]
+    dependencies = resolve_dependencies(steps)
+    assert StepSelection(only=["check"]).select(steps, dependencies) == {1, 2}
+    assert StepSelection(start=["test"]).select(steps, dependencies) == {1, 3}
+    assert StepSelection(until=["test"]).select(steps, dependencies) == {0, 1}
+    selection = StepSelection.model_validate({"from": ["build"], "until": ["test"]})
+    assert selection.select(steps, dependencies) == {0, 1}
+    with pytest.raises(ValueError, match="No step has the ID or tag publish"):
+        StepSelection(only=["publish"]).select(steps, dependencies)
+
+
+def _write_workflow(config_dir: Path) -> Path:
+    counter = config_dir / "counter"
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            f"""
+            steps:
+              - id: version
+                run: echo version >> {counter}; date +%s%N
+              - id: nested
+                workflow: missing
+              - id: build
+                run: echo build >> {counter}; echo "$VERSION"
+                tags: [release]
+                with:
+                  env:
+                    VERSION: ${{steps.version.output}}
+              - id: publish
+                run: echo publish >> {counter}
+                tags: [release]
+            """
+        )
+    return counter
+
+
+def test_run_selected_steps(config_dir: Path):
+    from tarmac.runner import Runner
+    from tarmac.scheduler import StepSelection
+
+    counter = _write_workflow(config_dir)
+    runner = Runner(base_path=str(config_dir))
+    # The missing nested workflow is never loaded.
+    outputs = runner.execute_workflow(
+        "workflow", {}, selection=StepSelection(until=["version"])
+    )
+    assert outputs["succeeded"] is True
+    version = outputs["steps"]["version"]["output"]
+
+    outputs = runner.execute_workflow(
+        "workflow", {}, selection=StepSelection(only=["release"])
+    )
+    assert outputs["succeeded"] is True
+    assert list(outputs["steps"]) == ["version", "build", "publish"]
+    assert outputs["steps"]["version"]["output"] == version
+    assert outputs["steps"]["build"]["output"] == version + "\n"
+    assert counter.read_text() == "version\nbuild\npublish\n"
+
+
+def test_resume_selected_steps(config_dir: Path):
+    from tarmac.runner import Runner
+    from tarmac.scheduler import StepSelection
+
+    counter = _write_workflow(config_dir)
+    runner = Runner(base_path=str(config_dir))
+    selection = StepSelection(start=["publish"])
+    runner.execute_workflow("workflow", {}, run_id="r1", selection=selection)
+    outputs = runner.resume_workflow("workflow", "r1")
+    assert list(outputs["steps"]) == ["publish"]
+    assert counter.read_text() == "publish\n"
+    # Another selection with the same run ID starts over.
+    selection = StepSelection(only=["publish"])
+    runner.execute_workflow("workflow", {}, run_id="r1", selection=selection)
+    assert counter.read_text() == "publish\npublish\n"
+
+
+def test_select_command(config_dir: Path):
+    counter = _write_workflow(config_dir)
+    command = [sys.executable, "-m", "tarmac", "workflow", "-b", str(config_dir)]
+    result = subprocess.run(
+        command + ["--from", "publish", "--output-format", "json"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert list(json.loads(result.stdout)["steps"]) == ["publish"]
+    assert counter.read_text() == "publish\n"
+
+    result = subprocess.run(
+        command + ["--only", "nothing"], capture_output=True, text=True
+    )
+    assert result.returncode == 2
+    assert "No step has the ID or tag nothing" in result.stderr
+    result = subprocess.run(
+        command + ["--only", "build", "--graph"], capture_output=True, text=True
+    )
+    assert result.returncode == 2
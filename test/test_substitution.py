@@ -65,9 +65,37 @@ steps:
         """,
         ["Hello", {"world": ["nested", "substitution", "test"]}],
     )
-    import sys
-
-    check("${__import__('sys').platform}", sys.platform)
+    with pytest.raises(ValueError, match="Calling __import__ is not allowed"):
+        check("${__import__('sys').platform}", "")
 
     check("123", 123)
     check("123.456", 123.456)
+
+
+def test_template():
+    from tarmac.templates import Template
+
+    template = Template({"a": "${n + 1}", "b": ["x-${n}", "$${n}", 3], "c": "plain"})
+    assert not template.constant
+    assert template.render({"n": 1}) == {"a": 2, "b": ["x-1", "${n}", 3], "c": "plain"}
+    assert template.render({"n": 2})["b"][0] == "x-2"
+
+    constant = Template({"list": [1, "two"], "escaped": "$${n}"})
+    assert not constant.constant
+    assert constant.render({}) == {"list": [1, "two"], "escaped": "${n}"}
+    plain = Template({"list": [1, "two"]})
+    assert plain.constant
+    rendered = plain.render({})
+    assert rendered == {"list": [1, "two"]}
+    # The rendered value can be changed without changing the template.
+    rendered["list"].append(3)
+    assert plain.render({}) == {"list": [1, "two"]}
+
+
+def test_params_template_is_compiled_once():
+    from tarmac.metadata import WorkflowStep
+
+    step = WorkflowStep(id="test", run="true", **{"with": {"a": "${n}"}})
+    assert step.params_template is step.params_template
+    instance = step.model_copy(update={"id": "test-1"})
+    assert instance.params_template is step.params_template
@@ -0,0 +1,257 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+
+def _wait_for_exit(pid: int) -> bool:
+    # Killed processes may stay zombies if nothing reaps them.
+    for _ in range(50):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                if f.read().rpartition(")")[2].split()[0] == "Z":
+                    return True
+        except FileNotFoundError:
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_timeout_validation():
+    from tarmac.metadata import WorkflowMetadata, WorkflowStep
+
+    assert WorkflowStep(run="true", timeout=1.5).timeout == 1.5
+    with pytest.raises(ValueError, match="Cannot use `timeout` with `py`"):
+        WorkflowStep(py="pass", timeout=1)
+    with pytest.raises(ValueError, match="`timeout` must be positive"):
+        WorkflowStep(run="true", timeout=0)
+    with pytest.raises(ValueError, match="`deadline` must be positive"):
+        WorkflowMetadata(deadline=-1)
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="Reads /proc")
+def test_shell_timeout(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    pid_file = config_dir / "pid"
+    start = time.monotonic()
+    out = runner.execute_shell(
+        f"echo partial; sleep 30 & echo $! > {pid_file}; wait", {}, timeout=0.3
+    )
+    assert time.monotonic() - start < 2
+    assert out["succeeded"] is False
+    assert out["timed_out"] is True
+    assert out["output"] == "partial\n"
+    # The background child was killed along with the shell.
+    assert _wait_for_exit(int(pid_file.read_text()))
+
+    out = runner.execute_shell(["true", "true"], {}, timeout=5)
+    assert out["succeeded"] is True
+    assert "timed_out" not in out
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="Reads /proc")
+def test_script_timeout(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "scripts").mkdir()
+    pid_file = config_dir / "pid"
+    with open(config_dir / "scripts" / "hang.py", "w") as f:
+        f.write(
+            f"""
+import os, time
+with open({str(pid_file)!r}, "w") as f:
+    f.write(str(os.getpid()))
+print("started", flush=True)
+time.sleep(30)
+"""
+        )
+    with open(config_dir / "scripts" / "empty.py", "w") as f:
+        f.write("")
+    runner.execute_script("empty", {})  # let uv set up the environment
+    start = time.monotonic()
+    out = runner.execute_script("hang", {}, timeout=1)
+    assert time.monotonic() - start < 5
+    assert out["succeeded"] is False
+    assert out["timed_out"] is True
+    assert out["output"] == "started\n"
+    # The interpreter started by uv was killed too.
+    assert _wait_for_exit(int(pid_file.read_text()))
+
+
+def _write_deadline_workflow(config_dir: Path):
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            deadline: 0.6
+            steps:
+              - id: quick
+                run: "true"
+              - id: plenty
+                run: "true"
+                if: time_left() > 100
+              - id: enough
+                run: "true"
+                if: 0 < time_left() < 100
+              - id: hang
+                run: echo hanging; sleep 30
+                timeout: 20
+              - id: never
+                run: "true"
+            """
+        )
+
+
+def test_workflow_deadline(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_deadline_workflow(config_dir)
+    runner = Runner(base_path=str(config_dir))
+    start = time.monotonic()
+    outputs = runner.execute_workflow("workflow", {})
+    assert time.monotonic() - start < 2
+    assert outputs["succeeded"] is False
+    assert outputs["timed_out"] is True
+    steps = outputs["steps"]
+    assert steps["quick"]["succeeded"] is True
+    assert steps["plenty"]["succeeded"] is None
+    assert steps["enough"]["succeeded"] is True
+    assert steps["hang"]["timed_out"] is True
+    assert steps["hang"]["output"] == "hanging\n"
+    assert "never" not in steps
+
+
+def test_async_workflow_deadline(config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+
+    _write_deadline_workflow(config_dir)
+    runner = AsyncRunner(base_path=str(config_dir))
+    start = time.monotonic()
+    outputs = asyncio.run(runner.execute_workflow("workflow", {}))
+    assert time.monotonic() - start < 2
+    assert outputs["timed_out"] is True
+    steps = outputs["steps"]
+    assert steps["enough"]["succeeded"] is True
+    assert steps["hang"]["timed_out"] is True
+    assert steps["hang"]["output"] == "hanging\n"
+    assert "never" not in steps
+
+
+def test_parallel_deadline(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir), jobs=4)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            deadline: 0.4
+            steps:
+              - id: first
+                run: sleep 30
+                needs: []
+              - id: second
+                run: sleep 30
+                needs: []
+              - id: fanned
+                run: sleep 30
+                needs: []
+                matrix:
+                  n: [1, 2]
+              - id: after
+                run: "true"
+                needs: [first]
+            """
+        )
+    start = time.monotonic()
+    outputs = runner.execute_workflow("workflow", {})
+    assert time.monotonic() - start < 2
+    assert outputs["timed_out"] is True
+    steps = outputs["steps"]
+    assert steps["first"]["timed_out"] is True
+    assert steps["second"]["timed_out"] is True
+    assert all(out["timed_out"] for out in steps["fanned"]["instances"].values())
+    assert "after" not in steps
+
+
+@pytest.mark.parametrize("kind", ["sync", "async"])
+def test_parallel_step_timeout(kind: str, config_dir: Path):
+    from tarmac.async_runner import AsyncRunner
+    from tarmac.runner import Runner
+
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: slow
+                run: sleep 30
+                needs: []
+                timeout: 0.3
+              - id: sibling
+                run: echo partial; sleep 30
+                needs: []
+              - id: nested
+                workflow: inner
+                needs: []
+            """
+        )
+    with open(config_dir / "workflows" / "inner.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: hang
+                run: sleep 30
+            """
+        )
+    start = time.monotonic()
+    if kind == "sync":
+        outputs = Runner(base_path=str(config_dir), jobs=3).execute_workflow(
+            "workflow", {}
+        )
+    else:
+        runner = AsyncRunner(base_path=str(config_dir), jobs=3)
+        outputs = asyncio.run(runner.execute_workflow("workflow", {}))
+    # The steps running next to the one that timed out are killed with it.
+    assert time.monotonic() - start < 2
+    assert outputs["succeeded"] is False
+    steps = outputs["steps"]
+    assert steps["slow"]["timed_out"] is True
+    assert steps["sibling"]["timed_out"] is True
+    assert steps["sibling"]["output"] == "partial\n"
+    assert steps["nested"]["steps"]["hang"]["timed_out"] is True
+
+
+def test_nested_workflow_deadline(config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "outer.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: inner
+                workflow: inner
+                timeout: 0.3
+            """
+        )
+    with open(config_dir / "workflows" / "inner.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: hang
+                run: sleep 30
+            """
+        )
+    start = time.monotonic()
+    outputs = runner.execute_workflow("outer", {})
+    assert time.monotonic() - start < 2
+    inner = outputs["steps"]["inner"]
+    assert inner["timed_out"] is True
+    assert inner["steps"]["hang"]["timed_out"] is True
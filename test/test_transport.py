@@ -0,0 +1,223 @@
+from pathlib import Path
+
+import pytest
+
+TRANSPORTS = ["local", "loopback"]
+
+
+def make_transport(kind: str, cwd: str | Path | None = None):
+    from loopback import LoopbackTransport
+
+    from tarmac.transport import LocalTransport
+
+    if kind == "local":
+        return LocalTransport(cwd)
+    return LoopbackTransport(str(cwd) if cwd is not None else None)
+
+
+@pytest.mark.parametrize("kind", TRANSPORTS)
+def test_run_shell(kind: str, tmp_path: Path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "file").write_text("content")
+    transport = make_transport(kind, tmp_path)
+
+    result = transport.run_shell(
+        ["cat", 'echo "$GREETING, it\'s $(cat file)"', "cat"],
+        {"GREETING": "hello 'quoted' $world"},
+        "sub",
+        "input\n",
+    )
+    assert result.returncode == 0
+    assert result.stdout == "input\nhello 'quoted' $world, it's content\n"
+    assert result.stderr == ""
+
+    result = transport.run_shell(["echo one", "echo two >&2; exit 3", "echo three"], {})
+    assert result == (3, "one\n", "two\n", False)
+
+    assert transport.path_exists("sub/file", "f")
+    assert not transport.path_exists("sub/file", "d")
+    assert transport.path_exists("sub", "d")
+    assert not transport.path_exists("missing")
+
+
+@pytest.mark.parametrize("kind", TRANSPORTS)
+def test_run_shell_timeout(kind: str, tmp_path: Path):
+    import time
+
+    transport = make_transport(kind, tmp_path)
+    start = time.monotonic()
+    result = transport.run_shell(
+        ["echo before", "sleep 30", "echo after"], {}, timeout=0.3
+    )
+    assert time.monotonic() - start < 2
+    assert result.timed_out
+    assert result.returncode != 0
+    assert result.stdout == "before\n"
+
+
+@pytest.mark.parametrize("kind", TRANSPORTS)
+def test_run_script(kind: str, config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=config_dir, transport=make_transport(kind, config_dir))
+    (config_dir / "scripts").mkdir()
+    with open(config_dir / "scripts" / "script.py", "w") as f:
+        f.write(
+            """
+# /// tarmac
+# inputs:
+#   name:
+#     type: str
+# ///
+import os
+from tarmac.operations import run
+def main(op):
+    op.log("running in " + os.path.basename(os.getcwd()))
+    op.outputs["greeting"] = "hello " + op.inputs["name"] + " '$x'"
+run(main)
+"""
+        )
+    outputs = runner.execute_script("script", {"name": "world"})
+    assert outputs == {
+        "succeeded": True,
+        "greeting": "hello world '$x'",
+        "output": "running in config\n",
+    }
+
+    with open(config_dir / "scripts" / "raw.py", "w") as f:
+        f.write(
+            """
+import sys
+sys.stdout.write("no newline")
+sys.stderr.write("error")
+sys.exit(2)
+"""
+        )
+    outputs = runner.execute_script("raw", {})
+    assert outputs == {"succeeded": False, "output": "no newline", "error": "error"}
+
+
+@pytest.mark.parametrize("kind", TRANSPORTS)
+def test_script_operations_shim(kind: str, config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=config_dir, transport=make_transport(kind, config_dir))
+    (config_dir / "scripts").mkdir()
+    with open(config_dir / "scripts" / "shim.py", "w") as f:
+        f.write(
+            """
+import importlib.util
+from tarmac.operations import run
+def main(op):
+    # The operations come from the shim, even where tarmac is installed.
+    op.outputs["runner"] = importlib.util.find_spec("tarmac.runner") is not None
+run(main)
+"""
+        )
+    outputs = runner.execute_script("shim", {})
+    assert outputs == {
+        "succeeded": True,
+        "runner": False,
+        "output": "",
+    }
+
+
+@pytest.mark.parametrize("kind", TRANSPORTS)
+def test_run_large_script(kind: str, config_dir: Path):
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=config_dir, transport=make_transport(kind, config_dir))
+    (config_dir / "scripts").mkdir()
+    # Larger than a single command line argument may be on Linux.
+    padding = "# " + "x" * 200 * 1024 + "\n"
+    with open(config_dir / "scripts" / "large.py", "w") as f:
+        f.write(
+            padding
+            + """
+# /// tarmac
+# inputs:
+#   data:
+#     type: str
+#   sleep:
+#     type: int
+# ///
+import time
+from tarmac.operations import run
+def main(op):
+    op.outputs["length"] = len(op.inputs["data"])
+    time.sleep(op.inputs["sleep"])
+run(main)
+"""
+        )
+    data = "'$x\n" * 100 * 1024
+    outputs = runner.execute_script("large", {"data": data, "sleep": 0})
+    assert outputs == {"succeeded": True, "length": len(data), "output": ""}
+
+    outputs = runner.execute_script("large", {"data": "", "sleep": 30}, timeout=1)
+    assert outputs["succeeded"] is False
+    assert outputs["timed_out"] is True
+
+
+def test_workflow_through_loopback(config_dir: Path):
+    from loopback import LoopbackTransport
+
+    from tarmac.runner import Runner
+
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: write
+                run: echo "$TEXT" > file
+                with:
+                  env:
+                    TEXT: written
+              - id: read
+                run: cat file
+                if: isfile('file') and run('true').succeeded
+            """
+        )
+    runner = Runner(base_path=config_dir, transport=LoopbackTransport(str(config_dir)))
+    outputs = runner.execute_workflow("workflow", {})
+    assert outputs["succeeded"] is True
+    assert outputs["steps"]["read"]["output"] == "written\n"
+
+
+def test_ssh_transport_commands(tmp_path: Path):
+    from tarmac.transport import SSHTransport
+
+    transport = SSHTransport(
+        "example.com",
+        user="deploy",
+        port=2222,
+        cwd="/srv/app",
+        ssh_options=["-i", "key"],
+        control_dir=tmp_path,
+    )
+    command = transport._remote_command("echo hi")
+    assert command[0] == "ssh"
+    assert "ControlMaster=auto" in command
+    assert f"ControlPath={transport.control_path}" in command
+    assert transport.control_path.startswith(str(tmp_path))
+    assert command[-6:] == ["-p", "2222", "-i", "key", "example.com", "echo hi"]
+    assert SSHTransport("example.com").control_path != transport.control_path
+
+    script = transport.shell_script(["make", "make install"], {"A": "1"}, "build")
+    assert script.splitlines() == [
+        "cd /srv/app/build || exit 1",
+        "export A=1",
+        "sh -c make || exit $?",
+        "sh -c 'make install' </dev/null || exit $?",
+    ]
+    with pytest.raises(ValueError, match="Invalid environment variable name: A;"):
+        transport.shell_script(["true"], {"A;": "1"})
+
+
+def test_runner_transport_arguments(config_dir: Path):
+    from tarmac.runner import Runner
+    from tarmac.transport import LocalTransport
+
+    assert isinstance(Runner(base_path=config_dir).transport, LocalTransport)
+    with pytest.raises(ValueError, match="Cannot use `cwd` with `transport`"):
+        Runner(base_path=config_dir, cwd=config_dir, transport=LocalTransport())
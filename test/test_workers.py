@@ -0,0 +1,164 @@
+from pathlib import Path
+
+SCRIPT = """
+# /// tarmac
+# ///
+import os
+import sys
+from tarmac.operations import run
+
+# Neither the modules a script imports nor its namespace stay in a warm worker.
+state = sys.modules.setdefault("warm_state", type(sys)("warm_state"))
+state.runs = getattr(state, "runs", 0) + 1
+fresh = "marker" not in globals()
+marker = True
+
+def main(op):
+    op.log("hello")
+    op.outputs["pid"] = os.getpid()
+    op.outputs["runs"] = state.runs
+    op.outputs["fresh"] = fresh
+
+run(main)
+"""
+
+
+def _write_script(config_dir: Path, name: str, source: str) -> None:
+    (config_dir / "scripts").mkdir(exist_ok=True)
+    with open(config_dir / "scripts" / f"{name}.py", "w") as f:
+        f.write(source)
+
+
+def test_warm_workers(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_script(config_dir, "warm", SCRIPT)
+    _write_script(config_dir, "raise", "raise ValueError('This is a test error')\n")
+    with Runner(base_path=str(config_dir), warm_workers=True) as runner:
+        first = runner.execute_script("warm", {})
+        second = runner.execute_script("warm", {})
+        assert first["succeeded"] is True
+        assert first["output"] == "hello\n"
+        assert second["pid"] == first["pid"]
+        assert second["runs"] == 1
+        assert second["fresh"] is True
+
+        outputs = runner.execute_script("raise", {})
+        assert outputs["succeeded"] is False
+        assert outputs["error"].startswith(
+            'Traceback (most recent call last):\n  File "'
+        )
+        assert outputs["error"].endswith("ValueError: This is a test error\n")
+        assert runner.execute_script("warm", {})["pid"] == first["pid"]
+
+        # Opting out runs the script in a new interpreter.
+        cold = runner.execute_script("warm", {}, warm=False)
+        assert cold["pid"] != first["pid"]
+        assert cold["runs"] == 1
+
+        # A changed script gets a new worker.
+        _write_script(config_dir, "warm", SCRIPT + "\n")
+        assert runner.execute_script("warm", {})["pid"] != first["pid"]
+
+
+def test_worker_isolation(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_script(config_dir, "helper", "value = None\n")
+    _write_script(
+        config_dir,
+        "set",
+        """
+import os
+import helper
+from tarmac.operations import run
+
+os.environ["TARMAC_TEST_LEAK"] = "leaked"
+helper.value = "leaked"
+
+def main(op):
+    op.outputs["pid"] = os.getpid()
+
+run(main)
+""",
+    )
+    _write_script(
+        config_dir,
+        "get",
+        """
+import os
+import helper
+from tarmac.operations import run
+
+def main(op):
+    op.outputs["pid"] = os.getpid()
+    op.outputs["env"] = os.environ.get("TARMAC_TEST_LEAK")
+    op.outputs["value"] = helper.value
+
+run(main)
+""",
+    )
+    with Runner(base_path=str(config_dir), warm_workers=True) as runner:
+        first = runner.execute_script("set", {})
+        second = runner.execute_script("get", {})
+    assert first["succeeded"] is True
+    assert second["pid"] == first["pid"]
+    assert second["env"] is None
+    assert second["value"] is None
+
+
+def test_worker_recycling(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_script(config_dir, "warm", SCRIPT)
+    _write_script(config_dir, "hang", "import time\ntime.sleep(60)\n")
+    with Runner(base_path=str(config_dir), warm_workers=True) as runner:
+        assert runner.workers is not None
+        runner.workers.max_runs = 2
+        pids = [runner.execute_script("warm", {})["pid"] for _ in range(4)]
+        assert pids[0] == pids[1] != pids[2] == pids[3]
+
+        outputs = runner.execute_script("hang", {}, timeout=1)
+        assert outputs["succeeded"] is False
+        assert outputs["timed_out"] is True
+        assert runner.execute_script("warm", {})["pid"] not in pids
+
+
+def test_warm_step_opt_out(config_dir: Path):
+    from tarmac.runner import Runner
+
+    _write_script(config_dir, "warm", SCRIPT)
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "workflow.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: first
+                do: warm
+              - id: second
+                do: warm
+              - id: cold
+                do: warm
+                warm: false
+            """
+        )
+    with Runner(base_path=str(config_dir), warm_workers=True) as runner:
+        steps = runner.execute_workflow("workflow", {})["steps"]
+    assert steps["first"]["pid"] == steps["second"]["pid"] != steps["cold"]["pid"]
+    assert steps["cold"]["runs"] == 1
+
+
+def test_async_warm_workers(config_dir: Path):
+    import asyncio
+
+    from tarmac.async_runner import AsyncRunner
+
+    _write_script(config_dir, "warm", SCRIPT)
+    runner = AsyncRunner(base_path=str(config_dir), warm_workers=True)
+    try:
+        first = asyncio.run(runner.execute_script("warm", {}))
+        second = asyncio.run(runner.execute_script("warm", {}))
+    finally:
+        runner.close()
+    assert first["pid"] == second["pid"]
+    assert second["runs"] == 1
@@ -465,3 +465,42 @@ def test_workflow_callbacks(config_dir: Path):
     }
     assert before_called == 1
     assert after_called == 1
+
+
+def test_workflow_files_parsed_once(config_dir: Path, monkeypatch):
+    from tarmac.metadata import WorkflowMetadata
+    from tarmac.runner import Runner
+
+    runner = Runner(base_path=str(config_dir))
+    (config_dir / "workflows").mkdir()
+    with open(config_dir / "workflows" / "outer.yml", "w") as f:
+        f.write(
+            """
+            steps:
+              - id: inner
+                workflow: inner
+                matrix:
+                  n: [1, 2, 3]
+            """
+        )
+    with open(config_dir / "workflows" / "inner.yml", "w") as f:
+        f.write("steps: [{id: one, py: \"outputs['n'] = 1\"}]\n")
+
+    loaded = []
+    load = WorkflowMetadata.load.__func__
+
+    def counting_load(cls, file: str):
+        loaded.append(file)
+        return load(cls, file)
+
+    monkeypatch.setattr(WorkflowMetadata, "load", classmethod(counting_load))
+    assert runner.execute_workflow("outer", {})["succeeded"] is True
+    assert runner.execute_workflow("outer", {})["succeeded"] is True
+    assert len(loaded) == 2
+
+    # A changed file is parsed again.
+    with open(config_dir / "workflows" / "inner.yml", "w") as f:
+        f.write("steps: [{id: two, py: \"outputs['n'] = 2\"}]\n")
+    outputs = runner.execute_workflow("outer", {})
+    assert len(loaded) == 3
+    assert outputs["steps"]["inner"]["instances"]["inner-1"]["steps"]["two"]["n"] == 2